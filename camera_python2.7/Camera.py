@@ -21,6 +21,8 @@ check_version('labscript', '2.0.1', '3')
 from labscript_devices import labscript_device, BLACS_tab, BLACS_worker
 from labscript import TriggerableDevice, LabscriptError, set_passed_properties
 import numpy as np
+import h5py
+from bisect import bisect_left, bisect_right, insort
 
 @labscript_device
 class Camera(TriggerableDevice):
@@ -34,10 +36,15 @@ class Camera(TriggerableDevice):
     def __init__(self, name, parent_device, connection,
                  BIAS_port=1027, serial_number=0x0, SDK='', effective_pixel_size=0.0,
                  exposure_time=float('nan'), orientation='side', minimum_recovery_time=0,
-                 **kwargs):
+                 roi=None, binning=1, sensor_size=None, **kwargs):
                     
         # not a class attribute, so we don't have to have a subclass for each model of camera:
         self.minimum_recovery_time = minimum_recovery_time
+        # (width, height) of the images the camera reads out, if known, to check the rois against
+        self.sensor_size = sensor_size
+        # Default software region of interest (x, y, width, height) of the images
+        # and binning, applied by the camera server before storing them:
+        self.roi, self.binning = self._check_processing(name, roi, binning)
         self.exposure_time = exposure_time
         self.orientation = orientation
         self.BLACS_connection = BIAS_port
@@ -47,6 +54,11 @@ class Camera(TriggerableDevice):
         self.sdk = str(SDK)
         self.effective_pixel_size = effective_pixel_size
         self.exposures = []
+        # (roi, binning) of each exposure
+        self.exposure_processing = []
+        # Sorted start and end times of the exposures, to check the recovery time by bisection
+        self._exposure_starts = []
+        self._exposure_ends = []
         
         # DEPRECATED: backward compatibility:
         if 'exposuretime' in kwargs:
@@ -58,7 +70,10 @@ class Camera(TriggerableDevice):
         TriggerableDevice.__init__(self, name, parent_device, connection, **kwargs)
 
         
-    def expose(self, name, t , frametype, exposure_time=None):
+    def expose(self, name, t , frametype, exposure_time=None, roi=None, binning=None):
+        # roi (x, y, width, height) and binning override the ones of the device for this exposure
+        roi, binning = self._check_processing(self.name, self.roi if roi is None else roi,
+                                              self.binning if binning is None else binning)
         if exposure_time is None:
             duration = self.exposure_time
         else:
@@ -69,39 +84,70 @@ class Camera(TriggerableDevice):
         if not duration > 0:
             raise LabscriptError("exposure_time must be > 0, not %s"%str(duration))
         # Only ask for a trigger if one has not already been requested by 
-        # another camera attached to the same trigger:
-        already_requested = False
-        """
-        for camera in self.trigger_device.child_devices:
-            if camera is not self:
-                for _, other_t, _, other_duration in camera.exposures:
-                    if t == other_t and duration == other_duration:
-                        already_requested = True
-        """
-        if not already_requested:
+        # another camera attached to the same trigger. The requests are kept
+        # on the trigger device itself, keyed by (t, duration), so they live
+        # exactly as long as the compilation:
+        try:
+            requested_triggers = self.trigger_device.camera_triggers
+        except AttributeError:
+            requested_triggers = self.trigger_device.camera_triggers = {}
+        requested_by = requested_triggers.get((t, duration))
+        if requested_by is None or requested_by is self:
+            # A repeated request from the same camera still goes to the
+            # trigger device, which reports the overlap
             self.trigger_device.trigger(t, duration)
+            requested_triggers[(t, duration)] = self
         # Check for exposures too close together (check for overlapping 
         # triggers already performed in self.trigger_device.trigger()):
         start = t
         end = t + duration
-        for exposure in self.exposures:
-            _, other_t, _, other_duration = exposure
-            other_start = other_t
-            other_end = other_t + other_duration
-            if abs(other_start - end) < self.minimum_recovery_time or abs(other_end - start) < self.minimum_recovery_time:
-                raise LabscriptError('%s %s has two exposures closer together than the minimum recovery time: ' %(self.description, self.name) + \
-                                     'one at t = %fs for %fs, and another at t = %fs for %fs. '%(t,duration,start,duration) + \
-                                     'The minimum recovery time is %fs.'%self.minimum_recovery_time)
+        if self._too_close(self._exposure_starts, end) or self._too_close(self._exposure_ends, start):
+            raise LabscriptError('%s %s has two exposures closer together than the minimum recovery time: ' %(self.description, self.name) + \
+                                 'one at t = %fs for %fs, and another at t = %fs for %fs. '%(t,duration,start,duration) + \
+                                 'The minimum recovery time is %fs.'%self.minimum_recovery_time)
+        insort(self._exposure_starts, start)
+        insort(self._exposure_ends, end)
         self.exposures.append((name, t, frametype, duration))
+        self.exposure_processing.append((roi, binning))
         return duration
+        
+    def _check_processing(self, name, roi, binning):
+        if roi is not None:
+            roi = tuple(int(v) for v in roi)
+            if len(roi) != 4 or min(roi) < 0 or not roi[2] > 0 or not roi[3] > 0:
+                raise LabscriptError('Camera %s: roi must be (x, y, width, height) in pixels, not %s' % (name, str(roi)))
+        if int(binning) != binning or not binning >= 1:
+            raise LabscriptError('Camera %s: binning must be a positive integer, not %s' % (name, str(binning)))
+        if self.sensor_size is not None:
+            sensor_width, sensor_height = self.sensor_size
+            if roi is not None and (roi[0] + roi[2] > sensor_width or roi[1] + roi[3] > sensor_height):
+                raise LabscriptError('Camera %s: roi %s is not inside the %dx%d sensor'
+                                     % (name, str(roi), sensor_width, sensor_height))
+            width, height = roi[2:] if roi is not None else self.sensor_size
+            if binning > min(width, height):
+                raise LabscriptError('Camera %s: binning %d is larger than the %dx%d region'
+                                     % (name, binning, width, height))
+        elif roi is not None and binning > min(roi[2:]):
+            raise LabscriptError('Camera %s: binning %d is larger than the roi %s' % (name, binning, str(roi)))
+        return roi, int(binning)
+        
+    def _too_close(self, sorted_times, time):
+        # Whether any of the sorted times is within the minimum recovery time of time.
+        # Bisection finds the few candidates, the comparison itself is the same as
+        # it always was so that rounding decides borderline cases the same way.
+        recovery_time = self.minimum_recovery_time
+        i = bisect_left(sorted_times, time - 2*recovery_time)
+        j = bisect_right(sorted_times, time + 2*recovery_time)
+        return any(abs(other_time - time) < recovery_time for other_time in sorted_times[i:j])
     
     def do_checks(self):
         # Check that all Cameras sharing a trigger device have exposures when we have exposures:
         try:
             for camera in self.trigger_device.child_devices:
                 if camera is not self:
+                    other_exposures = set(camera.exposures)
                     for exposure in self.exposures:
-                        if exposure not in camera.exposures:
+                        if exposure not in other_exposures:
                             _, start, _, duration = exposure
                             raise LabscriptError('Cameras %s and %s share a trigger. ' % (self.name, camera.name) + 
                                                  '%s has an exposure at %fs for %fs, ' % (self.name, start, duration) +
@@ -110,15 +156,45 @@ class Camera(TriggerableDevice):
         except AttributeError:
             pass
             
+    def exposures_table(self):
+        # The EXPOSURES table, in the order of the expose() calls. The first four
+        # columns are as they always were (name, time, frametype, exposure_time),
+        # but the names are only as long as the longest one and the frametypes
+        # are an enum of the frametypes in use. frame_index is the position of
+        # the image of each exposure in the sequence of images of the camera.
+        # roi_x, roi_y, roi_width, roi_height (0 for the whole image) and binning
+        # tell the camera server how to crop and bin the image before storing it.
+        names, times, frametypes, durations = zip(*self.exposures)
+        frametypes = [str(frametype) for frametype in frametypes]
+        frametype_values = dict((frametype, k) for k, frametype in enumerate(sorted(set(frametypes))))
+        table_dtypes = [('name','a%d'%max(len(str(name)) for name in names)),
+                        ('time',float),
+                        ('frametype',h5py.special_dtype(enum=(np.int16, frametype_values))),
+                        ('exposure_time',float),
+                        ('frame_index',np.int32),
+                        ('roi_x',np.int32),
+                        ('roi_y',np.int32),
+                        ('roi_width',np.int32),
+                        ('roi_height',np.int32),
+                        ('binning',np.int16)]
+        data = np.empty(len(self.exposures), dtype=table_dtypes)
+        data['name'] = names
+        data['time'] = times
+        data['frametype'] = [frametype_values[frametype] for frametype in frametypes]
+        data['exposure_time'] = durations
+        data['frame_index'][np.argsort(data['time'], kind='mergesort')] = np.arange(len(data))
+        for k, (roi, binning) in enumerate(self.exposure_processing):
+            data['roi_x'][k], data['roi_y'][k], data['roi_width'][k], data['roi_height'][k] = roi or (0, 0, 0, 0)
+            data['binning'][k] = binning
+        return data
+            
     def generate_code(self, hdf5_file):
         self.do_checks()
-        table_dtypes = [('name','a256'), ('time',float), ('frametype','a256'), ('exposure_time',float)]
-        data = np.array(self.exposures,dtype=table_dtypes)
 
         group = self.init_device_group(hdf5_file)
 
         if self.exposures:
-            group.create_dataset('EXPOSURES', data=data)
+            group.create_dataset('EXPOSURES', data=self.exposures_table())
             
         # DEPRECATED backward campatibility for use of exposuretime keyword argument instead of exposure_time:
         self.set_property('exposure_time', self.exposure_time, location='device_properties', overwrite=True)
@@ -194,6 +270,134 @@ class CameraTab(DeviceTab):
             self.ui.is_responding.setVisible(False)
             self.ui.is_not_responding.setVisible(True)
 
+def check_response(connection, response, expected_response):
+    """Raises with the reply of the server unless it is the expected one."""
+    if response != expected_response:
+        # Replies of this exchange may still be in flight
+        connection.close()
+        raise Exception('invalid response from server: ' + str(response))
+
+
+class SocketConnection(object):
+    """Persistent connection to a camera server speaking the line-based ('\\r\\n') socket protocol.
+    
+    Replies are split on line boundaries, so 'ok' and 'done' can neither be
+    merged nor split by the network. The connection is (re)opened on demand.
+    """
+    
+    def __init__(self, host, port, timeout=120):
+        assert port, 'No port number supplied.'
+        assert host, 'No hostname supplied.'
+        assert str(int(port)) == str(port), 'Port must be an integer.'
+        self.host = host
+        self.port = int(port)
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = ''
+        
+    def connect(self):
+        self.close()
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+        self.buffer = ''
+        
+    def is_stale(self):
+        # Nothing should be readable between two requests: either the server
+        # closed the connection or there are leftover replies of an aborted exchange.
+        if self.sock is None or self.buffer:
+            return True
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        return bool(readable)
+        
+    def send(self, message):
+        if self.is_stale():
+            self.connect()
+        try:
+            self.sock.sendall('%s\r\n'%message)
+        except socket.error:
+            # The server dropped the connection, try once more on a fresh one
+            self.connect()
+            self.sock.sendall('%s\r\n'%message)
+            
+    def recv(self, timeout=None):
+        self.sock.settimeout(self.timeout if timeout is None else timeout)
+        try:
+            while '\r\n' not in self.buffer:
+                data = self.sock.recv(4096)
+                if not data:
+                    raise socket.error('connection closed by server')
+                self.buffer += data
+        except (socket.error, socket.timeout):
+            self.close()
+            raise
+        line, self.buffer = self.buffer.split('\r\n', 1)
+        return line
+        
+    def exchange(self, message, expected, timeout=None):
+        """Sends one request and reads its replies, one per expected reply.
+        
+        Each reply is checked as it arrives: the server answers a failure
+        with a single line, so no further reply is waited for then.
+        """
+        self.send(message)
+        for expected_response in expected:
+            check_response(self, self.recv(timeout), expected_response)
+        
+        
+class ZMQConnection(object):
+    """Persistent zmq REQ connection to a camera server.
+    
+    The socket is kept open between requests and replaced after a timeout,
+    as a REQ socket can not be reused once a reply went missing.
+    """
+    
+    def __init__(self, host, port, timeout=120):
+        self.host = host
+        self.port = int(port)
+        self.timeout = timeout
+        self.sock = None
+        
+    def connect(self):
+        self.close()
+        self.sock = zmq.Context.instance().socket(zmq.REQ)
+        self.sock.setsockopt(zmq.LINGER, 0)
+        self.sock.connect('tcp://%s:%d'%(socket.gethostbyname(self.host), self.port))
+        
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        
+    def request(self, message, timeout=None):
+        if self.sock is None:
+            self.connect()
+        timeout = self.timeout if timeout is None else timeout
+        self.sock.send(message)
+        if not self.sock.poll(int(timeout*1000)):
+            self.close()
+            raise socket.timeout('no response from server after %s seconds'%str(timeout))
+        return self.sock.recv()
+        
+    def exchange(self, message, expected, timeout=None):
+        """Sends one request and checks its replies, one per expected reply.
+        
+        The server answers the request and then waits for a go-ahead
+        (any message) before each further reply. A failure is answered
+        with a single reply, so no go-ahead is sent after it.
+        """
+        check_response(self, self.request(message, timeout), expected[0])
+        for expected_response in expected[1:]:
+            check_response(self, self.request('hello', timeout), expected_response)
+
+        
 @BLACS_worker            
 class CameraWorker(Worker):
     def init(self):#, port, host, use_zmq):
@@ -201,93 +405,44 @@ class CameraWorker(Worker):
 #        self.host = host
 #        self.use_zmq = use_zmq
         global socket; import socket
+        global select; import select
         global zmq; import zmq
-        global zprocess; import zprocess
         global shared_drive; import labscript_utils.shared_drive as shared_drive
         
         self.host = ''
         self.use_zmq = False
+        self.connection = None
         
     def update_settings_and_check_connectivity(self, host, use_zmq):
         self.host = host
         self.use_zmq = use_zmq
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
         if not self.host:
             return False
-        if not self.use_zmq:
-            return self.initialise_sockets(self.host, self.port)
-        else:
-            response = zprocess.zmq_get_raw(self.port, self.host, data='hello')
-            if response == 'hello':
-                return True
+        self.get_connection().exchange('hello', ['hello'], timeout=10)
+        return True
+            
+    def get_connection(self):
+        # One persistent connection per camera server, opened on first use
+        if self.connection is None:
+            if self.use_zmq:
+                self.connection = ZMQConnection(self.host, self.port)
             else:
-                raise Exception('invalid response from server: ' + str(response))
-                
-    def initialise_sockets(self, host, port):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        assert port, 'No port number supplied.'
-        assert host, 'No hostname supplied.'
-        assert str(int(port)) == port, 'Port must be an integer.'
-        s.settimeout(10)
-        s.connect((host, int(port)))
-        s.send('hello\r\n')
-        response = s.recv(1024)
-        s.close()
-        if 'hello' in response:
-            return True
-        else:
-            raise Exception('invalid response from server: ' + response)
-    
+                self.connection = SocketConnection(self.host, self.port)
+        return self.connection
+        
     def transition_to_buffered(self, device_name, h5file, initial_values, fresh):
         h5file = shared_drive.path_to_agnostic(h5file)
-        if not self.use_zmq:
-            return self.transition_to_buffered_sockets(h5file,self.host, self.port)
-        response = zprocess.zmq_get_raw(self.port, self.host, data=h5file)
-        if response != 'ok':
-            raise Exception('invalid response from server: ' + str(response))
-        response = zprocess.zmq_get_raw(self.port, self.host, timeout = 120)
-        if response != 'done':
-            raise Exception('invalid response from server: ' + str(response))
-        return {} # indicates final values of buffered run, we have none
-        
-    def transition_to_buffered_sockets(self, h5file, host, port):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(120)
-        s.connect((host, int(port)))
-        s.send('%s\r\n'%h5file)
-        response = s.recv(1024)
-        if not 'ok' in response:
-            s.close()
-            raise Exception(response)
-        response = s.recv(1024)
-        if not 'done' in response:
-            s.close()
-            raise Exception(response)
+        self.get_connection().exchange(h5file, ['ok', 'done'], timeout=120)
         return {} # indicates final values of buffered run, we have none
         
     def transition_to_manual(self):
-        if not self.use_zmq:
-            return self.transition_to_manual_sockets(self.host, self.port)
-        response = zprocess.zmq_get_raw(self.port, self.host, 'done')
-        if response != 'ok':
-            raise Exception('invalid response from server: ' + str(response))
-        response = zprocess.zmq_get_raw(self.port, self.host, timeout = 60)
-        if response != 'done':
-            raise Exception('invalid response from server: ' + str(response))
-        return True # indicates success
-        
-    def transition_to_manual_sockets(self, host, port):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(120)
-        s.connect((host, int(port)))
-        s.send('done\r\n')
-        response = s.recv(1024)
-        if response != 'ok\r\n':
-            s.close()
-            raise Exception(response)
-        response = s.recv(1024)
-        if not 'done' in response:
-            s.close()
-            raise Exception(response)
+        self.get_connection().exchange('done', ['ok', 'done'], timeout=120)
+        # The server replies once the images are read out, wait until they
+        # are written so that the shot is never handed over half-written
+        self.get_connection().exchange('flush', ['done'], timeout=120)
         return True # indicates success
         
     def abort_buffered(self):
@@ -297,27 +452,14 @@ class CameraWorker(Worker):
         return self.abort()
     
     def abort(self):
-        if not self.use_zmq:
-            return self.abort_sockets(self.host, self.port)
-        response = zprocess.zmq_get_raw(self.port, self.host, 'abort')
-        if response != 'done':
-            raise Exception('invalid response from server: ' + str(response))
-        return True # indicates success 
-        
-    def abort_sockets(self, host, port):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(120)
-        s.connect((host, int(port)))
-        s.send('abort\r\n')
-        response = s.recv(1024)
-        if not 'done' in response:
-            s.close()
-            raise Exception(response)
+        self.get_connection().exchange('abort', ['done'], timeout=120)
         return True # indicates success 
     
     def program_manual(self, values):
         return {}
     
     def shutdown(self):
+        if self.connection is not None:
+            self.connection.close()
         return
         
@@ -0,0 +1,117 @@
+"""Optical density of absorption images
+
+Reduces the raw frames of an absorption imaging shot to optical density,
+OD = -ln((atoms - dark) / (probe - dark)), in float32. The frames are
+grouped by their frametype in EXPOSURES: the k-th atoms frame goes with
+the k-th probe frame and the k-th dark frame (or the only one, or none).
+Counts are clipped from below before the logarithm, so that dark or
+saturated pixels give a finite OD.
+
+H5Writer runs this stage in its writer thread when the camera is
+configured for it (see camera_servers.ini), and stores the OD in the
+data/<camera>/optical_density group next to, or instead of, the raw
+frames it was computed from.
+
+  Typical usage example:
+
+  od = optical_density(atoms, probe, dark, min_counts = 1., max_od = 8.)
+  od_images, od_names, used = reduce_images(images, image_names, frametypes)
+"""
+
+import numpy as np
+
+MODES = ('off', 'add', 'replace')
+DEFAULT_FRAMETYPES = ('atoms', 'probe', 'dark')
+
+
+def optical_density(atoms, probe, dark=None, min_counts=1., max_od=None):
+    """
+    Computes the optical density of an absorption image
+
+    Args:
+        atoms (np.array): Frame with the atoms.
+        probe (np.array): Frame of the probe alone.
+        dark  (np.array): Background frame, subtracted from both. Optional.
+        min_counts (float): Background-subtracted counts are clipped to at
+                             least this, must be positive.
+        max_od (float): OD is clipped to at most this, None for no clipping.
+
+    Returns:
+        np.array: float32 OD, the shape of the frames.
+    """
+
+    if not min_counts > 0:
+        raise ValueError('min_counts must be positive, not %s' % min_counts)
+    transmitted = np.array(atoms, dtype=np.float32)
+    incident = np.array(probe, dtype=np.float32)
+    if dark is not None:
+        dark = np.asarray(dark, dtype=np.float32)
+        transmitted -= dark
+        incident -= dark
+    np.maximum(transmitted, min_counts, out=transmitted)
+    np.maximum(incident, min_counts, out=incident)
+    # -ln(transmitted / incident), in place
+    np.divide(incident, transmitted, out=incident)
+    od = np.log(incident, out=incident)
+    if max_od is not None:
+        np.minimum(od, max_od, out=od)
+    return od
+
+
+def absorption_groups(frametypes, frametype_names=DEFAULT_FRAMETYPES):
+    """
+    Groups the frames of a shot for optical_density()
+
+    Args:
+        frametypes (list): Frametype of each frame.
+        frametype_names (tuple): Frametypes of the (atoms, probe, dark) frames.
+
+    Returns:
+        list: (atoms, probe, dark) frame indices, dark is None without dark frames.
+
+    Raises:
+        ValueError: The frames do not pair up.
+    """
+
+    atoms_name, probe_name, dark_name = frametype_names
+    atoms = [k for k, frametype in enumerate(frametypes) if frametype == atoms_name]
+    probes = [k for k, frametype in enumerate(frametypes) if frametype == probe_name]
+    darks = [k for k, frametype in enumerate(frametypes) if frametype == dark_name]
+    if len(atoms) != len(probes):
+        raise ValueError('%d %s frames but %d %s frames' % (len(atoms), atoms_name, len(probes), probe_name))
+    if len(darks) == 1:
+        darks = darks * len(atoms)
+    elif not darks:
+        darks = [None] * len(atoms)
+    elif len(darks) != len(atoms):
+        raise ValueError('%d %s frames for %d %s frames' % (len(darks), dark_name, len(atoms), atoms_name))
+    return zip(atoms, probes, darks)
+
+
+def reduce_images(images, image_names, frametypes, frametype_names=DEFAULT_FRAMETYPES, min_counts=1., max_od=None):
+    """
+    Computes the OD of every absorption image of a shot
+
+    Args:
+        images (list): 2D frames (or a 3D array), in the order of image_names.
+        image_names (list): Exposure name of each frame.
+        frametypes (list): Frametype of each frame.
+        frametype_names, min_counts, max_od: See absorption_groups() and
+            optical_density().
+
+    Returns:
+        od_images (list), od_names (list): One OD per atoms frame, named
+            after the atoms exposure. Empty if the shot has no atoms frame.
+        used (list): Sorted indices of the frames the ODs were computed
+            from, the other frames (e.g. fluorescence images) are not part
+            of any OD.
+    """
+
+    n_images = min(len(images), len(image_names), len(frametypes))
+    od_images, od_names, used = [], [], set()
+    for atoms, probe, dark in absorption_groups(frametypes[:n_images], frametype_names):
+        od_images.append(optical_density(images[atoms], images[probe],
+                                         None if dark is None else images[dark], min_counts, max_od))
+        od_names.append(image_names[atoms])
+        used.update(k for k in (atoms, probe, dark) if k is not None)
+    return od_images, od_names, sorted(used)
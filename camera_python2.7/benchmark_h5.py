@@ -0,0 +1,84 @@
+"""Benchmark of the image storage layouts of h5writer
+
+Writes synthetic absorption images (a noisy probe beam with an atom cloud)
+for the pco.edge ROI and the full ORCA frame with every layout and
+compression, and reports the write time and file size of each.
+
+  Typical usage example:
+
+  python benchmark_h5.py             # 3 images per shot, 5 shots
+  python benchmark_h5.py 10 20       # 10 images per shot, 20 shots
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import h5py
+import numpy as np
+from h5writer import write_images
+
+FRAMES = [('pco.edge ROI', (550, 600)),
+          ('ORCA full frame', (2048, 2048))]
+
+STORAGES = [('images', None, None),
+            ('stack', None, None),
+            ('stack', 'lzf', None),
+            ('stack', 'gzip', 1),
+            ('images', 'lzf', None),
+            ('images', 'gzip', 1)]
+
+
+def synthetic_images(n_images, shape, seed = 0):
+    """Returns n_images 16 bit images of a gaussian beam with shot noise."""
+
+    rng = np.random.RandomState(seed)
+    y, x = np.indices(shape)
+    cy, cx = shape[0] / 2., shape[1] / 2.
+    beam = 3000. * np.exp(-((x - cx)**2 + (y - cy)**2) / (2 * (shape[0] / 3.)**2))
+    cloud = np.exp(-((x - cx)**2 + (y - cy)**2) / (2 * (shape[0] / 20.)**2))
+    images = []
+    for k in range(n_images):
+        mean = 100. + beam * (1 - 0.8 * cloud * (k % 3 == 0))
+        images.append(rng.poisson(mean).astype(np.uint16))
+    return images
+
+
+def benchmark(shape, n_images, n_shots, layout, compression, compression_opts, directory):
+    images = synthetic_images(n_images, shape)
+    image_names = ['image_%d' % k for k in range(n_images)]
+    times = []
+    sizes = []
+    for shot in range(n_shots):
+        h5_filepath = os.path.join(directory, 'shot_%d.h5' % shot)
+        with h5py.File(h5_filepath, 'w') as f:
+            f.create_group('data')
+        start_time = time.time()
+        with h5py.File(h5_filepath, 'a') as f:
+            write_images(f['data'].create_group('CAMERA'), images, image_names,
+                         layout, compression, compression_opts)
+        times.append(time.time() - start_time)
+        sizes.append(os.path.getsize(h5_filepath))
+        os.remove(h5_filepath)
+    return np.median(times), np.mean(sizes)
+
+
+if __name__ == '__main__':
+    n_images = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    n_shots = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    directory = tempfile.mkdtemp()
+    try:
+        for frame_name, shape in FRAMES:
+            raw_size = n_images * shape[0] * shape[1] * 2
+            print('%s %dx%d, %d images (%.1f MB raw)' % (frame_name, shape[1], shape[0], n_images, raw_size / 1e6))
+            print('  %-8s %-12s %10s %10s %8s' % ('layout', 'compression', 'time (ms)', 'size (MB)', 'ratio'))
+            for layout, compression, compression_opts in STORAGES:
+                write_time, size = benchmark(shape, n_images, n_shots, layout,
+                                             compression, compression_opts, directory)
+                if compression_opts is not None:
+                    compression = '%s %d' % (compression, compression_opts)
+                print('  %-8s %-12s %10.1f %10.2f %8.2f' % (layout, compression, 1e3 * write_time,
+                                                           size / 1e6, raw_size / size))
+    finally:
+        shutil.rmtree(directory)
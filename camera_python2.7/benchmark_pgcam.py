@@ -0,0 +1,80 @@
+"""Micro-benchmark of the MONO16 unpacking of PointGreyCamera.grabImages
+
+Compares the former byte arithmetic (_i1 + 256*_i2 on a copy of the
+buffer) with pgcam.unpackMono16 on synthetic Chameleon3 frames, with and
+without row padding, and checks that both give the same pixels. Neither
+PyCapture2 nor a camera is needed.
+
+  Typical usage example:
+
+  python benchmark_pgcam.py          # 3 images, 50 repetitions
+  python benchmark_pgcam.py 10 20
+"""
+
+import sys
+import time
+import numpy as np
+from pgcam import unpackMono16
+
+ROWS, COLS = 964, 1288 # Chameleon3 CM3-U3-13S2M
+
+
+def synthetic_buffer(rows, cols, stride, seed = 0):
+    """Returns the raw uint8 buffer of a MONO16 frame and its pixels."""
+
+    rng = np.random.RandomState(seed)
+    pixels = rng.randint(0, 2**16, size = (rows, cols)).astype('<u2')
+    raw = np.zeros((rows, stride), dtype = np.uint8)
+    raw[:, :2*cols] = pixels.view(np.uint8).reshape((rows, 2*cols))
+    return raw.reshape(-1), pixels
+
+
+def legacy_unpack(data, rows, cols):
+    """The former grabImages arithmetic, which ignores the stride."""
+
+    _imdat = np.array(data)
+    _i1 = _imdat[::2]
+    _i2 = _imdat[1::2]
+    _imd4 = _i1 + 256*_i2
+    return _imd4.reshape((rows, cols))
+
+
+def time_it(function, repetitions):
+    times = []
+    for _ in range(repetitions):
+        start_time = time.time()
+        function()
+        times.append(time.time() - start_time)
+    return np.median(times)
+
+
+if __name__ == '__main__':
+    n_images = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    frame_mb = ROWS * COLS * 2 / 1e6
+
+    for stride in (2*COLS, 2*COLS + 64):
+        buffers = [synthetic_buffer(ROWS, COLS, stride, seed) for seed in range(n_images)]
+        out = np.empty((n_images, ROWS, COLS), dtype = np.uint16)
+
+        def new():
+            for k, (raw, _) in enumerate(buffers):
+                unpackMono16(raw, ROWS, COLS, stride, out[k])
+
+        new()
+        for k, (_, pixels) in enumerate(buffers):
+            assert np.array_equal(out[k], pixels)
+        new_time = time_it(new, repetitions)
+        print('%dx%d MONO16, stride %d bytes, %d images' % (COLS, ROWS, stride, n_images))
+        print('  unpackMono16   %8.2f ms  %8.0f MB/s' % (1e3 * new_time, n_images * frame_mb / new_time))
+
+        if stride == 2*COLS:
+            def legacy():
+                return [legacy_unpack(raw, ROWS, COLS) for raw, _ in buffers]
+
+            assert np.array_equal(legacy()[0], buffers[0][1])
+            legacy_time = time_it(legacy, repetitions)
+            print('  legacy         %8.2f ms  %8.0f MB/s  (%.1fx slower)' % (1e3 * legacy_time,
+                  n_images * frame_mb / legacy_time, legacy_time / new_time))
+        else:
+            print('  legacy         not applicable, it ignores the stride')
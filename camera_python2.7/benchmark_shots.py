@@ -0,0 +1,366 @@
+"""End-to-end benchmark of the shot cycle of the camera servers
+
+Runs a camera server of camera_server.py on a simulated camera (see
+simcams.py) and drives it through synthetic shots as BLACS would: the
+shot file, the 'done' and the 'flush' requests over zmq, with the
+camera triggered in between. Reports the percentiles of each phase of
+the cycle and the throughput, and appends them to a results file so that
+regressions show up over time (each run is compared with the last one
+with the same settings).
+
+Phases, as seen by BLACS:
+  buffered    shot file request until its 'done' (transition_to_buffered)
+  static      'done' request until its 'done' (transition_to_static)
+  flush       'flush' request until the images are on disk
+  dead_time   the whole cycle less the sequence itself
+and inside the server:
+  setup       transition_to_buffered (settings, buffers, acquisition start)
+  readout     getting the images off the camera (within static)
+  write       writing the images into the shot file (writer thread)
+and, with --startup, for a restarted server:
+  startup     starting a server process until it answers its first request,
+              which it only does once its camera is open
+
+  Typical usage example:
+
+  python benchmark_shots.py pcoedge                 # 50 shots of 3 images
+  python benchmark_shots.py hamamatsu --shots 200 --images 5 --compression lzf
+"""
+
+import os
+os.environ['CAMERA_BACKEND'] = 'simulated'
+
+import sys
+import time
+import json
+import shutil
+import socket
+import argparse
+import tempfile
+import datetime
+import threading
+import subprocess
+import zmq
+import h5py
+import numpy as np
+import simcams
+import camera_server
+from h5writer import LAYOUTS
+
+# Camera object (None for the server itself) and method of each server that
+# gets the images off the camera once the sequence is over
+READOUT = {'hamamatsu': (None, 'stop_readout'),
+           'pcoedge': (None, 'stop_stream'),
+           'pointgrey': ('pgcam', 'grabImages')}
+
+PHASES = ['buffered', 'setup', 'static', 'readout', 'flush', 'write', 'dead_time', 'startup']
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+# In the working directory, not in the source tree
+DEFAULT_RESULTS = 'benchmark_results.jsonl'
+
+
+class PhaseTimer(object):
+    """Accumulates the time spent in wrapped methods, per phase and per shot."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = {}
+
+    def add(self, phase, duration):
+        with self.lock:
+            self.durations[phase] = self.durations.get(phase, 0.) + duration
+
+    def wrap(self, obj, name, phase):
+        method = getattr(obj, name)
+        def timed(*args, **kwargs):
+            start_time = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.add(phase, time.time() - start_time)
+        setattr(obj, name, timed)
+
+    def pop(self):
+        with self.lock:
+            durations, self.durations = self.durations, {}
+        return durations
+
+
+def make_shot_file(h5_filepath, cam_name, n_images, period, exposure_time, roi=None, binning=1):
+    """
+    Writes a shot file with the camera globals of every server type and n_images exposures,
+    each cropped to roi (x, y, width, height) and binned.
+    """
+
+    with h5py.File(h5_filepath, 'w') as f:
+        f.create_group('data')
+        hcam_parameters = f.create_group('globals/hcam_parameters')
+        for name, value in [('hcam_trigger_source', 2), ('hcam_trigger_polarity', 2),
+                            ('hcam_ROIx', 2048), ('hcam_ROIy', 2048), ('hcam_cx', 0), ('hcam_cy', 0),
+                            ('hcam_exposure_time', exposure_time)]:
+            hcam_parameters.attrs[name] = value
+        f.create_group('globals/PointGrey_parameters').attrs['pg_exposure_time'] = exposure_time
+        f['globals'].attrs['pcoe_exposure_time'] = int(1e6 * exposure_time)
+
+        frametypes = ['atoms', 'probe', 'dark']
+        table_dtypes = [('name', 'a16'), ('time', float),
+                        ('frametype', h5py.special_dtype(enum=(np.int16, dict((t, k) for k, t in enumerate(frametypes))))),
+                        ('exposure_time', float), ('frame_index', np.int32),
+                        ('roi_x', np.int32), ('roi_y', np.int32), ('roi_width', np.int32), ('roi_height', np.int32),
+                        ('binning', np.int16)]
+        exposures = np.empty(n_images, dtype=table_dtypes)
+        exposures['name'] = ['image_%d' % k for k in range(n_images)]
+        exposures['time'] = period * np.arange(n_images)
+        exposures['frametype'] = np.arange(n_images) % len(frametypes)
+        exposures['exposure_time'] = exposure_time
+        exposures['frame_index'] = np.arange(n_images)
+        exposures['roi_x'], exposures['roi_y'], exposures['roi_width'], exposures['roi_height'] = roi or (0, 0, 0, 0)
+        exposures['binning'] = binning
+        f.create_group('devices/%s' % cam_name).create_dataset('EXPOSURES', data=exposures)
+
+
+class Client(object):
+    """The zmq side of the BLACS CameraWorker, see Camera.ZMQConnection."""
+
+    def __init__(self, port, timeout=30., reconnect_interval=None):
+        self.sock = zmq.Context.instance().socket(zmq.REQ)
+        self.sock.setsockopt(zmq.LINGER, 0)
+        if reconnect_interval is not None:
+            # ms between the attempts to connect to a server not listening yet
+            self.sock.setsockopt(zmq.RECONNECT_IVL, reconnect_interval)
+        self.sock.connect('tcp://127.0.0.1:%d' % port)
+        self.timeout = timeout
+
+    def request(self, message):
+        self.sock.send(message)
+        if not self.sock.poll(int(1e3 * self.timeout)):
+            raise RuntimeError('no response to %s after %g seconds' % (message, self.timeout))
+        return self.sock.recv()
+
+    def exchange(self, message, n_replies):
+        responses = [self.request(message)]
+        for _ in range(n_replies - 1):
+            responses.append(self.request('hello'))
+        return responses
+
+    def close(self):
+        self.sock.close()
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def stored_bytes(h5_filepath, cam_name):
+    """Returns the (uncompressed) size of the datasets of a camera in a shot file, optical density included."""
+
+    sizes = []
+    def add(name, item):
+        if isinstance(item, h5py.Dataset) and not name.endswith('image_names'):
+            sizes.append(item.dtype.itemsize * item.size)
+    with h5py.File(h5_filepath, 'r') as f:
+        f['data'][cam_name].visititems(add)
+    return sum(sizes)
+
+
+def percentiles(durations):
+    durations = np.asarray(durations)
+    return {'p50': float(np.percentile(durations, 50)),
+            'p90': float(np.percentile(durations, 90)),
+            'p99': float(np.percentile(durations, 99)),
+            'max': float(durations.max())}
+
+
+def run(server_type, n_shots, n_images, latency, period, exposure_time, storage, directory, quiet=False,
+        roi=None, binning=1):
+    """Runs the shots and returns the list of per-shot phase durations and the image size in bytes."""
+
+    simcams.configure(latency=latency)
+    cam_name = 'BENCHMARK'
+    port = free_port()
+    server = camera_server.SERVER_TYPES[server_type](port, cam_name, storage)
+    timer = PhaseTimer()
+    timer.wrap(server, 'transition_to_buffered', 'setup')
+    camera, method = READOUT[server_type]
+    timer.wrap(server if camera is None else getattr(server, camera), method, 'readout')
+    timer.wrap(server.writer, 'write', 'write')
+    client = Client(port)
+    sequence_duration = latency + period * n_images
+    shots = []
+    image_bytes = 0
+    stdout = sys.stdout
+    try:
+        if quiet:
+            sys.stdout = open(os.devnull, 'w')
+        assert client.request('hello') == 'hello'
+        for shot in range(n_shots):
+            h5_filepath = os.path.join(directory, 'shot_%04d.h5' % shot)
+            make_shot_file(h5_filepath, cam_name, n_images, period, exposure_time, roi, binning)
+            durations = {}
+            start_time = time.time()
+            assert client.exchange(h5_filepath, 2) == ['ok', 'done']
+            durations['buffered'] = time.time() - start_time
+            # The sequence
+            simcams.trigger_all(n_images, period)
+            time.sleep(sequence_duration)
+            static_time = time.time()
+            assert client.exchange('done', 2) == ['ok', 'done']
+            durations['static'] = time.time() - static_time
+            flush_time = time.time()
+            assert client.request('flush') == 'done'
+            durations['flush'] = time.time() - flush_time
+            durations['dead_time'] = time.time() - start_time - sequence_duration
+            durations.update(timer.pop())
+            shots.append(durations)
+            if not image_bytes:
+                image_bytes = stored_bytes(h5_filepath, cam_name) // n_images
+            os.remove(h5_filepath)
+    finally:
+        if quiet:
+            sys.stdout.close()
+            sys.stdout = stdout
+        client.close()
+        server.shutdown()
+    return shots, image_bytes
+
+
+def measure_startup(server_type, n_starts):
+    """
+    Returns the seconds from starting a server process until it answers 'hello', for each start.
+    A server only binds its port once its camera is open (see GenericServer.start()),
+    so this includes the import of the driver and the opening of the camera.
+    """
+
+    durations = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(n_starts):
+            port = free_port()
+            start_time = time.time()
+            process = subprocess.Popen([sys.executable, '-c', 'import camera_server; '
+                                        'camera_server.run_camera_server("BENCHMARK", "%s", %d)' % (server_type, port)],
+                                       cwd=HERE, stdout=devnull, stderr=devnull)
+            # Polls for the port often, so that the timing is not rounded up to zmq's 100 ms
+            client = Client(port, reconnect_interval=5)
+            try:
+                assert client.request('hello') == 'hello'
+                durations.append(time.time() - start_time)
+            finally:
+                client.close()
+                process.kill()
+                process.wait()
+    return durations
+
+
+def summarize(shots, n_images, image_bytes):
+    summary = {'phases': {}}
+    for phase in PHASES:
+        durations = [shot[phase] for shot in shots if phase in shot]
+        if durations:
+            summary['phases'][phase] = percentiles(durations)
+    dead_time = sum(shot['dead_time'] for shot in shots)
+    summary['frames_per_s'] = len(shots) * n_images / dead_time
+    summary['mb_per_s'] = len(shots) * n_images * image_bytes / 1e6 / dead_time
+    summary['image_bytes'] = image_bytes
+    return summary
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=HERE).strip()
+    except Exception:
+        return None
+
+
+def last_result(results_path, settings):
+    """Returns the last stored result with the same settings, None if there is none."""
+
+    if not os.path.exists(results_path):
+        return None
+    last = None
+    with open(results_path) as f:
+        for line in f:
+            result = json.loads(line)
+            if result['settings'] == settings:
+                last = result
+    return last
+
+
+def report(summary, previous):
+    print('%-10s %10s %10s %10s %10s %12s' % ('phase (ms)', 'p50', 'p90', 'p99', 'max', 'p50 change'))
+    for phase in PHASES:
+        if phase not in summary['phases']:
+            continue
+        p = summary['phases'][phase]
+        change = ''
+        if previous is not None and phase in previous['phases']:
+            change = '%+.0f%%' % (100. * (p['p50'] / previous['phases'][phase]['p50'] - 1))
+        print('%-10s %10.2f %10.2f %10.2f %10.2f %12s' % (phase, 1e3 * p['p50'], 1e3 * p['p90'],
+                                                          1e3 * p['p99'], 1e3 * p['max'], change))
+    print('%.1f frames/s, %.1f MB/s of dead time (%.2f MB per image)' % (summary['frames_per_s'],
+          summary['mb_per_s'], summary['image_bytes'] / 1e6))
+    if previous is not None:
+        print('compared with %s (commit %s)' % (previous['time'], previous['commit']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Shot cycle benchmark of the camera servers on simulated cameras')
+    parser.add_argument('camera', choices=sorted(camera_server.SERVER_TYPES), help='server type')
+    parser.add_argument('--shots', type=int, default=50)
+    parser.add_argument('--images', type=int, default=3, help='images per shot')
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds from a trigger to its frame')
+    parser.add_argument('--period', type=float, default=0.005, help='seconds between the triggers')
+    parser.add_argument('--exposure-time', type=float, default=0.001, help='seconds')
+    parser.add_argument('--layout', default='images', choices=LAYOUTS)
+    parser.add_argument('--compression', default='none', choices=['none', 'lzf', 'gzip'])
+    parser.add_argument('--compression-level', type=int, default=None)
+    parser.add_argument('--optical-density', default='off', choices=['off', 'add', 'replace'],
+                        help='also (add) or only (replace) store the OD of the atoms/probe/dark images')
+    parser.add_argument('--roi', default=None, metavar='X,Y,WIDTH,HEIGHT', help='crop the images to this')
+    parser.add_argument('--binning', type=int, default=1, help='bin the images by this')
+    parser.add_argument('--spool', action='store_true', help='acquire into spool files (see spool.py)')
+    parser.add_argument('--results', default=DEFAULT_RESULTS, help='file the results are appended to, by default in the working directory')
+    parser.add_argument('--quiet', action='store_true', help='hide the output of the server')
+    parser.add_argument('--startup', type=int, default=0, metavar='N',
+                        help='also time N starts of a server process')
+    args = parser.parse_args()
+
+    storage = {'layout': args.layout,
+               'compression': None if args.compression == 'none' else args.compression,
+               'compression_opts': args.compression_level}
+    if args.optical_density != 'off':
+        storage['optical_density'] = args.optical_density
+    settings = {'camera': args.camera, 'shots': args.shots, 'images': args.images, 'latency': args.latency,
+                'period': args.period, 'exposure_time': args.exposure_time, 'storage': storage}
+    if args.startup:
+        settings['startups'] = args.startup
+    roi = None
+    if args.roi:
+        roi = settings['roi'] = [int(v) for v in args.roi.split(',')]
+    if args.binning != 1:
+        settings['binning'] = args.binning
+    directory = tempfile.mkdtemp()
+    if args.spool:
+        settings['spool'] = True
+        # Not in the settings, the directory differs between runs
+        storage = dict(storage, spool_dir=os.path.join(directory, 'spool'))
+    try:
+        shots, image_bytes = run(args.camera, args.shots, args.images, args.latency, args.period,
+                                 args.exposure_time, storage, directory, args.quiet, roi, args.binning)
+    finally:
+        shutil.rmtree(directory)
+
+    summary = summarize(shots, args.images, image_bytes)
+    if args.startup:
+        summary['phases']['startup'] = percentiles(measure_startup(args.camera, args.startup))
+    previous = last_result(args.results, json.loads(json.dumps(settings)))
+    report(summary, previous)
+    result = {'time': datetime.datetime.now().isoformat(), 'commit': git_commit(), 'settings': settings}
+    result.update(summary)
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(result, sort_keys=True) + '\n')
@@ -1,62 +1,480 @@
+import os
 import sys
 import time
+import json
+import threading
+import traceback
+import multiprocessing
+import ConfigParser
+import Queue
+import zmq
 import zprocess
 from labscript_utils import check_version
 import labscript_utils.shared_drive
 import datetime
-from hcam import HamamatsuCamera
-from pgcam import PointGreyCamera
-from pcoedge import PCOCamera
-import matplotlib
-matplotlib.use('Qt4Agg')
-from matplotlib import pyplot as pt
+# The camera drivers are imported by their servers, so that a server only
+# loads the vendor library of its own camera
 # importing this wraps zlock calls around HDF file openings and closings:
 import labscript_utils.h5_lock
 import h5py
+from h5writer import H5Writer, check_roi
+from serverstats import ServerStats
+from preview import PreviewPublisher, parse_options
+import spool
 import numpy as np
-import ctypes
-import ctypes.util
-import visa
-import binascii
-
-class GenericServer(zprocess.ZMQServer):
-    def __init__(self, port):
-           zprocess.ZMQServer.__init__(self, port, type='string')
+
+class GenericServer(object):
+    """
+    Serves the requests of the BLACS CameraWorker (see Camera.py) for one camera.
+
+    A ROUTER socket is served by the request thread, which answers the
+    quick requests ('hello', 'stats', 'status') at once and hands the
+    others to the shot thread, in order. So a running transition does not
+    hold up the other clients, and an abort request cuts it short (see
+    wait_for()) instead of queueing behind it.
+
+    The shot file and 'done' requests are answered in two phases, as
+    before: 'ok' at once, then 'done' (or the error) in reply to the next
+    message of the same client, once the transition is over. state is
+    the state of the shot:
+
+      idle       no shot, the camera is free for the preview
+      buffering  transition_to_buffered running
+      buffered   armed, waiting for the 'done' of the sequence
+      static     transition_to_static running
+      aborting   abort requested, until the abort is done
+
+    Subclasses open their camera in __init__ and then call start(), so
+    that no request is served before the camera is ready.
+    """
+    # Seconds an image may take to arrive once the sequence is over, on top of its exposure
+    readout_margin = 1.0
+    # Seconds the waits of a transition check for an abort request
+    abort_interval = 0.05
+    # Seconds a finished reply waits for the go-ahead of its client, which
+    # never comes if the client replaced its socket after a timeout
+    pending_timeout = 60.0
+
+    def __init__(self, port, storage=None, preview=None):
            self._h5_filepath = None
            self.enable = True
+           self.state = 'idle'
+           # Timings and counters, served by the 'stats' request
+           self.stats = ServerStats()
+           self.last_shot_time = None
+           # storage: H5Writer keyword arguments (layout, compression, ..)
+           if storage is None:
+               storage = {}
+           self.writer = H5Writer(stats=self.stats, **storage)
+           # spool.SpoolFile the frames of the current shot are acquired into, if any
+           self.spool_file = None
+           # preview: port, max_rate and step of the live preview (see preview.py),
+           # no preview without a port
+           self.preview_settings = dict(preview or {})
+           self.preview = None
+           self.preview_thread = None
+           self.preview_stop = threading.Event()
+           self.abort_requested = threading.Event()
+           # Client identity: the reply to its next message, None while the
+           # transition it asked for is still running
+           self.pending = {}
+           self.waiting = set()
+           # Client identity: when its finished reply was stored in self.pending
+           self.pending_since = {}
+           self.port = port
+           self.jobs = Queue.Queue()
+           self.running = False
+
+    def start(self):
+        """Binds the server port and starts serving requests, once the camera is open."""
+        context = zmq.Context.instance()
+        self.sock = context.socket(zmq.ROUTER)
+        self.sock.setsockopt(zmq.LINGER, 0)
+        self.sock.bind('tcp://*:%d' % self.port)
+        # The replies of the shot thread, sent on by the request thread
+        self.replies_address = 'inproc://camera-server-replies-%d' % self.port
+        self.replies = context.socket(zmq.PULL)
+        self.replies.bind(self.replies_address)
+        self.running = True
+        self.shot_thread = threading.Thread(target=self.shot_loop)
+        self.shot_thread.daemon = True
+        self.shot_thread.start()
+        self.request_thread = threading.Thread(target=self.mainloop)
+        self.request_thread.daemon = True
+        self.request_thread.start()
+
+    def mainloop(self):
+        poller = zmq.Poller()
+        poller.register(self.sock, zmq.POLLIN)
+        poller.register(self.replies, zmq.POLLIN)
+        while self.running:
+            events = dict(poller.poll(100))
+            if self.replies in events:
+                client, two_phase, response = self.replies.recv_multipart()
+                if two_phase == '0' or client in self.waiting:
+                    self.waiting.discard(client)
+                    self.pending.pop(client, None)
+                    self.reply(client, response)
+                else:
+                    self.pending[client] = response
+                    self.pending_since[client] = time.time()
+            if self.sock in events:
+                message = self.sock.recv_multipart()
+                client, request_data = message[0], message[-1]
+                try:
+                    response = self.handler(client, request_data)
+                except Exception:
+                    self.stats.count('errors')
+                    response = traceback.format_exc()
+                    sys.stderr.write(response)
+                if response is not None:
+                    self.reply(client, response)
+            self.expire_pending()
+
+    def expire_pending(self):
+        """Drops the finished replies whose client did not come for them within self.pending_timeout."""
+        now = time.time()
+        for client, since in self.pending_since.items():
+            if now - since > self.pending_timeout:
+                del self.pending[client]
+                del self.pending_since[client]
+                self.stats.count('replies_expired')
+
+    def reply(self, client, response):
+        self.sock.send_multipart([client, '', response])
+
+    def handler(self, client, request_data):
+        """
+        Handles a request in the request thread. Returns the reply, or None
+        if the shot thread replies later.
+        """
+        if client in self.pending:
+            # Go-ahead for the second reply of a shot file or 'done' request
+            if self.pending[client] is None:
+                self.waiting.add(client)
+                return None
+            self.pending_since.pop(client, None)
+            return self.pending.pop(client)
+        print(request_data)
+        if request_data == 'hello':
+            return 'hello'
+        elif request_data == 'stats':
+            return json.dumps(self.stats.summary())
+        elif request_data == 'status':
+            return json.dumps({'state': self.state, 'shot': self._h5_filepath,
+                               'preview': self.preview_thread is not None, 'queued': self.jobs.qsize()})
+        elif request_data.endswith('.h5'):
+            if self.state in ('buffering', 'static', 'aborting'):
+                raise RuntimeError('%s: shot file during %s' % (self.name, self.state))
+            self.state = 'buffering'
+            self.pending[client] = None
+            self.jobs.put((client, request_data, True))
+            return 'ok'
+        elif request_data == 'done':
+            if self.state != 'buffered':
+                raise RuntimeError('%s: done while %s, no shot to finish' % (self.name, self.state))
+            self.state = 'static'
+            self.pending[client] = None
+            self.jobs.put((client, request_data, True))
+            return 'ok'
+        elif request_data == 'abort':
+            # Cuts a running transition short, then aborts in turn
+            self.abort_requested.set()
+            self.state = 'aborting'
+            self.jobs.put((client, request_data, False))
+            return None
+        elif request_data == 'preview' or request_data.startswith('preview '):
+            if self.state != 'idle':
+                raise RuntimeError('%s: no preview during a shot' % self.name)
+            self.jobs.put((client, request_data, False))
+            return None
+        elif request_data in ('flush', 'stop_preview'):
+            self.jobs.put((client, request_data, False))
+            return None
+        else:
+            raise ValueError('invalid request: %s'%request_data)
+
+    def shot_loop(self):
+        replies = zmq.Context.instance().socket(zmq.PUSH)
+        replies.setsockopt(zmq.LINGER, 0)
+        replies.connect(self.replies_address)
+        while True:
+            client, request_data, two_phase = self.jobs.get()
+            if client is None:
+                break
+            try:
+                response = self.run_request(request_data)
+            except Exception:
+                response = traceback.format_exc()
+                sys.stderr.write(response)
+                failed = True
+            else:
+                failed = False
+            replies.send_multipart([client, '1' if two_phase else '0', response])
+            if request_data == 'done' and not failed and not self.abort_requested.is_set():
+                self.prearm_next_shot()
+        replies.close()
 
-    def handler(self, request_data):
+    def run_request(self, request_data):
+        """Carries out a request in the shot thread, returns its (last) reply."""
         try:
-            print(request_data)
-            if request_data == 'hello':
-                return 'hello'
-            elif request_data.endswith('.h5'):
+            if request_data.endswith('.h5'):
+                # The shot takes over the camera
+                self.stop_preview()
                 self._h5_filepath = labscript_utils.shared_drive.path_to_local(request_data)
-                self.send('ok')
-                self.recv()
-                self.transition_to_buffered(self._h5_filepath)
+                with self.stats.timer('transition_to_buffered'):
+                    self.transition_to_buffered(self._h5_filepath)
+                self.check_abort()
+                self.state = 'buffered'
                 return 'done'
             elif request_data == 'done':
-                self.send('ok')
-                self.recv()
-                self.transition_to_static(self._h5_filepath)
+                with self.stats.timer('transition_to_static'):
+                    self.transition_to_static(self._h5_filepath)
                 self._h5_filepath = None
+                self.state = 'idle'
+                self.count_shot()
                 return 'done'
-            elif request_data == 'abort':
-                self.abort(self, self._h5_filepath)
-                self._h5_filepath = None
+            elif request_data == 'flush':
+                # Acknowledged once the images of the last shot are on disk
+                with self.stats.timer('flush'):
+                    self.writer.flush()
+                return 'done'
+            elif request_data.startswith('preview'):
+                self.start_preview(request_data.split()[1:])
                 return 'ok'
-            else:
-                raise ValueError('invalid request: %s'%request_data)
+            elif request_data == 'stop_preview':
+                self.stop_preview()
+                return 'ok'
+            elif request_data == 'abort':
+                try:
+                    with self.stats.timer('abort'):
+                        self.stop_preview()
+                        self.abort()
+                finally:
+                    self._h5_filepath = None
+                    self.abort_requested.clear()
+                    self.state = 'idle'
+                return 'done'
         except Exception:
-            if self._h5_filepath is not None and request_data != 'abort':
+            self.stats.count('errors')
+            # A requested abort follows in turn
+            if self._h5_filepath is not None and not self.abort_requested.is_set():
                 try:
                     self.abort()
                 except Exception as e:
                     sys.stderr.write('Exception in self.abort() while handling another exception:\n{}\n'.format(str(e)))
             self._h5_filepath = None
+            if not self.abort_requested.is_set():
+                self.state = 'idle'
             raise
 
+    def check_abort(self):
+        """Raises if an abort was requested, to cut a running transition short."""
+        if self.abort_requested.is_set():
+            raise RuntimeError('%s: aborted' % self.name)
+
+    def wait_for(self, wait, timeout):
+        """
+        Calls wait(seconds), which returns True once what it waits for is
+        done, until it does, timeout seconds are over or an abort is
+        requested. Each call waits at most abort_interval seconds, which
+        bounds the latency of an abort. Returns the last result of wait.
+        """
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            done = wait(max(min(self.abort_interval, remaining), 0))
+            if done or remaining <= self.abort_interval or self.abort_requested.is_set():
+                return done
+
+    def shutdown(self):
+        self.running = False
+        self.request_thread.join()
+        self.jobs.put((None, None, False))
+        self.shot_thread.join()
+        self.sock.close()
+        self.replies.close()
+        self.stop_preview()
+
+    def shutdown_on_interrupt(self):
+        try:
+            # Joined with a timeout, so that a KeyboardInterrupt gets through
+            while self.request_thread.is_alive():
+                self.request_thread.join(1)
+        except KeyboardInterrupt:
+            self.shutdown()
+
+    def read_exposures(self, h5_file):
+        """
+        Loads the EXPOSURES table of the camera from an open shot file.
+        The number of images to acquire, and how long to wait for them
+        after the sequence, follow from it.
+        Returns the table, None if the camera takes no image in this shot.
+
+        image_names and frametypes hold the name and frametype of the
+        exposure of each image, in the order the images arrive, and
+        image_rois its (x, y, width, height, binning) to crop and bin
+        the image to before storing it (None to store it as is). Tables
+        without a frame_index column (older labscript devices) are put in
+        order of exposure time, and their frametypes are plain strings
+        rather than an enum.
+        """
+        exposures = h5_file['devices'][self.name].get('EXPOSURES')
+        if exposures is None:
+            self.exposures = None
+            self.image_names = []
+            self.frametypes = []
+            self.image_rois = None
+            return None
+        self.exposures = exposures[:]
+        self.readout_timeout = self.readout_margin + max(self.exposures['exposure_time'])
+        if 'frame_index' in self.exposures.dtype.names:
+            order = np.argsort(self.exposures['frame_index'], kind='mergesort')
+        else:
+            order = np.argsort(self.exposures['time'], kind='mergesort')
+        self.image_names = [str(name) for name in self.exposures['name'][order]]
+        frametypes = self.exposures['frametype'][order]
+        frametype_values = h5py.check_dtype(enum=exposures.dtype['frametype'])
+        if frametype_values is not None:
+            frametype_names = dict((value, name) for name, value in frametype_values.items())
+            self.frametypes = [frametype_names[value] for value in frametypes]
+        else:
+            self.frametypes = [str(frametype) for frametype in frametypes]
+        if 'binning' in self.exposures.dtype.names:
+            rois = zip(*[self.exposures[column][order] for column in
+                         ('roi_x', 'roi_y', 'roi_width', 'roi_height', 'binning')])
+            self.image_rois = [tuple(int(v) for v in roi) for roi in rois]
+            if all(roi == (0, 0, 0, 0, 1) for roi in self.image_rois):
+                self.image_rois = None
+        else:
+            self.image_rois = None
+        return self.exposures
+
+    def check_rois(self, shape):
+        """
+        Raises a ValueError before the shot runs if the roi of an exposure does
+        not fit the (rows, cols) images of the camera (see h5writer.check_roi()).
+        """
+        for image_name, roi in zip(self.image_names, self.image_rois or []):
+            try:
+                check_roi(shape, roi)
+            except ValueError as e:
+                raise ValueError('%s, exposure %s: %s' % (self.name, image_name, str(e)))
+
+    def frame_buffer(self, h5_filepath, n_frames, shape, dtype=np.uint16):
+        """
+        Returns an (n_frames, rows, cols) array to acquire the images of the
+        shot into, memory-mapped on a spool file if storage has a spool_dir
+        (see spool.py). Its spool file is kept in self.spool_file for the
+        put() of the images.
+        """
+        frames, self.spool_file = self.writer.frame_buffer(h5_filepath, self.name, n_frames, shape, dtype,
+                                                           self.image_names, self.frametypes, self.image_rois)
+        return frames
+
+    def discard_spool(self):
+        """Gives up the spool file of an aborted shot, its frames are not written."""
+        if self.spool_file is not None and self.spool_file.state() == spool.ACQUIRING:
+            self.spool_file.set_state(spool.EMPTY)
+        self.spool_file = None
+
+    def count_shot(self):
+        """Counts a completed shot and records the time since the previous one."""
+        now = time.time()
+        self.stats.count('shots')
+        if self.last_shot_time is not None:
+            self.stats.record('shot_interval', now - self.last_shot_time)
+        self.last_shot_time = now
+
+    def check_image_count(self, n_images):
+        """
+        Raises if the camera did not deliver exactly one image per exposure,
+        as then the images can not be matched to the exposures. Called before
+        the images are queued: such a shot fails in BLACS and is aborted, and
+        none of its images are written (its spool file is given up as well).
+        """
+        n_expected = len(self.exposures)
+        self.stats.count('frames_acquired', n_images)
+        self.stats.count('frames_missing', max(n_expected - n_images, 0))
+        self.stats.count('frames_surplus', max(n_images - n_expected, 0))
+        if n_images < n_expected:
+            raise RuntimeError('%s: only %d of %d images arrived, missing trigger?'
+                               % (self.name, n_images, n_expected))
+        if n_images > n_expected:
+            raise RuntimeError('%s: %d images arrived but only %d were expected, surplus trigger?'
+                               % (self.name, n_images, n_expected))
+
+    def start_preview(self, args):
+        """
+        Runs the camera continuously and publishes its frames, see preview.py.
+        args are the options of the 'preview' request, e.g. ['rate=20', 'step=4'].
+        For manual mode only, a shot file request stops the preview.
+        """
+        if 'port' not in self.preview_settings:
+            raise RuntimeError('%s: no preview_port configured' % self.name)
+        options = dict(self.preview_settings, **parse_options(args))
+        self.stop_preview()
+        if self.preview is None:
+            self.preview = PreviewPublisher(options['port'], self.name)
+        self.preview.configure(options.get('max_rate', 10.), options.get('step', 1), options.get('roi'))
+        self.start_free_run()
+        self.preview_stop.clear()
+        self.preview_thread = threading.Thread(target=self.preview_loop)
+        self.preview_thread.daemon = True
+        self.preview_thread.start()
+
+    def stop_preview(self):
+        """Stops the preview, if running, and the free-running camera."""
+        if self.preview_thread is None:
+            return
+        self.preview_stop.set()
+        self.preview_thread.join()
+        self.preview_thread = None
+        self.stop_free_run()
+
+    def preview_loop(self):
+        try:
+            while not self.preview_stop.is_set():
+                image = self.read_preview(timeout=0.1)
+                if image is not None and self.preview.publish(image):
+                    self.stats.count('preview_frames')
+        except Exception:
+            self.stats.count('preview_errors')
+            sys.stderr.write('%s: preview stopped:\n%s' % (self.name, traceback.format_exc()))
+
+    def prearm_next_shot(self):
+        """
+        Readies the camera for another shot with the settings of the last one
+        (see prearm()), right after the reply to its 'done'. This overlaps
+        the camera setup with the writing of the images and with BLACS
+        getting the next shot ready. If the next shot has other settings,
+        its transition_to_buffered sets the camera up in full as before.
+        """
+        if not self.enable or self.exposures is None:
+            return
+        try:
+            with self.stats.timer('prearm'):
+                self.prearm()
+        except Exception:
+            self.stats.count('prearm_errors')
+            sys.stderr.write('%s: could not prearm:\n%s' % (self.name, traceback.format_exc()))
+
+    def prearm(self):
+        pass
+
+    def start_free_run(self):
+        raise RuntimeError('%s: no live preview' % self.name)
+
+    def read_preview(self, timeout):
+        """
+        Returns the latest frame of the free-running camera, None if none arrived
+        within timeout seconds. It only has to stay valid until the next call.
+        """
+        return None
+
+    def stop_free_run(self):
+        pass
+
     def transition_to_buffered(self, h5_filepath):
         print('transition to buffered')
 
@@ -75,10 +493,14 @@ class HamamatsuCameraServer(GenericServer):
     one written in the connection table (and therefore in BLACS).
     """
     
-    def __init__(self, port, cam_name):
-        GenericServer.__init__(self, port)
-        self.hcam = HamamatsuCamera(0)
+    def __init__(self, port, cam_name, storage=None, preview=None):
+        GenericServer.__init__(self, port, storage, preview)
+        from hcam import HamamatsuCameraMR
+        self.hcam = HamamatsuCameraMR(0)
         self.name = cam_name
+        self.preview_frames = []
+        self.readout_thread = None
+        self.start()
     
     def transition_to_buffered(self, h5_filepath):
         """
@@ -88,7 +510,7 @@ class HamamatsuCameraServer(GenericServer):
         then put in acquisition mode.
         """
 
-        with h5py.File(h5_filepath) as p:
+        with self.stats.timer('read_shot_file'), h5py.File(h5_filepath) as p:
             trig_source = int(p['globals']['hcam_parameters'].attrs['hcam_trigger_source'])
             trig_polarity = int(p['globals']['hcam_parameters'].attrs['hcam_trigger_polarity'])
             roix = int(p['globals']['hcam_parameters'].attrs['hcam_ROIx'])     
@@ -96,30 +518,41 @@ class HamamatsuCameraServer(GenericServer):
             cx = int(p['globals']['hcam_parameters'].attrs['hcam_cx'])     
             cy = int(p['globals']['hcam_parameters'].attrs['hcam_cy'])
             exp_time = float(p['globals']['hcam_parameters'].attrs['hcam_exposure_time'])
-            self.exposures = p['devices'][self.name].get('EXPOSURES')
+            self.read_exposures(p)
         
         if self.exposures is not None:
             self.enable = True
-            self.hcam.setPropertyValue("trigger_source", trig_source)
-            self.hcam.setPropertyValue("trigger_polarity", trig_polarity)
-            self.hcam.setPropertyValue("trigger_global_exposure", 5) # Global reset edge trigger
-            self.hcam.setPropertyValue("exposure_time", exp_time)
+            params = [("trigger_source", trig_source),
+                      ("trigger_polarity", trig_polarity),
+                      ("trigger_global_exposure", 5), # Global reset edge trigger
+                      ("exposure_time", exp_time)]
+                      
+            #params += [("subarray_hsize", roix),
+            #           ("subarray_vsize", roiy),
+            #           ("subarray_hpos", cx),
+            #           ("subarray_vpos", cy)]
             
-            #self.hcam.setPropertyValue("subarray_hsize", roix)
-            #self.hcam.setPropertyValue("subarray_vsize", roiy)
-            #self.hcam.setPropertyValue("subarray_hpos", cx)
-            #self.hcam.setPropertyValue("subarray_vpos", cy)
-            #self.hcam.setSubArrayMode()
+            # Only the properties that changed since the last shot are sent,
+            # the camera reports the values it was actually set to. Unless
+            # any changed, the camera is still prepared from prearm().
+            with self.stats.timer('settings'):
+                values = self.hcam.setProperties(params)
             
-            params = ["trigger_polarity",
-                      "trigger_source",
-                      "trigger_global_exposure",
-                      "exposure_time"]
+            for param, _ in params:
+                print(param, values[param])
+            self.check_rois((int(self.hcam.getPropertyValue("image_height")[0]),
+                             int(self.hcam.getPropertyValue("image_width")[0])))
             
-            for param in params:
-                print(param, self.hcam.getPropertyValue(param)[0])
-            
-            self.hcam.startAcquisition()
+            # The frame buffers of the last shot may still be with the
+            # writer, the camera then uses its spare set
+            with self.stats.timer('start_acquisition'):
+                self.hcam.startAcquisition(len(self.exposures))
+                spool_images = None
+                if self.writer.spool_dir is not None:
+                    # One spare slot, as for the camera buffers
+                    spool_images = self.frame_buffer(h5_filepath, len(self.exposures) + 1,
+                                                     (self.hcam.frame_y, self.hcam.frame_x))
+                self.start_readout(len(self.exposures), spool_images)
         else:
             self.enable = False
             
@@ -129,37 +562,145 @@ class HamamatsuCameraServer(GenericServer):
     def transition_to_static(self, h5_filepath):
         """
         Method called when the sequence is over.
-        Images are retrieved from the camera buffer and stored in a new dataset
-        in the sequence h5 file named after the camera (self.name).
+        Images are retrieved from the camera buffer and queued to be stored in
+        a new dataset in the sequence h5 file named after the camera (self.name)
+        by the writer thread.
         """
         start_time = time.time()
         print "hcam start static"
         if self.enable:
             print "hcam try to get frames"
-            [frames, dims] = self.hcam.getFrames()
+            with self.stats.timer('readout'):
+                # Most frames were collected during the sequence already
+                self.stop_readout(self.readout_timeout)
+                if self.readout_error is None:
+                    # Any surplus frame has arrived by now, the spare buffer holds it
+                    [new_frames, dims] = self.hcam.getFrames(timeout = 0)
+                    for frame in new_frames:
+                        self.keep_frame(frame)
+            frames = self.frames
+            if self.readout_error is not None or self.abort_requested.is_set():
+                self.hcam.stopAcquisition()
+                self.hcam.releaseFrames(frames)
+                self.check_abort()
+                raise self.readout_error
             end_time = time.time()
             print("Get frame time was %g seconds" % (end_time - start_time))
+            # Frames the camera got ahead of us by, reset by stopAcquisition()
+            self.stats.record('backlog', self.hcam.max_backlog)
             self.hcam.stopAcquisition()
-            with h5py.File(h5_filepath) as f:
-                f['data'].create_group(self.name)
-                exposures = f['devices'][self.name].get('EXPOSURES')
-                end_time = time.time()
-                print("prepare h5 time was %g seconds" % (end_time - start_time))
-                img = [np.reshape(frame.getData(), (dims[1], dims[0])) for frame in frames]
-                end_time = time.time()
-                print("reshape data time was %g seconds" % (end_time - start_time))
-                for k, image in enumerate(img):
-                    image_name = str(exposures[k][0])
-                    #np.save(image_name, image)
-                    f['data'][self.name].create_dataset(image_name, data=image)      
+            try:
+                self.check_image_count(self.n_frames)
+            except Exception:
+                self.hcam.releaseFrames(frames)
+                raise
+            if self.spool_images is not None:
+                # The frames were copied to the spool file and released as they arrived
+                img = self.spool_images[:min(self.n_frames, len(self.spool_images))]
+                self.writer.put(h5_filepath, self.name, img, self.image_names, frametypes=self.frametypes,
+                                rois=self.image_rois, spool_file=self.spool_file)
+            else:
+                # Frames are already 2-D views on the camera buffers,
+                # they are handed back to the camera once written
+                img = [frame.getImage() for frame in frames]
+                self.writer.put(h5_filepath, self.name, img, self.image_names,
+                                callback=lambda: self.hcam.releaseFrames(frames), frametypes=self.frametypes,
+                                rois=self.image_rois)
+            self.spool_file = None
         
         # Feedback
         end_time = time.time()
         print("Elapsed time was %g seconds" % (end_time - start_time))
         print (self.name+' transition to static at %s' %(str(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S.%f"'))))
 
+    def start_readout(self, n_frames, spool_images=None):
+        """Collects the frames in the background as they arrive during the sequence,
+        into spool_images if given (see keep_frame())."""
+        self.frames = []
+        self.n_frames = 0
+        self.spool_images = spool_images
+        self.readout_error = None
+        self.readout_stop = threading.Event()
+        self.readout_thread = threading.Thread(target=self.readout_loop, args=(n_frames,))
+        self.readout_thread.daemon = True
+        self.readout_thread.start()
+
+    def readout_loop(self, n_frames):
+        try:
+            while self.n_frames < n_frames and not self.readout_stop.is_set():
+                # Short waits, to notice when the shot is over
+                for frame, frame_number, timestamp in self.hcam.iterFrames(n_frames - self.n_frames, timeout = 0.05):
+                    if frame_number != self.n_frames + 1:
+                        print('%s: frame %d arrived as image %d, frames were lost'
+                              % (self.name, frame_number, self.n_frames + 1))
+                    self.keep_frame(frame)
+        except Exception as e:
+            self.readout_error = e
+
+    def keep_frame(self, frame):
+        """
+        Keeps a frame of the shot. Without a spool the (locked) frame itself
+        is kept until it is written, otherwise it is copied to the spool file
+        and handed straight back to the camera. Frames beyond the spool
+        slots are only counted.
+        """
+        if self.spool_images is None:
+            self.frames.append(frame)
+        else:
+            if self.n_frames < len(self.spool_images):
+                self.spool_images[self.n_frames] = frame.getImage()
+                self.spool_file.commit(self.n_frames + 1)
+            self.hcam.releaseFrames([frame])
+        self.n_frames += 1
+
+    def stop_readout(self, timeout):
+        """Waits up to timeout seconds (or an abort) for the frames to be collected, then stops.
+        Returns the (locked) frames collected so far, none if they were spooled."""
+        def collected(seconds):
+            self.readout_thread.join(seconds)
+            return not self.readout_thread.is_alive()
+        self.wait_for(collected, timeout)
+        self.readout_stop.set()
+        self.readout_thread.join()
+        self.readout_thread = None
+        return self.frames
+
+    def prearm(self):
+        # Buffers attached for as many frames as the last shot, the next
+        # startAcquisition() with the same properties only starts the capture
+        self.hcam.prepareAcquisition(len(self.exposures))
+
+    def start_free_run(self):
+        # Internal trigger at the exposure time of the last shot, the
+        # next shot sets its trigger source again. The frame buffers
+        # of the last shot have to be written and released first. A failed
+        # write is reported by the next flush, not by the preview.
+        self.writer.wait()
+        self.hcam.setProperties([("trigger_source", 1)])
+        self.hcam.startAcquisition()
+        self.preview_frames = []
+
+    def read_preview(self, timeout):
+        # The frame handed out last goes back to the camera now
+        self.hcam.releaseFrames(self.preview_frames)
+        [self.preview_frames, dims] = self.hcam.getFrames(timeout = timeout)
+        if not self.preview_frames:
+            return None
+        self.hcam.releaseFrames(self.preview_frames[:-1])
+        self.preview_frames = self.preview_frames[-1:]
+        return self.preview_frames[0].getImage()
+
+    def stop_free_run(self):
+        self.hcam.stopAcquisition()
+        self.hcam.releaseFrames(self.preview_frames)
+        self.preview_frames = []
+
     def abort(self):
-        pass
+        if self.readout_thread is not None:
+            frames = self.stop_readout(0)
+            self.hcam.stopAcquisition()
+            self.hcam.releaseFrames(frames)
+        self.discard_spool()
      
 class PointGreyCameraServer(GenericServer):
     """
@@ -169,10 +710,17 @@ class PointGreyCameraServer(GenericServer):
     one written in the connection table (and therefore in BLACS).
     """
     
-    def __init__(self, port, cam_name):
-        GenericServer.__init__(self, port)
+    def __init__(self, port, cam_name, storage=None, preview=None):
+        GenericServer.__init__(self, port, storage, preview)
+        from pgcam import PointGreyCamera
         self.pgcam = PointGreyCamera(0)
         self.name = cam_name
+        self.applied_settings = {}
+        # (rows, cols), the Format7 settings are only made here
+        self.image_shape = self.pgcam.getImageShape()
+        # Whether the capture of a shot is running, for abort()
+        self.capturing = False
+        self.start()
     
     def transition_to_buffered(self, h5_filepath):
         """
@@ -182,17 +730,33 @@ class PointGreyCameraServer(GenericServer):
         then put in acquisition mode.
         """
         
-        with h5py.File(h5_filepath) as p:
+        with self.stats.timer('read_shot_file'), h5py.File(h5_filepath) as p:
             self.exp_time = float(p['globals']['PointGrey_parameters'].attrs['pg_exposure_time'])
-            self.exposures = p['devices'][self.name].get('EXPOSURES')
+            self.read_exposures(p)
         
         if self.exposures is not None:
-            self.enable = True            
-            self.pgcam.setTriggerMode(trig = True, p = 0, s = 0, m = 0)
-            self.pgcam.setExposureTime(t = self.exp_time*1000.)
-            self.pgcam.setGrabMode(mode = 1)
+            self.enable = True
+            with self.stats.timer('settings'):
+                # Settings left unchanged since the last shot are not sent again
+                if self.applied_settings.get('exp_time') != self.exp_time:
+                    self.applied_settings.pop('exp_time', None)
+                    self.pgcam.setTriggerMode(trig = True, p = 0, s = 0, m = 0)
+                    self.pgcam.setExposureTime(t = self.exp_time*1000.)
+                    self.applied_settings['exp_time'] = self.exp_time
+                # One spare buffer to catch a surplus image, each image is
+                # waited for as long as any exposure is given to be read out
+                grab_mode = (len(self.exposures) + 1, int(np.ceil(1e3*self.readout_timeout)))
+                if self.applied_settings.get('grab_mode') != grab_mode:
+                    self.applied_settings.pop('grab_mode', None)
+                    self.pgcam.setGrabMode(mode = 1, num_buffers = grab_mode[0], timeout = grab_mode[1])
+                    self.applied_settings['grab_mode'] = grab_mode
             
-            self.pgcam.startAcquisition()
+            self.check_rois(self.image_shape)
+            with self.stats.timer('start_acquisition'):
+                # Stack for the images and the spare one
+                self.images = self.frame_buffer(h5_filepath, len(self.exposures) + 1, self.image_shape)
+                self.pgcam.startAcquisition()
+                self.capturing = True
         else:
             self.enable = False
             
@@ -202,24 +766,49 @@ class PointGreyCameraServer(GenericServer):
     def transition_to_static(self, h5_filepath):
         """
         Method called when the sequence is over.
-        Images are retrieved from the camera buffer and stored in a new dataset
-        in the sequence h5 file named after the camera (self.name).
+        Images are retrieved from the camera buffer and queued to be stored in
+        a new dataset in the sequence h5 file named after the camera (self.name)
+        by the writer thread.
         """
         start_time = time.time()
         if self.enable:
-            with h5py.File(h5_filepath) as f:
-                exposures = f['devices'][self.name].get('EXPOSURES')
-                images = self.pgcam.grabImages(len(exposures))
-                f['data'].create_group(self.name)
-                for k, image in enumerate(images):
-                    image_name = str(exposures[k][0])
-                    f['data'][self.name].create_dataset(image_name, data=image)      
-                self.pgcam.stopAcquisition()
+            with self.stats.timer('readout'):
+                images = self.pgcam.grabImages(len(self.exposures), out = self.images)
+                n_images = len(images)
+                # A surplus image would be waiting in the spare buffer by now
+                if n_images == len(self.exposures) and \
+                        self.pgcam.grabSpareImage(out = self.images[n_images]) is not None:
+                    n_images += 1
+            self.pgcam.stopAcquisition()
+            self.capturing = False
+            self.check_image_count(n_images)
+            self.writer.put(h5_filepath, self.name, images, self.image_names, frametypes=self.frametypes,
+                            rois=self.image_rois, spool_file=self.spool_file)
+            self.spool_file = None
         # Feedback
         print (self.name+' transition to static at %s' %(str(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S.%f"'))))
 
+    def start_free_run(self):
+        # Free-running, only the newest frame is kept. The next shot
+        # applies all its settings again.
+        self.applied_settings = {}
+        self.pgcam.setTriggerMode(trig = False)
+        self.pgcam.setGrabMode(mode = 0, timeout = 100)
+        self.pgcam.startAcquisition()
+
+    def read_preview(self, timeout):
+        # Waits up to the grab timeout set above
+        return self.pgcam.grabImage()
+
+    def stop_free_run(self):
+        self.pgcam.stopAcquisition()
+
     def abort(self):
-        pass
+        # The next shot or preview can not start the capture while it runs
+        if self.capturing:
+            self.capturing = False
+            self.pgcam.stopAcquisition()
+        self.discard_spool()
         
 class pcoedgeCameraServer(GenericServer):
     """
@@ -229,10 +818,18 @@ class pcoedgeCameraServer(GenericServer):
     one written in the connection table (and therefore in BLACS).
     """
     
-    def __init__(self, port, cam_name):
-        GenericServer.__init__(self, port)
+    # Hardware cropping of the sensor
+    roi = {'left': 800, 'right': 1400, 'top': 750, 'bottom': 1300}
+    
+    def __init__(self, port, cam_name, storage=None, preview=None):
+        GenericServer.__init__(self, port, storage, preview)
+        from pcoedge import PCOCamera
         self.pcoecam = PCOCamera(verbose=True)
         self.name = cam_name
+        # us, the preview uses the exposure time of the last shot
+        self.exposure_time = 1000
+        self.preview_image = None
+        self.start()
     
     def transition_to_buffered(self, h5_filepath):
         """
@@ -242,9 +839,9 @@ class pcoedgeCameraServer(GenericServer):
         then put in acquisition mode.
         """
 
-        with h5py.File(h5_filepath) as p:
+        with self.stats.timer('read_shot_file'), h5py.File(h5_filepath) as p:
             self.exposure_time = int(p['globals'].attrs['pcoe_exposure_time'])
-            self.exposures = p['devices'][self.name].get('EXPOSURES')
+            self.read_exposures(p)
         
         if self.exposures is not None:
             self.enable = True
@@ -252,9 +849,20 @@ class pcoedgeCameraServer(GenericServer):
             # because all the internal delays of the camera seem to depend on that parameter
             # and therefore adjusting the roi on the fly would require tweaking the sequence
             # timings; which nobody wants to do :-)
-            self.pcoecam.apply_settings(trigger = 'external_trigger', exposure_time = self.exposure_time,\
-            roi = {'left': 800, 'right': 1400, 'top': 750, 'bottom': 1300})
-            self.pcoecam.arm(num_buffers = 3)
+            # Unchanged settings are not sent again, and then the camera
+            # is still armed from the last shot
+            with self.stats.timer('settings'):
+                self.pcoecam.apply_settings(trigger = 'external_trigger', exposure_time = self.exposure_time,\
+                roi = self.roi)
+            # Images are copied out of the buffers as they arrive,
+            # so any number of exposures fits in at most 16 buffers
+            with self.stats.timer('start_acquisition'):
+                self.pcoecam.arm(num_buffers = min(len(self.exposures) + 1, 16))
+                self.check_rois((self.pcoecam.height, self.pcoecam.width))
+                # Stack for the images and a spare one
+                images = self.frame_buffer(h5_filepath, len(self.exposures) + 1,
+                                           (self.pcoecam.height, self.pcoecam.width))
+                self.pcoecam.start_stream(len(self.exposures), out = images)
             
         else:
             self.enable = False
@@ -265,46 +873,236 @@ class pcoedgeCameraServer(GenericServer):
     def transition_to_static(self, h5_filepath):
         """
         Method called when the sequence is over.
-        Images are retrieved from the camera buffer and stored in a new dataset
-        in the sequence h5 file named after the camera (self.name).
+        Images are retrieved from the camera buffer and queued to be stored in
+        a new dataset in the sequence h5 file named after the camera (self.name)
+        by the writer thread.
         """
         if self.enable:
-            images = self.pcoecam.get_images(3)
-            self.pcoecam.disarm()
-            with h5py.File(h5_filepath) as f:
-                f['data'].create_group(self.name)
-                exposures = f['devices'][self.name].get('EXPOSURES')
-                for k, image in enumerate(images):
-                    image_name = str(exposures[k][0])
-                    #np.save(image_name, image)
-                    f['data'][self.name].create_dataset(image_name, data=image)      
+            with self.stats.timer('readout'):
+                images, info = self.stop_stream(len(self.exposures), self.readout_timeout)
+            # Stay armed, the next shot most likely uses the same settings
+            self.pcoecam.stop_recording()
+            self.check_abort()
+            # The images beyond the spare slot are only counted
+            self.check_image_count(len(images) + info['surplus'])
+            self.writer.put(h5_filepath, self.name, images, self.image_names, frametypes=self.frametypes,
+                            rois=self.image_rois, spool_file=self.spool_file)
+            self.spool_file = None
         
         # Feedback
         print (self.name+' transition to static at %s' %(str(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S.%f"'))))
 
+    def prearm(self):
+        # Recording again with the settings and buffers of the last shot,
+        # transition_to_buffered then finds the camera ready
+        self.pcoecam.arm(num_buffers = min(len(self.exposures) + 1, 16))
+
+    def stop_stream(self, n_images, timeout):
+        """Waits up to timeout seconds (or an abort) for the images, then stops the stream.
+        Returns the images and their info, see PCOCamera.stop_stream()."""
+        self.wait_for(lambda seconds: self.pcoecam.wait_stream(n_images, seconds), timeout)
+        return self.pcoecam.stop_stream(n_images, timeout = 0)
+
+    def start_free_run(self):
+        # The next shot switches back to the external trigger
+        self.pcoecam.apply_settings(trigger = 'auto_trigger', exposure_time = self.exposure_time, roi = self.roi)
+        self.pcoecam.arm(num_buffers = 4)
+        self.preview_image = np.empty((self.pcoecam.height, self.pcoecam.width), dtype = np.uint16)
+
+    def read_preview(self, timeout):
+        return self.pcoecam.grab_image(self.preview_image, timeout = timeout)
+
+    def stop_free_run(self):
+        self.pcoecam.stop_recording()
+
     def abort(self):
-        pass
+        if self.enable:
+            self.pcoecam.disarm()
+        self.discard_spool()
+
+SERVER_TYPES = {'hamamatsu': HamamatsuCameraServer,
+                'pcoedge': pcoedgeCameraServer,
+                'pointgrey': PointGreyCameraServer}
 
-def start_main_cams():
-    port = 7
-    print('Starting Hamamatsu camera server on port %d' % port)
-    h_server = HamamatsuCameraServer(port, "HCAM_1")
+# Used when there is no configuration file
+DEFAULT_CAMERAS = [('HCAM_1', 'hamamatsu', 7, {}, {}),
+                   ('PCOEDGE', 'pcoedge', 77, {}, {}),
+                   ('PGCAM', 'pointgrey', 777, {}, {})]
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'camera_servers.ini')
+
+# A crashed camera server is restarted after RESTART_DELAY seconds, doubled
+# for each consecutive crash within EARLY_EXIT seconds of its start (e.g. a
+# missing camera), and given up after MAX_EARLY_EXITS of those
+RESTART_DELAY = 1.0
+EARLY_EXIT = 60.0
+MAX_EARLY_EXITS = 6
+
+def read_camera_config(config_path=DEFAULT_CONFIG):
+    """
+    Returns the list of (camera name, server type, port, storage, preview) to serve.
     
+    Every section of the configuration file is a camera named after the
+    section (as in the connection table), e.g.
+    
+    [PCOEDGE]
+    type = pcoedge
     port = 77
-    print('Starting pco.edge camera server on port %d' % port)
-    pcoe_server = pcoedgeCameraServer(port, "PCOEDGE")
     
-    port = 777
-    print('Starting PointGrey camera server on port %d' % port)
-    pg_server = PointGreyCameraServer(port, "PGCAM")
+    The optional layout, compression and compression_level options set how
+    the images are stored in the shot files (see h5writer.write_images),
+    optical_density and the od_ options whether their optical density is
+    stored as well (see absorption.py), and spool_dir a local directory
+    to acquire the images into memory-mapped files until they are written
+    (see spool.py).
+    The optional preview_port enables the live preview on that port,
+    preview_rate (frames/s) and preview_step (decimation) are its defaults.
+    """
     
-    pg_server.shutdown_on_interrupt()
-    h_server.shutdown_on_interrupt()
-    pcoe_server.shutdown_on_interrupt()  
+    if not os.path.exists(config_path):
+        print('No camera configuration at %s, using the default cameras' % config_path)
+        return list(DEFAULT_CAMERAS)
+    config = ConfigParser.ConfigParser()
+    config.read(config_path)
+    cameras = []
+    for cam_name in config.sections():
+        server_type = config.get(cam_name, 'type').lower()
+        if server_type not in SERVER_TYPES:
+            raise ValueError('unknown camera server type %s for %s' % (server_type, cam_name))
+        storage = {}
+        if config.has_option(cam_name, 'layout'):
+            storage['layout'] = config.get(cam_name, 'layout')
+        if config.has_option(cam_name, 'compression'):
+            compression = config.get(cam_name, 'compression').lower()
+            storage['compression'] = None if compression == 'none' else compression
+        if config.has_option(cam_name, 'compression_level'):
+            storage['compression_opts'] = config.getint(cam_name, 'compression_level')
+        if config.has_option(cam_name, 'optical_density'):
+            storage['optical_density'] = config.get(cam_name, 'optical_density').lower()
+            od_settings = storage['od_settings'] = {}
+            if config.has_option(cam_name, 'od_frametypes'):
+                od_settings['frametype_names'] = tuple(name.strip() for name in
+                                                       config.get(cam_name, 'od_frametypes').split(','))
+                if len(od_settings['frametype_names']) != 3:
+                    raise ValueError('od_frametypes of %s: atoms, probe and dark frametypes expected' % cam_name)
+            if config.has_option(cam_name, 'od_min_counts'):
+                od_settings['min_counts'] = config.getfloat(cam_name, 'od_min_counts')
+            if config.has_option(cam_name, 'od_max'):
+                od_settings['max_od'] = config.getfloat(cam_name, 'od_max')
+        if config.has_option(cam_name, 'spool_dir'):
+            storage['spool_dir'] = config.get(cam_name, 'spool_dir')
+        preview = {}
+        if config.has_option(cam_name, 'preview_port'):
+            preview['port'] = config.getint(cam_name, 'preview_port')
+        if config.has_option(cam_name, 'preview_rate'):
+            preview['max_rate'] = config.getfloat(cam_name, 'preview_rate')
+        if config.has_option(cam_name, 'preview_step'):
+            preview['step'] = config.getint(cam_name, 'preview_step')
+        cameras.append((cam_name, server_type, config.getint(cam_name, 'port'), storage, preview))
+    return cameras
+
+def run_camera_server(cam_name, server_type, port, storage=None, preview=None):
+    """
+    Runs a single camera server until interrupted.
+    Target of the supervisor's subprocesses.
+    """
+    
+    print('Starting %s camera server for %s on port %d' % (server_type, cam_name, port))
+    server = SERVER_TYPES[server_type](port, cam_name, storage, preview)
+    server.shutdown_on_interrupt()
+
+def start_main_cams(config_path=DEFAULT_CONFIG):
+    """
+    Supervises one subprocess per configured camera.
+    
+    Every camera server reads out its camera and writes its h5 data in its
+    own process, so a slow camera never delays the replies of the others
+    (h5py serialises all HDF5 calls within a process). A server process
+    that crashes is restarted, with a growing delay if it keeps crashing
+    right after its start.
+    """
+    
+    cameras = read_camera_config(config_path)
+    processes = {}
+    # Camera name: (camera, time to restart it at)
+    restarts = {}
+    # Camera name: number of consecutive crashes shortly after the start
+    early_exits = {}
+    
+    def start(camera):
+        process = multiprocessing.Process(target=run_camera_server, args=camera, name=camera[0])
+        process.start()
+        processes[camera[0]] = (camera, process, time.time())
+    
+    for camera in cameras:
+        start(camera)
+    
+    try:
+        while True:
+            time.sleep(1)
+            now = time.time()
+            for cam_name, (camera, process, start_time) in processes.items():
+                if process.is_alive():
+                    continue
+                del processes[cam_name]
+                if process.exitcode == 0:
+                    # Shut down on purpose
+                    continue
+                if now - start_time < EARLY_EXIT:
+                    early_exits[cam_name] = early_exits.get(cam_name, 0) + 1
+                else:
+                    early_exits[cam_name] = 1
+                if early_exits[cam_name] > MAX_EARLY_EXITS:
+                    sys.stderr.write('%s camera server exited with code %s, %d times right after its start, '
+                                     'giving up\n' % (cam_name, process.exitcode, early_exits[cam_name]))
+                    continue
+                delay = RESTART_DELAY * 2 ** (early_exits[cam_name] - 1)
+                sys.stderr.write('%s camera server exited with code %s, restarting in %g s\n'
+                                 % (cam_name, process.exitcode, delay))
+                restarts[cam_name] = (camera, now + delay)
+            for cam_name, (camera, restart_time) in restarts.items():
+                if now >= restart_time:
+                    del restarts[cam_name]
+                    start(camera)
+            if not processes and not restarts:
+                break
+    except KeyboardInterrupt:
+        for _, process, _ in processes.values():
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
    
+
+def print_stats(config_path=DEFAULT_CONFIG, host='localhost'):
+    """
+    Prints the timings and counters of every configured camera server,
+    as returned by their 'stats' request.
+    """
+    
+    for cam_name, server_type, port, storage, preview in read_camera_config(config_path):
+        try:
+            stats = json.loads(zprocess.zmq_get_raw(port, host, data='stats', timeout=5))
+        except Exception as e:
+            print('%s (port %d): no stats, %s' % (cam_name, port, str(e)))
+            continue
+        print('%s (port %d), up %.0f s' % (cam_name, port, stats['uptime']))
+        for name, value in sorted(stats['counters'].items()):
+            print('  %-24s %d' % (name, value))
+        print('  %-24s %8s %8s %8s %8s %8s' % ('', 'count', 'last', 'p50', 'p90', 'max'))
+        for name, sample in sorted(stats['samples'].items()):
+            print('  %-24s %8d %8.4g %8.4g %8.4g %8.4g' % (name, sample['count'], sample['last'],
+                                                        sample['p50'], sample['p90'], sample['max']))
         
 if __name__ == '__main__':
-    start_main_cams()
+    # python camera_server.py [config] to serve the cameras,
+    # python camera_server.py --stats [config] to show their stats
+    args = sys.argv[1:]
+    if args and args[0] == '--stats':
+        print_stats(*args[1:2])
+    elif args:
+        start_main_cams(args[0])
+    else:
+        start_main_cams()
 
 
 
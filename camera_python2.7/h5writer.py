@@ -0,0 +1,297 @@
+"""Storage of camera images in the shot files
+
+Writes the images of a shot into the data/<camera> group of its h5 file,
+either as one dataset per exposure (named after the exposure, the default)
+or as a single stacked (n_images, height, width) dataset chunked per frame
+with an 'image_names' index. Both layouts can use the lossless lzf or
+shuffle + gzip filters. Each image can first be cropped to a region of
+interest and binned, as set per exposure in the labscript device (see
+crop_and_bin). Optionally the optical density of absorption
+images is stored in data/<camera>/optical_density as well, or instead
+of the raw frames (see absorption.py). With a spool directory, the
+frames of each shot are acquired into a memory-mapped spool file
+(frame_buffer) and stay there until they are written (see spool.py).
+
+The camera servers write from a dedicated thread (H5Writer). They import
+labscript_utils.h5_lock so that the file openings are locked against the
+other BLACS devices.
+
+  Typical usage example:
+
+  writer = H5Writer(layout = 'stack', compression = 'lzf')
+  writer.put(h5_filepath, 'PCOEDGE', images, ['atoms', 'probe', 'dark'])
+  writer.flush()
+"""
+
+import sys
+import time
+import threading
+import Queue
+import h5py
+import numpy as np
+import absorption
+import spool
+
+LAYOUTS = ('images', 'stack')
+COMPRESSIONS = (None, 'lzf', 'gzip')
+
+
+def write_images(group, images, image_names, layout = 'images', compression = None, compression_opts = None):
+    """Writes images into an h5 group
+
+    Args:
+        group       (h5py.Group):  Group to write the images into.
+        images            (list):  2D arrays (or a 3D array) of images.
+        image_names       (list):  Exposure names, exactly one per image.
+        layout             (str):  'images' for one dataset per exposure,
+                                    'stack' for a single 'images' dataset
+                                    of shape (n_images, height, width) and
+                                    an 'image_names' index. Images of different
+                                    shapes are always stored one per dataset.
+        compression        (str):  None, 'lzf' or 'gzip' (with shuffle).
+        compression_opts   (int):  gzip level.
+
+    Returns:
+        int: Number of images written.
+    """
+
+    if layout not in LAYOUTS:
+        raise ValueError('unknown image layout: %s' % layout)
+    if compression not in COMPRESSIONS:
+        raise ValueError('unknown image compression: %s' % compression)
+    if len(images) != len(image_names):
+        raise ValueError('%d images for %d image names' % (len(images), len(image_names)))
+    n_images = len(images)
+    image_names = [str(image_name) for image_name in image_names]
+    filters = {}
+    if compression is not None:
+        filters = {'compression': compression, 'compression_opts': compression_opts, 'shuffle': True}
+
+    shapes = set(np.shape(images[k]) for k in range(n_images))
+    if layout == 'stack' and len(shapes) == 1:
+        shape = shapes.pop()
+        # One chunk per frame: each frame is written and read in one go
+        dataset = group.create_dataset('images', shape = (n_images,) + shape,
+                                       dtype = images[0].dtype, chunks = (1,) + shape, **filters)
+        if isinstance(images, np.ndarray):
+            dataset[...] = images
+        else:
+            for k in range(n_images):
+                dataset[k] = images[k]
+        group.create_dataset('image_names', data = np.array(image_names, dtype = 'S'))
+    else:
+        for k in range(n_images):
+            image = images[k]
+            chunks = np.shape(image) if filters else None
+            group.create_dataset(image_names[k], data = image, chunks = chunks, **filters)
+    return n_images
+
+
+def check_roi(shape, roi):
+    """Checks that crop_and_bin() can crop and bin an image to a region of interest
+
+    Args:
+        shape    (tuple): (rows, cols) of the image.
+        roi      (tuple): As for crop_and_bin(), None for no change.
+
+    Raises:
+        ValueError: The region is not inside the image, or binning it
+            would leave no pixel.
+    """
+
+    if roi is None:
+        return
+    x, y, width, height, binning = roi
+    rows, cols = shape
+    if width and height:
+        if x < 0 or y < 0 or x + width > cols or y + height > rows:
+            raise ValueError('roi (x=%d, y=%d, width=%d, height=%d) is not inside the %dx%d image'
+                             % (x, y, width, height, cols, rows))
+        rows, cols = height, width
+    if binning > min(rows, cols):
+        raise ValueError('binning %d is larger than the %dx%d region' % (binning, cols, rows))
+
+
+def crop_and_bin(image, roi):
+    """Crops and bins an image
+
+    Args:
+        image (np.array): 2D image.
+        roi      (tuple): (x, y, width, height, binning), a width or height
+                           of 0 for the whole image. None for no change.
+
+    Returns:
+        np.array: A view on the cropped image, unless it is binned. Binning
+            sums binning x binning blocks (dropping the incomplete ones at
+            the edges) into a uint32 image.
+
+    Raises:
+        ValueError: See check_roi().
+    """
+
+    if roi is None:
+        return image
+    check_roi(np.shape(image), roi)
+    x, y, width, height, binning = roi
+    if width and height:
+        image = image[y:y + height, x:x + width]
+    if binning > 1:
+        rows, cols = image.shape[0] // binning, image.shape[1] // binning
+        image = image[:rows * binning, :cols * binning].reshape((rows, binning, cols, binning))
+        image = image.sum(axis=(1, 3), dtype=np.uint32)
+    return image
+
+
+class H5Writer(object):
+    """
+    Writes camera images into the shot files from a dedicated thread.
+
+    Readout only has to put the images on the bounded queue (put() blocks
+    while it is full) and the server can reply as soon as the images are
+    in memory. flush() blocks until everything queued so far is on disk
+    and re-raises the first error of the writer thread, wait() only blocks
+    and leaves the error to the next flush().
+    """
+
+    def __init__(self, maxsize=4, layout='images', compression=None, compression_opts=None, stats=None,
+                 optical_density='off', od_settings=None, spool_dir=None):
+        if layout not in LAYOUTS:
+            raise ValueError('unknown image layout: %s' % layout)
+        if compression not in COMPRESSIONS:
+            raise ValueError('unknown image compression: %s' % compression)
+        if optical_density not in absorption.MODES:
+            raise ValueError('unknown optical density mode: %s' % optical_density)
+        self.layout = layout
+        self.compression = compression
+        self.compression_opts = compression_opts
+        # 'add' or 'replace' the raw frames with their optical density,
+        # od_settings: absorption.reduce_images() keyword arguments
+        self.optical_density = optical_density
+        self.od_settings = dict(od_settings or {})
+        # Optional serverstats.ServerStats to record the writes in
+        self.stats = stats
+        # Directory of the spool files, None to acquire into memory
+        self.spool_dir = spool_dir
+        self.spools = {}
+        self.queue = Queue.Queue(maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self.mainloop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def frame_buffer(self, h5_filepath, cam_name, n_frames, shape, dtype, image_names, frametypes=None, rois=None):
+        """
+        Returns an (n_frames, rows, cols) array to acquire the frames of a shot
+        into, and its spool.SpoolFile (None without a spool directory). Waits
+        for the queued writes if all the spool files of the camera are in use.
+        """
+        if self.spool_dir is None:
+            return np.empty((n_frames,) + tuple(shape), dtype=dtype), None
+        if cam_name not in self.spools:
+            self.spools[cam_name] = spool.Spool(self.spool_dir, cam_name, n_files=self.queue.maxsize + 2)
+        spool_file = self.spools[cam_name].acquire()
+        if spool_file is None:
+            # An error of an earlier shot is for its flush, not for this shot
+            self.wait()
+            spool_file = self.spools[cam_name].acquire()
+        if spool_file is None:
+            raise RuntimeError('all the spool files of %s hold unwritten frames, see python spool.py %s --recover'
+                               % (cam_name, self.spool_dir))
+        frames = spool_file.create(h5_filepath, cam_name, n_frames, shape, dtype, image_names, frametypes, rois)
+        return frames, spool_file
+
+    def put(self, h5_filepath, cam_name, images, image_names, callback=None, frametypes=None, rois=None,
+            spool_file=None):
+        """
+        Queues images to be written to the data/<cam_name> group of the shot file.
+        The optional callback is called once the images are written (or failed to).
+        The frametypes of the images are needed for their optical density,
+        rois are the crop_and_bin() regions of interest of the images, they are
+        checked here (see check_roi()) rather than failing in the writer thread.
+        spool_file is the spool.SpoolFile of frame_buffer() the images are in,
+        it is marked written once they are.
+        """
+        if rois is not None:
+            for k in range(min(len(images), len(rois))):
+                check_roi(np.shape(images[k]), rois[k])
+        if spool_file is not None:
+            spool_file.commit(len(images), spool.READY)
+        self.queue.put((h5_filepath, cam_name, images, image_names, callback, frametypes, rois, spool_file))
+        if self.stats is not None:
+            self.stats.record('writer_backlog', self.queue.qsize())
+
+    def mainloop(self):
+        while True:
+            h5_filepath, cam_name, images, image_names, callback, frametypes, rois, spool_file = self.queue.get()
+            start_time = time.time()
+            try:
+                n_images, n_bytes = self.write(h5_filepath, cam_name, images, image_names, frametypes, rois)
+            except Exception as e:
+                sys.stderr.write('Exception writing %s images to %s:\n%s\n' % (cam_name, h5_filepath, str(e)))
+                if self.error is None:
+                    self.error = e
+                if self.stats is not None:
+                    self.stats.count('write_errors')
+            else:
+                # A failed write leaves the frames in the spool file for recovery
+                if spool_file is not None:
+                    spool_file.set_state(spool.WRITTEN)
+                if self.stats is not None:
+                    self.stats.record('write', time.time() - start_time)
+                    self.stats.count('images_written', n_images)
+                    self.stats.count('bytes_written', n_bytes)
+            finally:
+                if callback is not None:
+                    callback()
+                self.queue.task_done()
+
+    def write(self, h5_filepath, cam_name, images, image_names, frametypes=None, rois=None):
+        """Writes the images, returns the number and size in bytes of the raw images written."""
+        if rois is not None:
+            images = [crop_and_bin(images[k], rois[k]) for k in range(min(len(images), len(rois)))]
+        od_images = self.reduce(cam_name, images, image_names, frametypes)
+        if od_images is not None and self.optical_density == 'replace':
+            # Only the frames that went into an OD are replaced by it
+            used = set(od_images[2])
+            kept = [k for k in range(min(len(images), len(image_names))) if k not in used]
+            images = [images[k] for k in kept]
+            image_names = [image_names[k] for k in kept]
+        with h5py.File(h5_filepath) as f:
+            group = f['data'].create_group(cam_name)
+            n_images = write_images(group, images, image_names, self.layout,
+                                    self.compression, self.compression_opts)
+            if od_images is not None:
+                od_images, od_names, used = od_images
+                write_images(group.create_group('optical_density'), od_images, od_names, self.layout,
+                             self.compression, self.compression_opts)
+            return n_images, sum(images[k].nbytes for k in range(n_images))
+
+    def reduce(self, cam_name, images, image_names, frametypes):
+        """
+        Returns the (OD images, names, indices of the frames used) of a shot, None if there are none.
+        The raw frames are stored anyway if their OD can not be computed.
+        """
+        if self.optical_density == 'off' or frametypes is None:
+            return None
+        start_time = time.time()
+        try:
+            od_images, od_names, used = absorption.reduce_images(images, image_names, frametypes, **self.od_settings)
+        except Exception as e:
+            sys.stderr.write('No optical density for %s, keeping the raw images:\n%s\n' % (cam_name, str(e)))
+            if self.stats is not None:
+                self.stats.count('od_errors')
+            return None
+        if not od_images:
+            return None
+        if self.stats is not None:
+            self.stats.record('optical_density', time.time() - start_time)
+        return od_images, od_names, used
+
+    def wait(self):
+        self.queue.join()
+
+    def flush(self):
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
@@ -1,5 +1,8 @@
+import os
+import time
 import ctypes
 import ctypes.util
+import threading
 import numpy
 
 # Hamamatsu constants.
@@ -8,6 +11,7 @@ DCAMCAP_EVENT_FRAMEREADY = int("0x0002", 0)
 # DCAM3 API.
 DCAMERR_ERROR = 0
 DCAMERR_NOERROR = 1
+DCAMERR_TIMEOUT = int("0x80000106", 0)
 
 DCAMPROP_ATTR_HASVALUETEXT = int("0x10000000", 0)
 DCAMPROP_ATTR_READABLE = int("0x00010000", 0)
@@ -32,6 +36,17 @@ DCAM_DEFAULT_ARG = 0
 DCAM_IDPROP_EXPOSURETIME = int("0x001F0110", 0)
 DCAM_IDSTR_MODEL = int("0x04000104", 0)
 
+# Alignment of the user memory attached to the camera (one page).
+PAGE_SIZE = 4096
+
+# Setting a property starting with one of these names can change the
+# attributes (range, options, ..) of the other properties.
+DCAM_ATTR_CHANGING_PROPERTIES = ("binning",
+                                 "subarray",
+                                 "trigger",
+                                 "sensor_mode",
+                                 "readout_speed")
+
 class DCAM_PARAM_PROPERTYATTR(ctypes.Structure):
     """
     The dcam property attribute structure
@@ -82,6 +97,20 @@ def convertPropertyName(p_name):
     c = b.replace(" ","_")
     return c
 
+def alignedEmpty(size, alignment = PAGE_SIZE):
+    """
+    Allocates an uninitialized numpy byte array whose data starts on an
+    alignment boundary.
+
+    @param size The size of the array in bytes.
+    @param alignment The required alignment in bytes.
+    @return A numpy.uint8 array of length size.
+    """
+
+    raw = numpy.empty(size + alignment, dtype=numpy.uint8)
+    offset = (-raw.ctypes.data) % alignment
+    return raw[offset:offset + size]
+
 class DCAMException(Exception):
     """
     Camera exceptions
@@ -92,28 +121,50 @@ class DCAMException(Exception):
 
 
 
-dcam = ctypes.windll.dcamapi
+# The library is loaded by the first camera, so that importing this
+# module is cheap and works without it.
+dcam = None
 
-temp = ctypes.c_int32(1)
-"""
-if (dcam.dcam_init(None, ctypes.byref(temp), None) != DCAMERR_NOERROR):
-    raise DCAMException("DCAM initialization failed.")
-"""
-n_cameras = temp.value
+def loadDcam():
+    """Loads the DCAM library on the first call.
+    Set the CAMERA_BACKEND environment variable to 'simulated' to run
+    without a camera (see simcams.py).
+    @return The library."""
+    global dcam
+    if dcam is None:
+        if os.environ.get('CAMERA_BACKEND') == 'simulated':
+            import simcams
+            dcam = simcams.SimulatedDcam()
+        else:
+            dcam = ctypes.windll.dcamapi
+    return dcam
 
 class HCamData():
     """Hamamatsu camera data object.
     Initially I tried to use create_string_buffer() to allocate storage for the
     data from the camera but this turned out to be too slow. The software
     kept falling behind the camera and create_string_buffer() seemed to be the
-    bottleneck."""
+    bottleneck.
 
-    def __init__(self, size):
+    The object also carries a reference count so that memory shared with the
+    camera (see HamamatsuCameraMR) is not recycled while downstream code
+    still holds it."""
+
+    def __init__(self, size, shape = None, alignment = 0):
         """Create a data object of the appropriate size.
-        @param size The size of the data object in bytes."""
+        @param size The size of the data object in bytes.
+        @param shape The (rows, columns) of the frame, used by getImage().
+        @param alignment If not zero, align the storage on this many bytes."""
 
-        self.np_array = numpy.empty((int(size/2), 1), dtype=numpy.uint16)
+        if alignment:
+            self.np_array = alignedEmpty(size, alignment).view(numpy.uint16).reshape((int(size/2), 1))
+        else:
+            self.np_array = numpy.empty((int(size/2), 1), dtype=numpy.uint16)
         self.size = size
+        self.shape = shape
+        self.image = None
+        self.ref_count = 0
+        self.ref_lock = threading.Lock()
 
     ## __getitem__
     #
@@ -147,6 +198,48 @@ class HCamData():
     def getDataPtr(self):
         return self.np_array.ctypes.data
 
+    ## getImage
+    #
+    # The view honours the row padding of the camera buffer (if any),
+    # so no data is copied.
+    #
+    # @return A 2-D (rows, columns) view of the camera data.
+    #
+    def getImage(self):
+        if self.shape is None:
+            return self.np_array
+        if self.image is None:
+            rows, cols = self.shape
+            self.image = numpy.ndarray((rows, cols),
+                                       dtype = numpy.uint16,
+                                       buffer = self.np_array,
+                                       strides = (int(self.size/rows), 2))
+        return self.image
+
+    ## lock
+    #
+    # Marks the data as in use downstream.
+    #
+    def lock(self):
+        with self.ref_lock:
+            self.ref_count += 1
+
+    ## unlock
+    #
+    # Releases one reference taken with lock().
+    #
+    def unlock(self):
+        with self.ref_lock:
+            if self.ref_count > 0:
+                self.ref_count -= 1
+
+    ## isLocked
+    #
+    # @return True if some downstream code still holds the data.
+    #
+    def isLocked(self):
+        return self.ref_count > 0
+
 
 class HamamatsuCamera():
     CAPTUREMODE_SNAP = 0
@@ -162,7 +255,7 @@ class HamamatsuCamera():
 
         self.buffer_index = 0
         self.camera_id = camera_id
-        self.dcam = ctypes.windll.dcamapi
+        self.dcam = loadDcam()
 
         self.debug = False
         self.frame_bytes = 0
@@ -170,6 +263,10 @@ class HamamatsuCamera():
         self.frame_y = 0
         self.last_frame_number = 0
         self.properties = {}
+        self.prop_attrs = {}
+        self.prop_texts = {}
+        self.prop_set_values = {}
+        self.prop_requested = {}
         self.max_backlog = 0
         self.number_image_buffers = 0
 
@@ -193,27 +290,20 @@ class HamamatsuCamera():
         self.max_height = self.getPropertyValue("image_height")[0]
         self.setmode(self.CAPTUREMODE_SEQUENCE) # By default is a sequence
 
-    def settrigger(self,mode):
-        TRIGMODE = ctypes.c_int32(mode)
-        self.checkStatus(self.dcam.dcam_settriggermode(self.camera_handle,TRIGMODE),'settriggermode')
-        DCAM_TRIGGERMODE = ctypes.c_int32(0)
-        self.checkStatus(self.dcam.dcam_gettriggermode(self.camera_handle,ctypes.byref(DCAM_TRIGGERMODE)),'gettrigermode')
-        return DCAM_TRIGGERMODE.value
-
     def setmode(self, mode):
         """Sets the acquisition mode of the camera."""
         self.mode = mode
 
     def settrigger(self,mode):
+        """Sets the trigger mode, which changes the trigger properties behind
+        the back of setProperties(): they are set again the next time."""
         TRIGMODE = ctypes.c_int32(mode)
         self.checkStatus(self.dcam.dcam_settriggermode(self.camera_handle,TRIGMODE),'settriggermode')
-        DCAM_TRIGGERMODE = ctypes.c_int32(0)
-        self.checkStatus(self.dcam.dcam_gettriggermode(self.camera_handle,ctypes.byref(DCAM_TRIGGERMODE)),'gettrigermode')
-        return DCAM_TRIGGERMODE.value
-
-    def settrigger(self,mode):
-        TRIGMODE = ctypes.c_int32(mode)
-        self.checkStatus(self.dcam.dcam_settriggermode(self.camera_handle,TRIGMODE),'settriggermode')
+        for property_name in list(self.prop_requested):
+            if property_name.startswith("trigger"):
+                del self.prop_requested[property_name]
+                self.prop_set_values.pop(property_name, None)
+        self.invalidatePropertyCache()
         DCAM_TRIGGERMODE = ctypes.c_int32(0)
         self.checkStatus(self.dcam.dcam_gettriggermode(self.camera_handle,ctypes.byref(DCAM_TRIGGERMODE)),'gettrigermode')
         return DCAM_TRIGGERMODE.value
@@ -317,14 +407,15 @@ class HamamatsuCamera():
         self.checkStatus(self.dcam.dcam_firetrigger(self.camera_handle),"dcam_firetrigger")
         print('TRIG')
 
-    def getFrames(self):
+    def getFrames(self, timeout = None):
         """Gets all of the available frames.
         This will block waiting for new frames even if
         there new frames available when it is called.
+        @param timeout Seconds to wait for a new frame, None to wait forever.
         @return [frames, [frame x size, frame y size]]."""
 
         frames = []
-        for n in self.newFrames():
+        for n in self.newFrames(timeout):
 
             # Lock the frame in the camera buffer & get address.
             data_address = ctypes.c_void_p(0)
@@ -336,7 +427,7 @@ class HamamatsuCamera():
                              "dcam_lockdata")
 
             # Create storage for the frame & copy into this storage.
-            hc_data = HCamData(self.frame_bytes)
+            hc_data = HCamData(self.frame_bytes, (self.frame_y, self.frame_x))
             hc_data.copyData(data_address)
 
             # Unlock the frame.
@@ -350,6 +441,28 @@ class HamamatsuCamera():
 
         return [frames, [self.frame_x, self.frame_y]]
 
+    def iterFrames(self, n_frames = None, timeout = None):
+        """Yields the frames one by one as soon as the camera signals them
+        ready (DCAMCAP_EVENT_FRAMEREADY), as returned by getFrames().
+        Frames that become ready together are all yielded, even beyond
+        n_frames. Can be called again to go on after a timeout.
+        @param n_frames Stop once this many frames were yielded, None to go on.
+        @param timeout Seconds to wait for each new frame, None to wait forever.
+                       Stops if no frame arrived in time.
+        @return Generator of (frame, frame number since the acquisition
+                start (from 1), time.time() at which it was found ready)."""
+
+        n_yielded = 0
+        while n_frames is None or n_yielded < n_frames:
+            [frames, dims] = self.getFrames(timeout)
+            if not frames:
+                return
+            timestamp = time.time()
+            first_number = self.last_frame_number - len(frames) + 1
+            for i, frame in enumerate(frames):
+                yield (frame, first_number + i, timestamp)
+            n_yielded += len(frames)
+
     def getModelInfo(self, camera_id):
         """Returns the model of the camera
         @param camera_id The (integer) camera id number.
@@ -373,13 +486,18 @@ class HamamatsuCamera():
 
     def getPropertyAttribute(self, property_name):
         """Return the attribute structure of a particular property.
-        FIXME (OPTIMIZATION): Keep track of known attributes?
+        The attributes are cached per property id until a property that
+        changes them is set (see invalidatePropertyCache()).
         @param property_name The name of the property to get the attributes of.
         @return A DCAM_PARAM_PROPERTYATTR object."""
 
+        prop_id = self.properties[property_name]
+        if prop_id in self.prop_attrs:
+            return self.prop_attrs[prop_id]
+
         p_attr = DCAM_PARAM_PROPERTYATTR()
         p_attr.cbSize = ctypes.sizeof(p_attr)
-        p_attr.iProp = self.properties[property_name]
+        p_attr.iProp = prop_id
         ret = self.checkStatus(self.dcam.dcam_getpropertyattr(self.camera_handle,
                                                          ctypes.byref(p_attr)),
                                "dcam_getpropertyattr")
@@ -387,19 +505,24 @@ class HamamatsuCamera():
             print(" property %s is not supported" % property_name)
             return False
         else:
+            self.prop_attrs[prop_id] = p_attr
             return p_attr
 
     def getPropertyText(self, property_name):
         """Return the text options of a property (if any).
+        The options are cached like the attributes.
         @param property_name The name of the property to get the text values of.
         @return A dictionary of text properties (which may be empty)."""
 
+        prop_id = self.properties[property_name]
+        if prop_id in self.prop_texts:
+            return self.prop_texts[prop_id]
+
         prop_attr = self.getPropertyAttribute(property_name)
         if not (prop_attr.attribute & DCAMPROP_ATTR_HASVALUETEXT):
-            return {}
+            text_options = {}
         else:
             # Create property text structure.
-            prop_id = self.properties[property_name]
             v = ctypes.c_double(prop_attr.valuemin)
 
             prop_text = DCAM_PARAM_PROPERTYVALUETEXT()
@@ -431,7 +554,8 @@ class HamamatsuCamera():
                 if ret == 0:
                     done = True
 
-            return text_options
+        self.prop_texts[prop_id] = text_options
+        return text_options
 
     def getPropertyRange(self, property_name):
         """Return the range for an attribute.
@@ -504,6 +628,12 @@ class HamamatsuCamera():
 
         return [prop_value, prop_type]
 
+    def invalidatePropertyCache(self):
+        """Forget the cached property attributes and text options."""
+
+        self.prop_attrs = {}
+        self.prop_texts = {}
+
     def isCameraProperty(self, property_name):
         """Check if a property name is supported by the camera.
         @param property_name The name of the property.
@@ -516,19 +646,29 @@ class HamamatsuCamera():
             return False
 
 
-    def newFrames(self):
+    def newFrames(self, timeout = None):
         """Return a list of the ids of all the new frames since the last check.
         This will block waiting for at least one new frame.
-        @return [id of the first frame, .. , id of the last frame]
+        @param timeout Seconds to wait for a new frame, None to wait forever.
+        @return [id of the first frame, .. , id of the last frame], empty
+                if no frame arrived within the timeout.
         """
 
         # Wait for a new frame.
+        if timeout is None:
+            c_timeout = DCAMWAIT_TIMEOUT_INFINITE
+        else:
+            c_timeout = max(int(1000*timeout), 0)
         dwait = ctypes.c_int(DCAMCAP_EVENT_FRAMEREADY)
-        self.checkStatus(self.dcam.dcam_wait(self.camera_handle,
-                                        ctypes.byref(dwait),
-                                        ctypes.c_int(DCAMWAIT_TIMEOUT_INFINITE),
-                                        None),
-                         "dcam_wait")
+        ret = self.dcam.dcam_wait(self.camera_handle,
+                                  ctypes.byref(dwait),
+                                  ctypes.c_int(c_timeout),
+                                  None)
+        if (ret == DCAMERR_ERROR):
+            c_error = self.dcam.dcam_getlasterror(self.camera_handle, None, ctypes.c_int32(0))
+            if (c_error & 0xFFFFFFFF) == DCAMERR_TIMEOUT:
+                return []
+            self.checkStatus(ret, "dcam_wait")
 
         # Check how many new frames there are.
         b_index = ctypes.c_int32(0)  # Is pointer to receive the number of the frame in which the most recent data is stored.
@@ -567,6 +707,13 @@ class HamamatsuCamera():
 
         return new_frames
 
+    def releaseFrames(self, frames):
+        """Hands frames returned by getFrames() back to the camera.
+        @param frames The list of HCamData objects to release."""
+
+        for frame in frames:
+            frame.unlock()
+
     def setPropertyValue(self, property_name, property_value):
         """Set the value of a property.
         @param property_name The name of the property.
@@ -577,6 +724,8 @@ class HamamatsuCamera():
         if not (property_name in self.properties):
             print(" unknown property name: %s"%property_name)
             return False
+        # What setProperties() compares the next request with
+        requested_value = property_value
 
         # If the value is text, figure out what the
         # corresponding numerical property value is.
@@ -605,8 +754,42 @@ class HamamatsuCamera():
                                                        ctypes.byref(p_value),
                                                        ctypes.c_int32(DCAM_DEFAULT_ARG)),
                          "dcam_setgetpropertyvalue")
+
+        # Only a change of value can change the attributes of other properties.
+        if property_name.startswith(DCAM_ATTR_CHANGING_PROPERTIES):
+            if self.prop_set_values.get(property_name) != p_value.value:
+                self.invalidatePropertyCache()
+        self.prop_set_values[property_name] = p_value.value
+        self.prop_requested[property_name] = requested_value
         return p_value.value
 
+    def setProperties(self, properties, force = False):
+        """Set the values of several properties in one pass.
+        Properties that change the attributes of other properties (binning,
+        subarray, trigger, ..) are set first, the others afterwards in the
+        order given. Properties that were last set to the same value through
+        this object are skipped, unless forced or unless one of the first
+        ones changed (as the camera may have adjusted the others).
+        @param properties A dictionary (or a list of (name, value) pairs)
+                          of properties to set.
+        @param force Set every property, even if it should be unchanged.
+        @return A dictionary with the values the properties were set to."""
+
+        if isinstance(properties, dict):
+            properties = list(properties.items())
+        first = [p for p in properties if p[0].startswith(DCAM_ATTR_CHANGING_PROPERTIES)]
+        others = [p for p in properties if not p[0].startswith(DCAM_ATTR_CHANGING_PROPERTIES)]
+
+        values = {}
+        for property_name, property_value in first + others:
+            if (not force and property_name in self.prop_requested
+                and self.prop_requested[property_name] == property_value):
+                values[property_name] = self.prop_set_values[property_name]
+            else:
+                values[property_name] = self.setPropertyValue(property_name, property_value)
+                force = force or property_name.startswith(DCAM_ATTR_CHANGING_PROPERTIES)
+        return values
+
     def setSubArrayMode(self):
         """This sets the sub-array mode as appropriate based on the current ROI."""
 
@@ -615,17 +798,23 @@ class HamamatsuCamera():
         roi_h = self.getPropertyValue("subarray_vsize")[0]
         # If the ROI is smaller than the entire frame turn on subarray mode
         if roi_w == self.max_width and roi_h == self.max_height:
-            self.setPropertyValue("subarray_mode", 1)  # OFF
+            self.setProperties({"subarray_mode": 1})  # OFF
         else:
-            self.setPropertyValue("subarray_mode", 2)  # ON
+            self.setProperties({"subarray_mode": 2})  # ON
 
-    def startAcquisition(self):
-        """ Start data acquisition."""
+    def startAcquisition(self, n_frames = None):
+        """ Start data acquisition.
+        @param n_frames The number of frames expected. One spare buffer is
+                        allocated so that a surplus frame does not overwrite
+                        the first one. If None, buffer 2 seconds of data."""
         self.captureSetup()
 
         # Allocate Hamamatsu image buffers.
-        # We allocate enough to buffer 2 seconds of data.
-        n_buffers = int(2.0*self.getPropertyValue("internal_frame_rate")[0])
+        if n_frames is None:
+            # We allocate enough to buffer 2 seconds of data.
+            n_buffers = int(2.0*self.getPropertyValue("internal_frame_rate")[0])
+        else:
+            n_buffers = n_frames + 1
         self.number_image_buffers = n_buffers
         self.checkStatus(self.dcam.dcam_allocframe(self.camera_handle,
                                               ctypes.c_int32(self.number_image_buffers)),
@@ -664,13 +853,14 @@ class HamamatsuCameraMR(HamamatsuCamera):
     that there is a lot less memory allocation & shuffling compared
     to the basic class, which performs one allocation and (I believe)
     two copies for each frame that is acquired.
-    WARNING: There is the potential here for chaos. Since the memory
-      is now shared there is the possibility that downstream code
-      will try and access the same bit of memory at the same time
-      as the camera and this could end badly.
-    FIXME: Use lockbits (and unlockbits) to avoid memory clashes?
-      This would probably also involve some kind of reference counting
-      scheme."""
+    The buffers are page aligned and handed out as 2-D views (see
+    HCamData.getImage()), so a frame is never copied between the camera
+    and the h5 file.
+    Since the memory is shared with the camera, every frame returned by
+    getFrames() is locked and has to be handed back with releaseFrames()
+    once downstream code is done with it. A locked buffer is never
+    re-attached to the camera, and a ring overrun onto a locked buffer
+    is reported instead of silently corrupting the frame."""
 
     def __init__(self, camera_id):
         """@param camera_id The id of the camera."""
@@ -678,75 +868,122 @@ class HamamatsuCameraMR(HamamatsuCamera):
         HamamatsuCamera.__init__(self, camera_id)
 
         self.hcam_data = []
+        # The other set of buffers, see prepareAcquisition()
+        self.spare_hcam_data = []
         self.hcam_ptr = False
-        self.old_frame_bytes = -1
+        self.buffers_attached = False
+        self.prepared = False
+        self.prepared_frames = None
 
         self.setPropertyValue("output_trigger_kind[0]", 2)
 
-    def getFrames(self):
+    def getFrames(self, timeout = None):
         """Gets all of the available frames.
         This will block waiting for new frames even if there new frames
         available when it is called.
+        The frames are locked and must be released with releaseFrames().
         FIXME: It does not always seem to block? The length of frames can
                be zero. Are frames getting dropped? Some sort of race condition?
+        @param timeout Seconds to wait for a new frame, None to wait forever.
         return [frames, [frame x size, frame y size]]
         """
 
         frames = []
-        for n in self.newFrames():
-            frames.append(self.hcam_data[n])
+        for n in self.newFrames(timeout):
+            hc_data = self.hcam_data[n]
+            if hc_data.isLocked():
+                # The caller never gets the frames locked so far
+                self.releaseFrames(frames)
+                raise DCAMException("frame buffer " + str(n) + " was overwritten while still in use")
+            hc_data.lock()
+            frames.append(hc_data)
 
         return [frames, [self.frame_x, self.frame_y]]
 
-    def startAcquisition(self):
-        """Allocate as many frames as will fit in 2GB of memory and start data acquisition."""
+    def prepareAcquisition(self, n_frames = None):
+        """Does everything startAcquisition() does but starting the capture,
+        e.g. while the frames of the last acquisition are still being written.
+        Setting any property afterwards undoes the preparation.
+        If the buffers are still locked downstream, the spare set is attached
+        instead (allocated once, or again if it is locked as well).
+        @param n_frames The number of frames expected, one spare frame is
+                        allocated on top. If None, allocate as many frames
+                        as will fit in 0.1GB of memory."""
+        if self.buffers_attached:
+            self.checkStatus(self.dcam.dcam_releasebuffer(self.camera_handle),
+                             "dcam_releasebuffer")
+            self.buffers_attached = False
         self.captureSetup()
 
-        # Allocate new image buffers if necessary.
-        # Allocate as many frames as can fit in 2GB of memory.
-        if (self.old_frame_bytes != self.frame_bytes):
-
+        if n_frames is None:
+            # Allocate as many frames as can fit in 0.1GB of memory.
             n_buffers = int((0.1 * 1024 * 1024 * 1024)/self.frame_bytes)
-            self.number_image_buffers = n_buffers
-
-            # Allocate new image buffers.
-            ptr_array = ctypes.c_void_p * self.number_image_buffers
-            self.hcam_ptr = ptr_array()
-            self.hcam_data = []
-            for i in range(self.number_image_buffers):
-                hc_data = HCamData(self.frame_bytes)
-                self.hcam_ptr[i] = hc_data.getDataPtr()
-                self.hcam_data.append(hc_data)
-
-            self.old_frame_bytes = self.frame_bytes
+        else:
+            n_buffers = n_frames + 1
+        frame_shape = (self.frame_y, self.frame_x)
+
+        def usable(buffers):
+            return (len(buffers) == n_buffers) and \
+                all((hc_data.size == self.frame_bytes) and (hc_data.shape == frame_shape) and
+                    not hc_data.isLocked() for hc_data in buffers)
+
+        if not usable(self.hcam_data):
+            if any(hc_data.isLocked() for hc_data in self.hcam_data):
+                self.hcam_data, self.spare_hcam_data = self.spare_hcam_data, self.hcam_data
+            if not usable(self.hcam_data):
+                # Allocate new image buffers.
+                # Buffers still held downstream keep their own memory alive,
+                # so they are simply dropped from the pool.
+                self.hcam_data = [HCamData(self.frame_bytes, frame_shape, PAGE_SIZE) for i in range(n_buffers)]
+        self.number_image_buffers = n_buffers
+        ptr_array = ctypes.c_void_p * self.number_image_buffers
+        self.hcam_ptr = ptr_array(*[hc_data.getDataPtr() for hc_data in self.hcam_data])
 
         # Attach image buffers.
         #
         # We need to attach & release for each acquisition otherwise
         # we'll get an error if we try to change the ROI in any way
         # between acquisitions.
-        self.checkStatus(dcam.dcam_attachbuffer(self.camera_handle,
+        self.checkStatus(self.dcam.dcam_attachbuffer(self.camera_handle,
                                                 self.hcam_ptr,
                                                 ctypes.sizeof(self.hcam_ptr)),
                          "dcam_attachbuffer")
+        self.buffers_attached = True
+        self.prepared_frames = n_frames
+        self.prepared = True
+
+    def startAcquisition(self, n_frames = None):
+        """Allocate the frames and start data acquisition. Only starts the
+        capture if prepareAcquisition(n_frames) was called since the last
+        acquisition (and no property was set since).
+        @param n_frames See prepareAcquisition()."""
+        if not (self.prepared and self.prepared_frames == n_frames):
+            self.prepareAcquisition(n_frames)
+        self.prepared = False
 
         # Start acquisition.
-        self.checkStatus(dcam.dcam_capture(self.camera_handle),
+        self.checkStatus(self.dcam.dcam_capture(self.camera_handle),
                          "dcam_capture")
 
-
+    def setPropertyValue(self, property_name, property_value):
+        """As HamamatsuCamera.setPropertyValue(), any property may change the frames."""
+        self.prepared = False
+        return HamamatsuCamera.setPropertyValue(self, property_name, property_value)
 
     def stopAcquisition(self):
-        """Stops the acquisition and releases the memory associated with the frames."""
+        """Stops the acquisition and releases the memory associated with the frames.
+        Frames still locked downstream stay valid, the memory is owned by numpy."""
 
         # Stop acquisition.
-        self.checkStatus(dcam.dcam_idle(self.camera_handle),
+        self.checkStatus(self.dcam.dcam_idle(self.camera_handle),
                          "dcam_idle")
 
         # Release image buffers.
-        if (self.hcam_ptr):
-            self.checkStatus(dcam.dcam_releasebuffer(self.camera_handle),
+        if self.buffers_attached:
+            self.checkStatus(self.dcam.dcam_releasebuffer(self.camera_handle),
                              "dcam_releasebuffer")
+            self.buffers_attached = False
+        self.prepared = False
 
         print("max camera backlog was: %s"%self.max_backlog)
         self.max_backlog = 0
@@ -754,6 +991,10 @@ class HamamatsuCameraMR(HamamatsuCamera):
 if __name__ == "__main__":
     print('MAIN')
 
+    temp = ctypes.c_int32(0)
+    if (loadDcam().dcam_init(None, ctypes.byref(temp), None) != DCAMERR_NOERROR):
+        raise DCAMException("DCAM initialization failed.")
+    n_cameras = temp.value
     print ("found: %s cameras"%n_cameras)
     if (n_cameras > 0):
 
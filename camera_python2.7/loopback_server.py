@@ -0,0 +1,85 @@
+"""Hardware-free stand-in for a camera server
+
+Answers the requests of the BLACS CameraWorker (see Camera.py) exactly as
+a camera server would, but without any camera attached. It lets the
+worker, its connections and the network be checked on a lab PC or on
+loopback.
+
+  Typical usage example:
+
+  python loopback_server.py 7              # zmq, as camera_server.py
+  python loopback_server.py 7 --sockets    # line-based socket protocol
+"""
+
+import sys
+import SocketServer
+import zprocess
+
+
+def reply(request_data):
+    """Returns the list of replies a camera server sends to a request."""
+
+    if request_data == 'hello':
+        return ['hello']
+    elif request_data.endswith('.h5') or request_data == 'done':
+        return ['ok', 'done']
+    elif request_data in ('flush', 'abort'):
+        return ['done']
+    elif request_data == 'stats':
+        return ['{"uptime": 0, "counters": {}, "samples": {}}']
+    elif request_data == 'status':
+        return ['{"state": "idle", "shot": null, "preview": false, "queued": 0}']
+    else:
+        raise ValueError('invalid request: %s'%request_data)
+
+
+class LoopbackSocketHandler(SocketServer.StreamRequestHandler):
+    """Serves any number of '\\r\\n' terminated requests on one connection."""
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            request_data = line.rstrip('\r\n')
+            print(request_data)
+            try:
+                responses = reply(request_data)
+            except ValueError as e:
+                responses = [str(e)]
+            for response in responses:
+                self.wfile.write('%s\r\n'%response)
+            self.wfile.flush()
+
+
+class LoopbackSocketServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port, host = ''):
+        SocketServer.TCPServer.__init__(self, (host, port), LoopbackSocketHandler)
+
+
+class LoopbackZMQServer(zprocess.ZMQServer):
+    """zmq stand-in with the same two-phase replies as camera_server.GenericServer."""
+
+    def __init__(self, port):
+        zprocess.ZMQServer.__init__(self, port, type='string')
+
+    def handler(self, request_data):
+        print(request_data)
+        responses = reply(request_data)
+        for response in responses[:-1]:
+            self.send(response)
+            self.recv()
+        return responses[-1]
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1])
+    if '--sockets' in sys.argv:
+        print('Starting loopback socket server on port %d' % port)
+        LoopbackSocketServer(port).serve_forever()
+    else:
+        print('Starting loopback zmq server on port %d' % port)
+        LoopbackZMQServer(port).shutdown_on_interrupt()
@@ -10,148 +10,31 @@ which was trimmed down to only work for our limited usecase
   camera.apply_settings(trigger = 'external_trigger', exposure_time = 200)
   camera.arm(num_images)
   # Experimental physics happens
-  images = camera.get_images(num_images)
+  images, info = camera.get_images(num_images)
   camera.close()
+
+  or, for sequences longer than the number of buffers:
+
+  camera.arm(num_buffers = 4)
+  camera.start_stream(num_images)
+  # Experimental physics happens
+  images, info = camera.stop_stream(num_images)
 """
 
+import os
+import time
+import threading
 import ctypes as C
 import numpy as np
 import logging
 
 logging.basicConfig()
 
-try:
-    dll = C.oledll.LoadLibrary('SC2_Cam')
-except WindowsError:
-    print('Failed to load SC2_Cam.dll')
-    raise
-    
-dll.open_camera = dll.PCO_OpenCamera
-dll.open_camera.argtypes = [C.POINTER(C.c_void_p), C.c_uint16]
-
-dll.close_camera = dll.PCO_CloseCamera
-dll.close_camera.argtypes = [C.c_void_p]
-
-dll.arm_camera = dll.PCO_ArmCamera
-dll.arm_camera.argtypes = [C.c_void_p]
-
-dll.allocate_buffer = dll.PCO_AllocateBuffer
-dll.allocate_buffer.argtypes = [
-    C.c_void_p,
-    C.POINTER(C.c_int16),
-    C.c_uint32,
-    C.POINTER(C.POINTER(C.c_uint16)),
-    C.POINTER(C.c_void_p)]
-
-dll.add_buffer = dll.PCO_AddBufferEx
-dll.add_buffer.argtypes = [
-    C.c_void_p,
-    C.c_uint32,
-    C.c_uint32,
-    C.c_int16,
-    C.c_uint16,
-    C.c_uint16,
-    C.c_uint16]
-
-dll.get_buffer_status = dll.PCO_GetBufferStatus
-dll.get_buffer_status.argtypes = [
-    C.c_void_p,
-    C.c_int16,
-    C.POINTER(C.c_uint32),
-    C.POINTER(C.c_uint32)]
-
-dll.set_image_parameters = dll.PCO_CamLinkSetImageParameters
-dll.set_image_parameters.argtypes = [C.c_void_p, C.c_uint16, C.c_uint16]
-
-dll.set_recording_state = dll.PCO_SetRecordingState
-dll.set_recording_state.argtypes = [C.c_void_p, C.c_uint16]
-
-dll.get_sizes = dll.PCO_GetSizes
-dll.get_sizes.argtypes = [
-    C.c_void_p,
-    C.POINTER(C.c_uint16),
-    C.POINTER(C.c_uint16),
-    C.POINTER(C.c_uint16),
-    C.POINTER(C.c_uint16)]
-
-dll.get_sensor_format = dll.PCO_GetSensorFormat
-dll.get_sensor_format.argtypes = [C.c_void_p, C.POINTER(C.c_uint16)]
-
-dll.get_camera_health = dll.PCO_GetCameraHealthStatus
-dll.get_camera_health.argtypes = [
-    C.c_void_p,
-    C.POINTER(C.c_uint32),
-    C.POINTER(C.c_uint32),
-    C.POINTER(C.c_uint32)]
-
-dll.get_temperature = dll.PCO_GetTemperature
-dll.get_temperature.argtypes = [
-    C.c_void_p,
-    C.POINTER(C.c_int16),
-    C.POINTER(C.c_int16),
-    C.POINTER(C.c_int16)]
-
-dll.get_trigger_mode = dll.PCO_GetTriggerMode
-dll.get_trigger_mode.argtypes = [C.c_void_p, C.POINTER(C.c_uint16)]
-
-dll.get_delay_exposure_time = dll.PCO_GetDelayExposureTime
-dll.get_delay_exposure_time.argtypes = [
-    C.c_void_p,
-    C.POINTER(C.c_uint32),
-    C.POINTER(C.c_uint32),
-    C.POINTER(C.c_uint16),
-    C.POINTER(C.c_uint16)]
-
-dll.set_delay_exposure_time = dll.PCO_SetDelayExposureTime
-dll.set_delay_exposure_time.argtypes = [
-    C.c_void_p,
-    C.c_uint32,
-    C.c_uint32,
-    C.c_uint16,
-    C.c_uint16]
-
-dll.get_roi = dll.PCO_GetROI
-dll.get_roi.argtypes = [
-    C.c_void_p,
-    C.POINTER(C.c_uint16),
-    C.POINTER(C.c_uint16),
-    C.POINTER(C.c_uint16),
-    C.POINTER(C.c_uint16)]
-
-dll.set_roi = dll.PCO_SetROI
-dll.set_roi.argtypes = [
-    C.c_void_p,
-    C.c_uint16,
-    C.c_uint16,
-    C.c_uint16,
-    C.c_uint16]
-
-dll.get_camera_name = dll.PCO_GetCameraName
-dll.get_camera_name.argtype = [
-    C.c_void_p,
-    C.c_char_p,
-    C.c_uint16]
-
-dll.reset_settings_to_default = dll.PCO_ResetSettingsToDefault
-dll.reset_settings_to_default.argtypes = [C.c_void_p]
-
-dll.set_recording_state = dll.PCO_SetRecordingState
-dll.set_recording_state.argtypes = [C.c_void_p, C.c_uint16]
-
-dll.remove_buffer = dll.PCO_RemoveBuffer
-dll.remove_buffer.argtypes = [C.c_void_p]
-
-dll.cancel_images = dll.PCO_CancelImages
-dll.cancel_images.argtypes = [C.c_void_p]
-
-dll.free_buffer = dll.PCO_FreeBuffer
-dll.free_buffer.argtypes = [C.c_void_p, C.c_int16]
-
-dll.set_trigger_mode = dll.PCO_SetTriggerMode
-dll.set_trigger_mode.argtypes = [C.c_void_p, C.c_uint16]
-
-dll.get_num_cnt = dll.PCO_GetHWIOSignalCount
-dll.get_num_cnt.argtypes = [C.c_void_p, C.POINTER(C.c_uint16)]
+# Buffer status flags (PCO_GetBufferStatus)
+BUFFER_EVENT_SET = 0x00008000
+WAIT_OBJECT_0 = 0x00000000
+# Seconds a buffer wait of the stream waits on the event at once, to notice a stop
+STOP_POLL_INTERVAL = 0.005
 
 class PCO_Signal(C.Structure):
     _fields_=[  ('wSize', C.c_uint16),
@@ -167,12 +50,172 @@ class PCO_Signal(C.Structure):
                 ('ZZdwReserved',  C.c_uint32*3),]
     
 PCO_Signal_star = C.POINTER(PCO_Signal)
-    
-dll.get_hwio_signal = dll.PCO_GetHWIOSignal
-dll.get_hwio_signal.argtypes = [C.c_void_p, C.c_uint16, PCO_Signal_star]
 
-dll.set_hwio_signal = dll.PCO_SetHWIOSignal
-dll.set_hwio_signal.argtypes = [C.c_void_p, C.c_uint16, PCO_Signal_star]
+# The libraries are loaded by the first PCOCamera, so that importing this
+# module is cheap and works without them
+dll = None
+kernel32 = None
+
+def load_libraries():
+    """Loads SC2_Cam.dll and kernel32 and declares the functions used
+    
+    Only the first call loads them. Set the CAMERA_BACKEND environment
+    variable to 'simulated' to run without a camera (see simcams.py).
+    """
+    
+    global dll, kernel32
+    if dll is not None:
+        return
+    if os.environ.get('CAMERA_BACKEND') == 'simulated':
+        import simcams
+        dll = simcams.SimulatedSC2Cam()
+    else:
+        try:
+            dll = C.oledll.LoadLibrary('SC2_Cam')
+        except (OSError, AttributeError): # no oledll off Windows
+            print('Failed to load SC2_Cam.dll')
+            raise
+
+    dll.open_camera = dll.PCO_OpenCamera
+    dll.open_camera.argtypes = [C.POINTER(C.c_void_p), C.c_uint16]
+
+    dll.close_camera = dll.PCO_CloseCamera
+    dll.close_camera.argtypes = [C.c_void_p]
+
+    dll.arm_camera = dll.PCO_ArmCamera
+    dll.arm_camera.argtypes = [C.c_void_p]
+
+    dll.allocate_buffer = dll.PCO_AllocateBuffer
+    dll.allocate_buffer.argtypes = [
+        C.c_void_p,
+        C.POINTER(C.c_int16),
+        C.c_uint32,
+        C.POINTER(C.POINTER(C.c_uint16)),
+        C.POINTER(C.c_void_p)]
+
+    dll.add_buffer = dll.PCO_AddBufferEx
+    dll.add_buffer.argtypes = [
+        C.c_void_p,
+        C.c_uint32,
+        C.c_uint32,
+        C.c_int16,
+        C.c_uint16,
+        C.c_uint16,
+        C.c_uint16]
+
+    dll.get_buffer_status = dll.PCO_GetBufferStatus
+    dll.get_buffer_status.argtypes = [
+        C.c_void_p,
+        C.c_int16,
+        C.POINTER(C.c_uint32),
+        C.POINTER(C.c_uint32)]
+
+    dll.set_image_parameters = dll.PCO_CamLinkSetImageParameters
+    dll.set_image_parameters.argtypes = [C.c_void_p, C.c_uint16, C.c_uint16]
+
+    dll.set_recording_state = dll.PCO_SetRecordingState
+    dll.set_recording_state.argtypes = [C.c_void_p, C.c_uint16]
+
+    dll.get_sizes = dll.PCO_GetSizes
+    dll.get_sizes.argtypes = [
+        C.c_void_p,
+        C.POINTER(C.c_uint16),
+        C.POINTER(C.c_uint16),
+        C.POINTER(C.c_uint16),
+        C.POINTER(C.c_uint16)]
+
+    dll.get_sensor_format = dll.PCO_GetSensorFormat
+    dll.get_sensor_format.argtypes = [C.c_void_p, C.POINTER(C.c_uint16)]
+
+    dll.get_camera_health = dll.PCO_GetCameraHealthStatus
+    dll.get_camera_health.argtypes = [
+        C.c_void_p,
+        C.POINTER(C.c_uint32),
+        C.POINTER(C.c_uint32),
+        C.POINTER(C.c_uint32)]
+
+    dll.get_temperature = dll.PCO_GetTemperature
+    dll.get_temperature.argtypes = [
+        C.c_void_p,
+        C.POINTER(C.c_int16),
+        C.POINTER(C.c_int16),
+        C.POINTER(C.c_int16)]
+
+    dll.get_trigger_mode = dll.PCO_GetTriggerMode
+    dll.get_trigger_mode.argtypes = [C.c_void_p, C.POINTER(C.c_uint16)]
+
+    dll.get_delay_exposure_time = dll.PCO_GetDelayExposureTime
+    dll.get_delay_exposure_time.argtypes = [
+        C.c_void_p,
+        C.POINTER(C.c_uint32),
+        C.POINTER(C.c_uint32),
+        C.POINTER(C.c_uint16),
+        C.POINTER(C.c_uint16)]
+
+    dll.set_delay_exposure_time = dll.PCO_SetDelayExposureTime
+    dll.set_delay_exposure_time.argtypes = [
+        C.c_void_p,
+        C.c_uint32,
+        C.c_uint32,
+        C.c_uint16,
+        C.c_uint16]
+
+    dll.get_roi = dll.PCO_GetROI
+    dll.get_roi.argtypes = [
+        C.c_void_p,
+        C.POINTER(C.c_uint16),
+        C.POINTER(C.c_uint16),
+        C.POINTER(C.c_uint16),
+        C.POINTER(C.c_uint16)]
+
+    dll.set_roi = dll.PCO_SetROI
+    dll.set_roi.argtypes = [
+        C.c_void_p,
+        C.c_uint16,
+        C.c_uint16,
+        C.c_uint16,
+        C.c_uint16]
+
+    dll.get_camera_name = dll.PCO_GetCameraName
+    dll.get_camera_name.argtype = [
+        C.c_void_p,
+        C.c_char_p,
+        C.c_uint16]
+
+    dll.reset_settings_to_default = dll.PCO_ResetSettingsToDefault
+    dll.reset_settings_to_default.argtypes = [C.c_void_p]
+
+    dll.set_recording_state = dll.PCO_SetRecordingState
+    dll.set_recording_state.argtypes = [C.c_void_p, C.c_uint16]
+
+    dll.remove_buffer = dll.PCO_RemoveBuffer
+    dll.remove_buffer.argtypes = [C.c_void_p]
+
+    dll.cancel_images = dll.PCO_CancelImages
+    dll.cancel_images.argtypes = [C.c_void_p]
+
+    dll.free_buffer = dll.PCO_FreeBuffer
+    dll.free_buffer.argtypes = [C.c_void_p, C.c_int16]
+
+    dll.set_trigger_mode = dll.PCO_SetTriggerMode
+    dll.set_trigger_mode.argtypes = [C.c_void_p, C.c_uint16]
+
+    # Used to block on the buffer events
+    if os.environ.get('CAMERA_BACKEND') == 'simulated':
+        kernel32 = simcams.SimulatedKernel32()
+    else:
+        kernel32 = C.windll.kernel32
+    kernel32.WaitForSingleObject.argtypes = [C.c_void_p, C.c_uint32]
+    kernel32.WaitForSingleObject.restype = C.c_uint32
+
+    dll.get_num_cnt = dll.PCO_GetHWIOSignalCount
+    dll.get_num_cnt.argtypes = [C.c_void_p, C.POINTER(C.c_uint16)]
+
+    dll.get_hwio_signal = dll.PCO_GetHWIOSignal
+    dll.get_hwio_signal.argtypes = [C.c_void_p, C.c_uint16, PCO_Signal_star]
+
+    dll.set_hwio_signal = dll.PCO_SetHWIOSignal
+    dll.set_hwio_signal.argtypes = [C.c_void_p, C.c_uint16, PCO_Signal_star]
 
 class PCOCamera:
     """Class to handle PCO Cameras."""
@@ -193,6 +236,9 @@ class PCOCamera:
             WindowsError, AssertionError: Could not connect to the camera.
         """
             
+        load_libraries()
+        self._stream_thread = None
+        self.settings = {}
         if logger is None:
             self.logger = logging.getLogger('pcoLogger')
             self.logger.setLevel(logging.INFO)
@@ -231,7 +277,9 @@ class PCOCamera:
     def apply_settings(self, trigger = 'external_exposure', trigger_polarity = 'raising', exposure_time = 107, roi = None):
         """Apply user specified settings to the camera
         
-        Has to be called prior to arming the device.
+        Has to be called prior to arming the device. Only the settings that
+        differ from the ones last applied are sent to the camera, and the
+        camera is only disarmed if any of them does.
         
         Args:
             trigger          (str):  Desired trigger mode chosen between:
@@ -244,24 +292,45 @@ class PCOCamera:
                                       - 'falling'
             exposure_time    (int):  Integration time in microseconds.
             roi             (dict):  Region of interest for hardware cropping.
+            
+        Returns:
+            bool: True if any setting changed, the camera then has to be armed again.
         """
         
         # Pro advice; never use mutable default arguments ;)
         if roi is None:
             roi = {'left':1, 'top': 1, 'right': 2048, 'bottom': 2048}
+        settings = {'trigger': trigger,
+                    #'trigger_polarity': trigger_polarity,
+                    'exposure_time': int(exposure_time),
+                    'roi': dict(roi)}
+        setters = {'trigger': self._set_trigger_mode,
+                   'trigger_polarity': self._set_trigger_polarity,
+                   'exposure_time': self._set_exposure_time,
+                   'roi': self._set_roi}
+        changed = [name for name in ('trigger', 'trigger_polarity', 'exposure_time', 'roi')
+                   if name in settings and self.settings.get(name) != settings[name]]
+        if not changed:
+            self.logger.info('Camera settings unchanged.')
+            return False
         if self.armed: self.disarm()
         self.logger.info('Applying settings to camera...')
-        self._set_trigger_mode(trigger)
-        #self._set_trigger_polarity(trigger_polarity)
-        self._set_exposure_time(exposure_time)
-        self._set_roi(roi)
-        return None
+        for name in changed:
+            # Forget the setting first, in case setting it fails half way
+            self.settings.pop(name, None)
+            setters[name](settings[name])
+            self.settings[name] = settings[name]
+        return True
     
     def arm(self, num_buffers = 3):
         """Readies the camera for image acquisition
         
         Arms the camera, provides it with pointers to pre-defined buffers
-        to store images and puts it in acquisition mode.
+        to store images and puts it in acquisition mode. If the camera is
+        still armed with as many buffers (see self.stop_recording()), the
+        buffers are only handed back to it and recording restarts. If it is
+        even still recording into all of them, and none holds an image yet
+        (e.g. armed ahead of a shot), nothing is done.
                 
         Args:
             num_buffers (int): Number of buffers that should be allocated 
@@ -269,14 +338,25 @@ class PCOCamera:
                                 this should be equal to the num_images arg
                                 of the self.get_images() function.
                                 Never provide fewer buffers than the number
-                                of images, because I didnt want to have to deal
-                                with permanent camera polling as this goes
-                                against having a fast experimental cycle time.
+                                of images to get_images(), because I didnt want
+                                to have to deal with permanent camera polling as
+                                this goes against having a fast experimental cycle
+                                time. Use self.start_stream() for longer sequences.
         """
     
         assert 1 <= num_buffers <= 16
+        if self.armed and num_buffers == len(self.buffer_pointers) and self._stream_thread is None and \
+           len(self.added_buffers) == num_buffers and not self._wait_for_buffer(self.added_buffers[0], 0):
+            self.logger.info('Camera still recording, ready.')
+            return None
+        if self.armed and num_buffers == len(self.buffer_pointers):
+            self.logger.info('Camera still armed, restarting recording...')
+            self.stop_recording()
+            self._start_recording()
+            return None
         if self.armed:
-            self.logger.warning('Arm requested, but the pco camera is already armed. Disarming...')
+            self.logger.info('Arm requested with '+str(num_buffers)+' buffers, but the pco camera is armed with '+\
+                             str(len(self.buffer_pointers))+'. Disarming...')
             self.disarm()
         self.logger.info('Arming camera...')
         dll.arm_camera(self.camera_handle)
@@ -287,6 +367,7 @@ class PCOCamera:
         self.logger.debug(' Camera ROI dimensions: '+str(self.width)+' (l/r) by '+str(self.height)+' (u/d)')
 
         self.buffer_pointers = []
+        self.buffer_events = []
         for i in range(num_buffers):
             buffer_number = C.c_int16(-1)
             self.buffer_pointers.append(C.POINTER(C.c_uint16)())
@@ -294,20 +375,41 @@ class PCOCamera:
             dll.allocate_buffer(self.camera_handle, buffer_number, self.bytes_per_image,\
                                 self.buffer_pointers[-1], buffer_event)
             assert buffer_number.value == i
+            self.buffer_events.append(buffer_event.value)
             self.logger.debug(' Buffer number '+str(i)+' allocated, pointing to '+str(self.buffer_pointers[-1].contents)+\
                               ', linked to event '+str(buffer_event.value))
         dll.set_image_parameters(self.camera_handle, self.width, self.height)
-        dll.set_recording_state(self.camera_handle, 1)
         self.armed = True
         self.logger.info(' Camera armed.')
 
+        self._dll_status = C.c_uint32()
+        self._driver_status = C.c_uint32()
+        self._image_datatype = C.c_uint16 * self.width * self.height
+        self._start_recording()
+        return None
+
+    def stop_recording(self):
+        """Stops recording but leaves the camera armed
+        
+        Removes the buffers from the driver queue without freeing them, so
+        that the next self.arm() with the same number of buffers is cheap.
+        Settings changes still require self.apply_settings() to disarm.
+        """
+        
+        if self._stream_thread is not None:
+            self.stop_stream()
+        dll.set_recording_state(self.camera_handle, 0)
+        dll.cancel_images(self.camera_handle)
+        self.added_buffers = []
+        return None
+
+    def _start_recording(self):
+    
+        dll.set_recording_state(self.camera_handle, 1)
         self.added_buffers = []
         for buf_num in range(len(self.buffer_pointers)):
             dll.add_buffer(self.camera_handle, 0, 0, buf_num, self.width, self.height, 16)
             self.added_buffers.append(buf_num)
-        self._dll_status = C.c_uint32()
-        self._driver_status = C.c_uint32()
-        self._image_datatype = C.c_uint16 * self.width * self.height
         return None
 
     def disarm(self):
@@ -318,6 +420,9 @@ class PCOCamera:
         
         if not hasattr(self, 'armed'):
             self.armed = False
+        if self._stream_thread is not None:
+            # The buffers are about to be freed
+            self.stop_stream()
         self.logger.info('Disarming camera...')
         dll.set_recording_state(self.camera_handle, 0)
         dll.cancel_images(self.camera_handle)
@@ -325,29 +430,48 @@ class PCOCamera:
             for buf in range(len(self.buffer_pointers)):
                 dll.free_buffer(self.camera_handle, buf)
             self.buffer_pointers = []
+            self.buffer_events = []
         self.armed = False
         self.logger.info('Camera disarmed.')
         return None
 
-    def get_images(self, num_images):
+    def get_images(self, num_images, out = None, timeout = 1.0):
         """Grabs images that were stored in the specified buffers
+        
+        Waits for each buffer in turn, blocking on its event (or polling its
+        status with backoff if it has none), and copies every image exactly
+        once into the output. Gives up at the first image that does not
+        arrive within the timeout, as a dropped trigger shifts all the
+        following images anyway.
                 
         Args:
-            num_images (int): Number of images that should be retrieved
-                               from the buffers. This has to be at least 
-                               equal to the number of allocated buffers.
+            num_images  (int): Number of images that should be retrieved
+                                from the buffers. This has to be at least 
+                                equal to the number of allocated buffers.
+            out    (np.array): Optional C-contiguous uint16 array of shape
+                                (num_images, height, width) to copy the images
+                                into. Allocated if not given.
+            timeout   (float): Seconds to wait for each image.
         
         Returns:
             out   (np.array): Array of shape (num_images, height, width)
-                               containing the images.
+                               containing the images. Entries of images
+                               that did not arrive are left untouched.
+            info      (dict): 'acquired', list of the indices of the images
+                               that arrived, 'times', time.time() at which
+                               each of them was found ready and 'missing',
+                               the number of images that did not arrive.
                                
         Raises:
             AssertError: Not enough buffers assigned.
         """
         
         if not self.armed: self.arm()
-        out = np.ones((num_images, self.height, self.width),
-                          dtype=np.uint16)
+        if out is None:
+            out = np.empty((num_images, self.height, self.width),
+                           dtype=np.uint16)
+        assert out.shape == (num_images, self.height, self.width) and out.dtype == np.uint16
+        assert out.flags['C_CONTIGUOUS']
         try:
             assert len(self.added_buffers) >= num_images
         except:
@@ -358,28 +482,230 @@ class PCOCamera:
         w = ' image'
         if num_images > 1: w = w + 's'
         self.logger.info('Acquiring ' + str(num_images) + w)
-        num_acquired = 0
+        info = {'acquired': [], 'times': [], 'missing': num_images}
         for which_im in range(num_images):
-            dll.get_buffer_status(self.camera_handle, self.added_buffers[0], self._dll_status,\
-                                  self._driver_status)
-
-            if self._dll_status.value == 0xc0008000: # If buffer event is set
-                buffer_number = self.added_buffers.pop(0)
-                self.logger.debug(' Buffer '+ str(buffer_number) +' is ready.')
-
-            try:
-                image = np.ctypeslib.as_array(self._image_datatype.from_address(C.addressof(self.buffer_pointers[buffer_number].contents)))
-                out[which_im, :, :] = image
-                num_acquired += 1
-            finally:
-                dll.add_buffer(self.camera_handle, 0, 0, buffer_number, self.width, self.height, 16)
-                self.added_buffers.append(buffer_number)
+            if not self._grab_next(out[which_im], timeout):
+                self.logger.error(' Image '+str(which_im)+' did not arrive within '+str(timeout)+'s (dll status '+\
+                                  hex(self._dll_status.value)+', driver status '+hex(self._driver_status.value)+')')
+                break
+            info['acquired'].append(which_im)
+            info['times'].append(time.time())
                 
+        num_acquired = len(info['acquired'])
+        info['missing'] = num_images - num_acquired
         w = ' image'
         if num_acquired > 1: w = w + 's'
         self.logger.info('Done acquiring ' + str(num_acquired) + w)
+        return out, info
+    
+    def start_stream(self, num_images = 16, timeout = 0.05, out = None):
+        """Starts copying images into a stack in the background as they arrive
+        
+        A background thread waits for the buffers in turn, copies each image
+        into a preallocated stack and hands the buffer straight back to the
+        camera. The number of images is therefore not limited by the number
+        of buffers, only by the camera frame rate. An allocated stack grows
+        (into a new array) if more images arrive than it holds. A given stack
+        never does: once it is full, the further images are only counted (see
+        self.stop_stream()), so that all the images stay in it.
+        
+        Args:
+            num_images  (int): Number of images expected, to size the stack.
+            timeout   (float): Seconds the thread waits for a buffer before
+                                checking whether it has to stop.
+            out    (np.array): Optional C-contiguous uint16 stack of shape
+                                (n, height, width) to copy the images into,
+                                e.g. memory-mapped. Allocated if not given.
+        """
+        
+        if not self.armed: self.arm()
+        if self._stream_thread is not None:
+            self.stop_stream()
+        self.logger.info('Streaming up to ' + str(num_images) + ' images')
+        self._stream_grows = out is None
+        if out is None:
+            out = np.empty((max(num_images, 1), self.height, self.width), dtype=np.uint16)
+        assert out.shape[1:] == (self.height, self.width) and out.dtype == np.uint16
+        assert out.flags['C_CONTIGUOUS'] and len(out)
+        self.stream_images = out
+        self.stream_times = []
+        self.stream_surplus = 0
+        self._stream_error = None
+        self._stream_stop = threading.Event()
+        self._stream_ready = threading.Condition()
+        self._stream_thread = threading.Thread(target=self._stream_loop, args=(timeout,))
+        self._stream_thread.daemon = True
+        self._stream_thread.start()
+        return None
+    
+    def stop_stream(self, num_images = None, timeout = 1.0):
+        """Stops the background copy started by self.start_stream()
+        
+        Args:
+            num_images  (int): If given, first wait up to timeout seconds
+                                for this many images.
+            timeout   (float): Seconds to wait for the images.
+            
+        Returns:
+            images (np.array): Array of shape (num_acquired, height, width)
+                                with the images in the order they arrived.
+            info       (dict): As returned by self.get_images(), 'missing'
+                                counts the images short of num_images,
+                                'surplus' the images that arrived after the
+                                stack given to self.start_stream() was full.
+        """
+        
+        if self._stream_thread is None:
+            return np.empty((0, self.height, self.width), dtype=np.uint16), \
+                   {'acquired': [], 'times': [], 'missing': num_images or 0, 'surplus': 0}
+        if num_images is not None:
+            self.wait_stream(num_images, timeout)
+        self._stream_stop.set()
+        self._stream_thread.join()
+        self._stream_thread = None
+        if self._stream_error is not None:
+            raise self._stream_error
+        
+        num_acquired = len(self.stream_times)
+        if num_images is None:
+            num_images = num_acquired
+        info = {'acquired': range(num_acquired),
+                'times': list(self.stream_times),
+                'missing': max(num_images - num_acquired, 0),
+                'surplus': self.stream_surplus}
+        if info['missing']:
+            self.logger.error(' Only '+str(num_acquired)+' of '+str(num_images)+' images arrived')
+        if info['surplus']:
+            self.logger.error(' '+str(info['surplus'])+' more images arrived than the stack holds')
+        self.logger.info('Done streaming ' + str(num_acquired) + ' images')
+        return self.stream_images[:num_acquired], info
+    
+    def wait_stream(self, num_images, timeout = 1.0):
+        """Waits for the stream started by self.start_stream() to hold num_images images
+        
+        Args:
+            num_images  (int): Number of images to wait for.
+            timeout   (float): Seconds to wait at most.
+        
+        Returns:
+            bool: True once the images are in, or if nothing is streaming.
+                  False after the timeout or an error of the stream.
+        """
+        
+        if self._stream_thread is None:
+            return True
+        deadline = time.time() + timeout
+        with self._stream_ready:
+            while len(self.stream_times) < num_images:
+                remaining = deadline - time.time()
+                if remaining <= 0 or self._stream_error is not None:
+                    return False
+                self._stream_ready.wait(remaining)
+        return True
+    
+    def grab_image(self, out = None, timeout = 1.0):
+        """Copies the next image into out, e.g. to follow a free-running camera
+        
+        The camera has to be armed and recording. Unlike self.get_images(),
+        the buffers are reused in turn, so the camera can run indefinitely.
+        
+        Args:
+            out    (np.array): Optional C-contiguous uint16 array of shape
+                                (height, width). Allocated if not given.
+            timeout   (float): Seconds to wait for the image.
+        
+        Returns:
+            out (np.array): The image, None if it did not arrive in time.
+        """
+        
+        if out is None:
+            out = np.empty((self.height, self.width), dtype=np.uint16)
+        assert out.shape == (self.height, self.width) and out.dtype == np.uint16
+        assert out.flags['C_CONTIGUOUS']
+        if not self._grab_next(out, timeout):
+            return None
         return out
     
+    def _stream_loop(self, timeout):
+        
+        # Receives the images that do not fit into a stack given by the caller
+        scratch = None
+        try:
+            while not self._stream_stop.is_set():
+                num_acquired = len(self.stream_times)
+                if num_acquired == len(self.stream_images) and not self._stream_grows:
+                    if scratch is None:
+                        scratch = np.empty((self.height, self.width), dtype=np.uint16)
+                    if self._grab_next(scratch, timeout, self._stream_stop):
+                        self.stream_surplus += 1
+                    continue
+                if num_acquired == len(self.stream_images):
+                    grown = np.empty((2 * num_acquired, self.height, self.width), dtype=np.uint16)
+                    grown[:num_acquired] = self.stream_images
+                    self.stream_images = grown
+                if self._grab_next(self.stream_images[num_acquired], timeout, self._stream_stop):
+                    with self._stream_ready:
+                        self.stream_times.append(time.time())
+                        self._stream_ready.notify_all()
+        except Exception as e:
+            self.logger.exception('Streaming stopped.')
+            with self._stream_ready:
+                self._stream_error = e
+                self._stream_ready.notify_all()
+        return None
+    
+    def _grab_next(self, out, timeout, stop = None):
+        """Copies the next image into out and hands its buffer back to the camera
+        
+        Returns:
+            bool: False if no image arrived within the timeout (or before stop
+                  was set, see self._wait_for_buffer()).
+        """
+        
+        buffer_number = self.added_buffers[0]
+        if not self._wait_for_buffer(buffer_number, timeout, stop):
+            return False
+        self.added_buffers.pop(0)
+        self.logger.debug(' Buffer '+ str(buffer_number) +' is ready.')
+        try:
+            C.memmove(out.ctypes.data, self.buffer_pointers[buffer_number], self.bytes_per_image)
+        finally:
+            dll.add_buffer(self.camera_handle, 0, 0, buffer_number, self.width, self.height, 16)
+            self.added_buffers.append(buffer_number)
+        return True
+    
+    def _wait_for_buffer(self, buffer_number, timeout, stop = None):
+        """Waits until a buffer holds an image
+        
+        Args:
+            stop (threading.Event): Optional, stop waiting once it is set. It
+                                     is checked every STOP_POLL_INTERVAL.
+        
+        Returns:
+            bool: True if the image is ready, False after the timeout or stop.
+        """
+        
+        deadline = time.time() + timeout
+        event = self.buffer_events[buffer_number] if buffer_number < len(self.buffer_events) else None
+        if event:
+            slice_ms = 1e3 * (timeout if stop is None else STOP_POLL_INTERVAL)
+            while not (stop is not None and stop.is_set()):
+                remaining = deadline - time.time()
+                if remaining <= 0 or \
+                   kernel32.WaitForSingleObject(event, int(min(1e3 * remaining, slice_ms))) == WAIT_OBJECT_0:
+                    break
+        delay = 1e-4
+        while True:
+            dll.get_buffer_status(self.camera_handle, buffer_number, self._dll_status,\
+                                  self._driver_status)
+            if self._dll_status.value & BUFFER_EVENT_SET:
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0 or (stop is not None and stop.is_set()):
+                return False
+            time.sleep(min(delay, remaining))
+            delay = min(2 * delay, 1e-2)
+    
     def _refresh_camera_setting_attributes(self):
     
         self.logger.info('Retrieving settings from camera...')
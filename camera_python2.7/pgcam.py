@@ -1,12 +1,52 @@
-import cv2
-import PyCapture2 as pc2
+import os
 import numpy as np
-import struct
 from time import sleep
 #import matplotlib
 #matplotlib.use('Qt4Agg')
 #from matplotlib import pyplot as pt
 
+pc2 = None
+
+def load_pycapture2():
+    """
+    Imports PyCapture2, only the first call does. unpackMono16() works without it.
+    Set the CAMERA_BACKEND environment variable to 'simulated' to run without
+    a camera (see simcams.py).
+    """
+    
+    global pc2
+    if pc2 is not None:
+        return
+    if os.environ.get('CAMERA_BACKEND') == 'simulated':
+        from simcams import PyCapture2
+    else:
+        import PyCapture2
+    pc2 = PyCapture2
+
+
+def unpackMono16(data, rows, cols, stride, out = None):
+    """
+    Views a raw MONO16 buffer as a 2D array of 16 bit pixels without copying it
+    
+    @data (array or buffer): raw little-endian image bytes, as from Image.getData()
+    @rows, cols (int): image size in pixels
+    @stride (int): bytes per row, including any padding
+    @out (2D array): if given, the pixels are copied into it
+    
+    returns the (rows, cols) pixels, a view on data unless out is given
+    """
+    
+    if isinstance(data, np.ndarray):
+        raw = data.reshape(-1).view(np.uint8)
+    else:
+        raw = np.frombuffer(data, dtype = np.uint8)
+    # Padded rows are skipped by slicing, which keeps this a view
+    pixels = raw[:rows*stride].view('<u2').reshape((rows, stride//2))[:, :cols]
+    if out is None:
+        return pixels
+    out[...] = pixels
+    return out
+
 
 class PointGreyCamera():  
     """
@@ -20,11 +60,14 @@ class PointGreyCamera():
         In case of multiple cameras, first figure out which one corresponds to which id
         """
 
+        load_pycapture2()
         # Retrieve the pgcam guid
         self.pgcam_id = camera_id
         self.bus = pc2.BusManager()
         
         self.pxmode = 'MONO16'
+        # ms, see setGrabMode
+        self.grab_timeout = 1
         self.modes  = {'MONO8': -2147483648, 'MONO12': 1048576, 'RAW12': 524288, 'MONO16': 67108864, 'RAW16': 2097152, 'RAW12': 524288}
         
         try:
@@ -84,6 +127,15 @@ class PointGreyCamera():
         
         self.pgcam.setFormat7Configuration(100.0, settngs)
 
+    def getImageShape(self):
+        """
+        Returns the (rows, cols) of the images, as set in the Format7 configuration
+        """
+        
+        settngs = self.pgcam.getFormat7Configuration()[0]
+        
+        return (settngs.height, settngs.width)
+
     def softwareTrigger(self):
         """
         Fires a software trigger to the camera (USB-mediated)
@@ -120,7 +172,7 @@ class PointGreyCamera():
         for attr, value in self.pgcam.getTriggerMode().__dict__.iteritems():
             print attr, value
         
-    def setGrabMode(self, mode = 1):
+    def setGrabMode(self, mode = 1, num_buffers = None, timeout = 1):
         """
         Configures the way the camera buffer is read when self.readBuffer() is called
     
@@ -128,10 +180,17 @@ class PointGreyCamera():
         = 0, drop every frame from the buffer and read the newest one
         = 1, grab the oldest frame then discard it, allowing to read the older ones
         = 2, unspecified mode, do not use
+        @num_buffers (int): number of host buffers, in mode 1 at least the
+        number of images of a sequence. Unchanged if None
+        @timeout (int): ms to wait for an image when retrieving one
         """
     
+        self.grab_timeout = timeout
         try:
-            self.pgcam.setConfiguration(config  =  None, grabMode = mode, grabTimeout = 1)
+            if num_buffers is None:
+                self.pgcam.setConfiguration(config  =  None, grabMode = mode, grabTimeout = timeout)
+            else:
+                self.pgcam.setConfiguration(config  =  None, numBuffers = num_buffers, grabMode = mode, grabTimeout = timeout)
         except:
             print("There was an error when setting the " + self.pgcam_info.modelName +\
             " buffer grab mode")
@@ -147,50 +206,76 @@ class PointGreyCamera():
         self.pgcam.setProperty(type = pc2.PROPERTY_TYPE.SHUTTER, absValue = t)
     
     
-    def grabImages(self, n_images):
+    def grabImage(self, out = None):
+        """
+        Retrieves the next image without any feedback, e.g. to follow the
+        free-running camera. Waits at most the grab timeout (see setGrabMode)
+        
+        @out (2D uint16 array): optional (rows, cols) array to fill
+        
+        returns a (rows, cols) uint16 numpy array, None if no image arrived
+        """
+        
+        try:
+            _image = self.pgcam.retrieveBuffer()
+        except pc2.Fc2error:
+            return None
+        return unpackMono16(_image.getData(), _image.getRows(), _image.getCols(), _image.getStride(), out)
+    
+    def grabSpareImage(self, out = None):
+        """
+        Retrieves an image already waiting in the host buffers, without
+        waiting for one, e.g. to check that no image arrived beyond those
+        of a sequence. Quiet if there is none
+        
+        @out (2D uint16 array): optional (rows, cols) array to fill
+        
+        returns a (rows, cols) uint16 numpy array, None if there was none
+        """
+        
+        timeout = self.grab_timeout
+        self.pgcam.setConfiguration(config = None, grabTimeout = 0)
+        try:
+            return self.grabImage(out)
+        finally:
+            self.pgcam.setConfiguration(config = None, grabTimeout = timeout)
+    
+    def grabImages(self, n_images, out = None):
         """
         Image retrieval method
         Call this one before stopping the acquisition
         
         @n_images (int): number of images one wishes to retrieve
         starting from the last image taken
+        @out (3D uint16 array): optional (n_images, rows, cols) array to
+        fill, allocated on the first image otherwise
         
-        returns an numpy array of 2D numpy arrays
+        returns a (n_retrieved, rows, cols) uint16 numpy array, stops at the
+        first image that does not arrive within the grab timeout
         """
         
-        self.images = []
+        n_retrieved = 0
         for _ in xrange(n_images):
             try:
                 _image = self.pgcam.retrieveBuffer()
             except pc2.Fc2error:
                 print("Error retrieving buffer")
-                continue
+                break
             else:
-                _img = _image
-                _imdat = np.array(_img.getData())
-                l = len(_imdat)
+                _rows = _image.getRows()
+                _cols = _image.getCols()
+                _stride = _image.getStride()
                 
-                _i1 = _imdat[::2]
-                _i2 = _imdat[1::2]
+                if out is None:
+                    out = np.empty((n_images, _rows, _cols), dtype = np.uint16)
                 
-                #_imd = np.array([struct.unpack('<H', _imdat[k:k+2])[0] & 0xffff\
-                #                 for k in range(0, len(_imdat), 2)])
-               
-                """              
-                #_imd2 = np.array([int('0'*(8-len(bin(_imdat[k+1])[2:]))+bin(_imdat[k+1])[2:]+'0'*(8-len(bin(_imdat[k])[2:]))+bin(_imdat[k])[2:],2)\
-                                # for k in range(0, len(_imdat), 2)])
-                """
-                
-                #_imd3 = np.array([_imdat[k]+256*_imdat[k+1] for k in range(0, l, 2)])
-                
-                _imd4 = _i1 + 256*_i2
-                
-                _rows = _img.getRows()
-                _cols = _img.getCols()
-                _stride = _img.getStride()
-
-                self.images.append(_imd4.reshape((_rows, _cols)))
+                # Single copy, straight from the camera buffer into the output
+                unpackMono16(_image.getData(), _rows, _cols, _stride, out[n_retrieved])
+                n_retrieved += 1
                 
-        print(self.pgcam_info.modelName + " successfully retrieved "+ str(n_images) + "images")
-        return np.array(self.images)
+        if out is None:
+            out = np.empty((0, 0, 0), dtype = np.uint16)
+        self.images = out[:n_retrieved]
+        print(self.pgcam_info.modelName + " successfully retrieved "+ str(n_retrieved) + "images")
+        return self.images
     
@@ -0,0 +1,178 @@
+"""Live preview of the cameras over zmq
+
+In manual mode a camera server can run its camera continuously and
+publish the frames on a zmq PUB socket, to check alignment and focus
+without running shots. The frames are cropped to a region of interest,
+decimated and published at a capped rate. Each frame is sent as a
+three part message, without pickling:
+
+  camera name | header | pixels
+
+The header is HEADER packed (little-endian): 'CPV1', the frame number,
+the time.time() of the frame, its rows and columns, the top and left
+of the region of interest on the sensor and the decimation step. The
+pixels are rows x cols little-endian uint16, row by row.
+
+  Typical usage example:
+
+  python preview.py tcp://lab-pc:1077            # print the frame rate
+  python preview.py tcp://lab-pc:1077 --show     # and show the frames
+"""
+
+import sys
+import time
+import struct
+import zmq
+import numpy as np
+
+MAGIC = 'CPV1'
+HEADER = struct.Struct('<4sIdHHHHH')
+
+
+def parse_options(args):
+    """
+    Parses the key=value options of a 'preview' request
+
+    Args:
+        args (list): Strings 'rate=<frames/s>', 'step=<decimation>' or
+                      'roi=<x>,<y>,<width>,<height>' (as the exposure rois
+                      of h5writer.crop_and_bin()).
+
+    Returns:
+        dict: Keyword arguments of PreviewPublisher.configure(), for the
+              options given.
+    """
+
+    options = {}
+    for arg in args:
+        key, _, value = arg.partition('=')
+        if key == 'rate':
+            options['max_rate'] = float(value)
+        elif key == 'step':
+            options['step'] = int(value)
+        elif key == 'roi':
+            options['roi'] = tuple(int(v) for v in value.split(','))
+            if len(options['roi']) != 4:
+                raise ValueError('roi=<x>,<y>,<width>,<height> expected, got %s' % arg)
+        else:
+            raise ValueError('unknown preview option: %s' % arg)
+    return options
+
+
+def pack_frame(image, frame_number, timestamp, roi=None, step=1):
+    """
+    Crops and decimates an image and packs it for publishing
+
+    Args:
+        image    (np.array): 2D image.
+        frame_number  (int): Frame counter of the preview.
+        timestamp   (float): time.time() of the frame.
+        roi         (tuple): (x, y, width, height) to crop to, None for all.
+        step          (int): Keep every step-th row and column.
+
+    Returns:
+        header (str), pixels (np.array): The header and a C-contiguous
+            little-endian uint16 copy of the pixels.
+    """
+
+    top, left = 0, 0
+    if roi is not None:
+        left, top, width, height = roi
+        image = image[top:top + height, left:left + width]
+    # Always a copy, the image may be a view on a camera buffer
+    pixels = np.array(image[::step, ::step], dtype='<u2', order='C')
+    header = HEADER.pack(MAGIC, frame_number & 0xFFFFFFFF, timestamp, pixels.shape[0], pixels.shape[1],
+                         top, left, step)
+    return header, pixels
+
+
+def unpack_frame(header, data):
+    """
+    Unpacks a frame packed by pack_frame()
+
+    Returns:
+        info (dict): 'frame_number', 'timestamp', 'top', 'left' and 'step'.
+        image (np.array): (rows, cols) uint16 view on data.
+    """
+
+    magic, frame_number, timestamp, rows, cols, top, left, step = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError('not a preview frame')
+    image = np.frombuffer(data, dtype='<u2').reshape((rows, cols))
+    info = {'frame_number': frame_number, 'timestamp': timestamp, 'top': top, 'left': left, 'step': step}
+    return info, image
+
+
+class PreviewPublisher(object):
+    """
+    Publishes preview frames on a zmq PUB socket at a capped rate.
+
+    Frames offered faster than max_rate are dropped, so the camera can run
+    at its own rate. A PUB socket never blocks on slow viewers.
+    """
+
+    def __init__(self, port, cam_name, max_rate=10., step=1, roi=None):
+        self.cam_name = cam_name
+        self.sock = zmq.Context.instance().socket(zmq.PUB)
+        self.sock.setsockopt(zmq.SNDHWM, 2)
+        self.sock.setsockopt(zmq.LINGER, 0)
+        self.sock.bind('tcp://*:%d' % port)
+        self.frame_number = 0
+        self.last_time = 0.
+        self.configure(max_rate, step, roi)
+
+    def configure(self, max_rate=10., step=1, roi=None):
+        """Sets the rate cap (frames/s), the decimation and the region of interest (None for all)."""
+        self.max_rate = max_rate
+        self.step = max(step, 1)
+        self.roi = roi
+
+    def publish(self, image):
+        """Publishes an image unless the last one was published too recently.
+
+        Returns:
+            bool: True if the image was published.
+        """
+        now = time.time()
+        if now - self.last_time < 1. / self.max_rate:
+            return False
+        self.last_time = now
+        self.frame_number += 1
+        header, pixels = pack_frame(image, self.frame_number, now, self.roi, self.step)
+        self.sock.send_multipart([self.cam_name, header, pixels], copy=False)
+        return True
+
+    def close(self):
+        self.sock.close()
+
+
+if __name__ == '__main__':
+    address = sys.argv[1]
+    show = '--show' in sys.argv
+    sock = zmq.Context.instance().socket(zmq.SUB)
+    sock.setsockopt(zmq.SUBSCRIBE, '')
+    sock.connect(address)
+    if show:
+        from matplotlib import pyplot as plt
+        plt.ion()
+        plot = None
+    n_frames, start_time = 0, time.time()
+    while True:
+        cam_name, header, data = sock.recv_multipart()
+        info, image = unpack_frame(header, data)
+        n_frames += 1
+        if time.time() - start_time >= 1:
+            print('%s: %.1f frames/s, %dx%d (step %d), mean %.1f, max %d, latency %.1f ms' %
+                  (cam_name, n_frames / (time.time() - start_time), image.shape[1], image.shape[0],
+                   info['step'], image.mean(), image.max(), 1e3 * (time.time() - info['timestamp'])))
+            n_frames, start_time = 0, time.time()
+        if show:
+            if plot is None or plot.get_array().shape != image.shape:
+                plt.clf()
+                plot = plt.imshow(image, cmap='gray')
+                plt.colorbar()
+            else:
+                plot.set_data(image)
+                plot.autoscale()
+            plt.title('%s, frame %d' % (cam_name, info['frame_number']))
+            plt.pause(0.001)
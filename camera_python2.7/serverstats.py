@@ -0,0 +1,83 @@
+"""Timings and counters of a camera server
+
+A camera server records how long each phase of its requests takes and
+counts frames, bytes and errors in a ServerStats object. Recording is a
+dictionary update under a lock, cheap enough for every shot. The summary
+is served as JSON by the 'stats' request of camera_server.GenericServer.
+
+  Typical usage example:
+
+  stats = ServerStats()
+  with stats.timer('readout'):
+      images = camera.get_images(3)
+  stats.count('frames_acquired', len(images))
+  print(stats.summary()['samples']['readout']['p50'])
+"""
+
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+
+
+class ServerStats(object):
+    """
+    Samples (e.g. durations in seconds) and counters of a server.
+
+    For every sample name, the number of samples, their total, the last
+    and largest one are kept, as well as the n_recent latest samples for
+    the percentiles.
+    """
+
+    def __init__(self, n_recent=100):
+        self.n_recent = n_recent
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.samples = {}
+        self.counters = {}
+
+    def record(self, name, value):
+        """Adds a sample."""
+        with self.lock:
+            sample = self.samples.get(name)
+            if sample is None:
+                sample = self.samples[name] = {'count': 0, 'total': 0., 'max': value,
+                                               'recent': deque(maxlen=self.n_recent)}
+            sample['count'] += 1
+            sample['total'] += value
+            sample['last'] = value
+            sample['max'] = max(sample['max'], value)
+            sample['recent'].append(value)
+
+    def count(self, name, n=1):
+        """Adds n to a counter."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def timer(self, name):
+        """Records the duration of the with block, also if it raises."""
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start_time)
+
+    def summary(self):
+        """Returns a JSON serializable summary of the samples and counters."""
+        with self.lock:
+            samples = dict((name, dict(sample, recent=list(sample['recent'])))
+                           for name, sample in self.samples.items())
+            counters = dict(self.counters)
+        summary = {}
+        for name, sample in samples.items():
+            summary[name] = {'count': sample['count'],
+                             'mean': sample['total'] / sample['count'],
+                             'last': sample['last'],
+                             'max': sample['max'],
+                             'p50': float(np.percentile(sample['recent'], 50)),
+                             'p90': float(np.percentile(sample['recent'], 90))}
+        return {'uptime': time.time() - self.start_time,
+                'counters': counters,
+                'samples': summary}
@@ -0,0 +1,870 @@
+"""Simulated camera backends
+
+Stand-ins for the vendor libraries behind hcam.py (DCAM, dcamapi.dll),
+pcoedge.py (SC2_Cam.dll) and pgcam.py (PyCapture2). They implement the
+calls these modules make, with the same argument passing (ctypes objects
+and byref()), and produce synthetic 16 bit frames. The camera modules
+use them instead of the vendor libraries when the CAMERA_BACKEND
+environment variable is 'simulated' at import, so that the servers and
+the acquisition paths can be run and profiled without any camera.
+
+A simulated camera in an external trigger mode only takes a frame when
+it is triggered while it acquires: at the configured trigger_times after
+each acquisition start, on trigger_all() (as the labscript sequence
+would) or on a software trigger. In its internal (free-running) trigger
+mode it takes frames at its frame rate, as for the live preview. The
+frame is ready latency seconds after its trigger. The first pixel of
+every frame holds its frame number (modulo 2**16).
+
+  Typical usage example:
+
+  os.environ['CAMERA_BACKEND'] = 'simulated'
+  import simcams
+  simcams.configure(latency = 0.002)
+  from pcoedge import PCOCamera
+  camera = PCOCamera()
+  camera.apply_settings(trigger = 'external_trigger', exposure_time = 200)
+  camera.arm(num_buffers = 4)
+  camera.start_stream(3)
+  simcams.trigger_all(3, period = 0.01)
+  images, info = camera.stop_stream(3)
+"""
+
+import time
+import weakref
+import threading
+import itertools
+import ctypes as C
+import numpy as np
+
+SETTINGS = {'latency': 0.0,            # seconds from a trigger to its frame being ready
+            'trigger_times': None,     # seconds after each acquisition start to trigger at
+            'seed': 0,                 # of the synthetic frames
+            'dcam_shape': (2048, 2048),
+            'pco_shape': (2048, 2048),
+            'pg_shape': (964, 1288),
+            'pg_row_padding': 0}       # bytes at the end of each PointGrey row
+
+SENSORS = weakref.WeakSet()
+
+
+def configure(**settings):
+    """Updates SETTINGS. The frame shapes apply to cameras opened afterwards."""
+
+    for name in settings:
+        if name not in SETTINGS:
+            raise ValueError('unknown simulation setting: %s' % name)
+    SETTINGS.update(settings)
+
+
+def trigger_all(n_triggers = 1, period = 0.0):
+    """Triggers every acquiring simulated camera n_triggers times, period seconds apart."""
+
+    for sensor in list(SENSORS):
+        for k in range(n_triggers):
+            sensor.trigger(k * period)
+
+
+_base_frames = {}
+
+def base_frame(shape):
+    """Returns the (cached) synthetic uint16 frame of a shape, a gaussian beam with noise.
+
+    The cameras make it when they start acquiring, not on their first frame.
+    """
+
+    key = (tuple(shape), SETTINGS['seed'])
+    if key not in _base_frames:
+        rng = np.random.RandomState(SETTINGS['seed'])
+        rows, cols = shape
+        y, x = np.ogrid[:rows, :cols]
+        beam = 3000. * np.exp(-((x - cols / 2.)**2 + (y - rows / 2.)**2) / (2 * (max(shape) / 4.)**2))
+        frame = 100 + beam + rng.randint(0, 32, size = shape)
+        _base_frames[key] = frame.astype(np.uint16)
+    return _base_frames[key]
+
+
+def write_frame(out, frame_number):
+    """Fills a (rows, cols) uint16 array with the synthetic frame number frame_number."""
+
+    out[...] = base_frame(out.shape)
+    out.flat[0] = frame_number & 0xFFFF
+
+
+def _obj(arg):
+    # The ctypes object behind a byref() argument
+    return getattr(arg, '_obj', arg)
+
+
+def _value(arg):
+    arg = _obj(arg)
+    return getattr(arg, 'value', arg)
+
+
+def _set(arg, value):
+    _obj(arg).value = value
+
+
+class SimulatedSensor(object):
+    """
+    Turns triggers into frames for a simulated camera.
+
+    deliver(frame_number) is called from a timer thread latency seconds
+    after each trigger, as long as the acquisition that was running when
+    the trigger came is still running. A free-running sensor triggers
+    itself every period seconds.
+    """
+
+    def __init__(self, deliver):
+        self.deliver = deliver
+        self.lock = threading.Lock()
+        self.running = False
+        self.acquisition = 0
+        self.frame_number = 0
+        self.period = None
+        SENSORS.add(self)
+
+    def start(self, period = None):
+        """Starts acquiring, free-running with a frame every period seconds if given."""
+        with self.lock:
+            self.running = True
+            self.acquisition += 1
+            self.period = period
+        if period is not None:
+            self.trigger()
+        elif SETTINGS['trigger_times'] is not None:
+            for trigger_time in SETTINGS['trigger_times']:
+                self.trigger(trigger_time)
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.acquisition += 1
+
+    def trigger(self, delay = 0.0):
+        timer = threading.Timer(delay + SETTINGS['latency'], self.fire, args = (self.acquisition,))
+        timer.daemon = True
+        timer.start()
+
+    def fire(self, acquisition):
+        with self.lock:
+            if not self.running or acquisition != self.acquisition:
+                return
+            self.frame_number += 1
+            self.deliver(self.frame_number)
+            if self.period is not None:
+                timer = threading.Timer(self.period, self.fire, args = (acquisition,))
+                timer.daemon = True
+                timer.start()
+
+
+class DllFunction(object):
+    """A callable that accepts the argtypes/restype attributes of a ctypes function."""
+
+    def __init__(self, function):
+        self.function = function
+        self.argtypes = None
+        self.restype = None
+
+    def __call__(self, *args):
+        return self.function(*args)
+
+
+class SimulatedDll(object):
+    """Exposes the methods named like the library functions as ctypes-like functions."""
+
+    prefix = ''
+
+    def __init__(self):
+        for name in dir(type(self)):
+            if name.startswith(self.prefix):
+                setattr(self, name, DllFunction(getattr(self, name)))
+
+
+# DCAM (hcam.py)
+
+DCAMERR_ERROR = 0
+DCAMERR_NOERROR = 1
+DCAMERR_TIMEOUT = 0x80000106
+DCAMERR_NOTWRITABLE = 0x80000A04
+DCAMERR_INVALIDPROPERTYID = 0x80000821
+
+DCAMPROP_TYPE_MODE = 0x00000001
+DCAMPROP_TYPE_LONG = 0x00000002
+DCAMPROP_TYPE_REAL = 0x00000003
+DCAMPROP_ATTR_HASVALUETEXT = 0x10000000
+DCAMPROP_ATTR_READABLE = 0x00010000
+DCAMPROP_ATTR_WRITABLE = 0x00020000
+DCAMPROP_OPTION_NEAREST = 0x80000000
+DCAMPROP_OPTION_NEXT = 0x01000000
+
+
+class SimulatedDcam(SimulatedDll):
+    """
+    Stand-in for dcamapi.dll with one ORCA-Flash4.0 like camera.
+
+    Property names, types and ranges follow the ORCA. The image size
+    follows the subarray and binning properties. Frames go round robin
+    into the frames allocated with dcam_allocframe() or the user buffers
+    given to dcam_attachbuffer(). dcam_wait() returns at once if a frame
+    arrived since the last wait, as the DCAM frame ready event is latched.
+    """
+
+    prefix = 'dcam_'
+    model = 'C13440-20CU'
+
+    # name, type, minimum, maximum, default, writable, texts
+    PROPERTIES = [('SENSOR MODE', DCAMPROP_TYPE_MODE, 1, 1, 1, True, {'AREA': 1}),
+                  ('TRIGGER SOURCE', DCAMPROP_TYPE_MODE, 1, 4, 1, True,
+                   {'INTERNAL': 1, 'EXTERNAL': 2, 'SOFTWARE': 3, 'MASTER PULSE': 4}),
+                  ('TRIGGER POLARITY', DCAMPROP_TYPE_MODE, 1, 2, 1, True, {'NEGATIVE': 1, 'POSITIVE': 2}),
+                  ('TRIGGER GLOBAL EXPOSURE', DCAMPROP_TYPE_MODE, 3, 5, 3, True, {'DELAYED': 3, 'GLOBAL RESET': 5}),
+                  ('EXPOSURE TIME', DCAMPROP_TYPE_REAL, 1e-6, 10., 0.01, True, {}),
+                  ('READOUT SPEED', DCAMPROP_TYPE_LONG, 1, 2, 2, True, {}),
+                  ('BINNING', DCAMPROP_TYPE_MODE, 1, 4, 1, True, {'1X1': 1, '2X2': 2, '4X4': 4}),
+                  ('SUBARRAY HPOS', DCAMPROP_TYPE_LONG, 0, 2044, 0, True, {}),
+                  ('SUBARRAY HSIZE', DCAMPROP_TYPE_LONG, 4, 2048, 2048, True, {}),
+                  ('SUBARRAY VPOS', DCAMPROP_TYPE_LONG, 0, 2044, 0, True, {}),
+                  ('SUBARRAY VSIZE', DCAMPROP_TYPE_LONG, 4, 2048, 2048, True, {}),
+                  ('SUBARRAY MODE', DCAMPROP_TYPE_MODE, 1, 2, 1, True, {'OFF': 1, 'ON': 2}),
+                  ('DEFECT CORRECT MODE', DCAMPROP_TYPE_MODE, 1, 2, 2, True, {'OFF': 1, 'ON': 2}),
+                  ('OUTPUT TRIGGER KIND[0]', DCAMPROP_TYPE_MODE, 1, 5, 1, True,
+                   {'LOW': 1, 'EXPOSURE': 2, 'PROGRAMABLE': 3, 'TRIGGER READY': 4, 'HIGH': 5}),
+                  ('INTERNAL FRAME RATE', DCAMPROP_TYPE_REAL, 0.1, 100., 100., False, {}),
+                  ('TIMING READOUT TIME', DCAMPROP_TYPE_REAL, 0.01, 0.01, 0.01, False, {}),
+                  ('IMAGE WIDTH', DCAMPROP_TYPE_LONG, 1, 2048, 2048, False, {}),
+                  ('IMAGE HEIGHT', DCAMPROP_TYPE_LONG, 1, 2048, 2048, False, {}),
+                  ('IMAGE ROWBYTES', DCAMPROP_TYPE_LONG, 2, 4096, 4096, False, {}),
+                  ('IMAGE FRAMEBYTES', DCAMPROP_TYPE_LONG, 2, 2048 * 4096, 2048 * 4096, False, {})]
+
+    def __init__(self):
+        SimulatedDll.__init__(self)
+        rows, cols = SETTINGS['dcam_shape']
+        self.lock = threading.Lock()
+        self.frame_ready = threading.Condition(self.lock)
+        self.properties = {}
+        self.names = {}
+        for k, (name, prop_type, minimum, maximum, default, writable, texts) in enumerate(self.PROPERTIES):
+            prop_id = 0x00100000 + 0x10 * k
+            if name in ('SUBARRAY HSIZE', 'IMAGE WIDTH'):
+                maximum = default = cols
+            elif name in ('SUBARRAY VSIZE', 'IMAGE HEIGHT'):
+                maximum = default = rows
+            elif name == 'SUBARRAY HPOS':
+                maximum = cols - 4
+            elif name == 'SUBARRAY VPOS':
+                maximum = rows - 4
+            self.properties[prop_id] = {'name': name, 'type': prop_type, 'min': minimum, 'max': maximum,
+                                        'value': float(default), 'writable': writable, 'texts': texts}
+            self.names[name] = prop_id
+        self.last_error = DCAMERR_NOERROR
+        self.trigger_mode = 1
+        self.frames = []
+        self.addresses = []
+        self.frame_count = 0
+        self.buffer_index = -1
+        self.event = False
+        self.sensor = SimulatedSensor(self.deliver)
+        self.update_image_size()
+
+    def value(self, name):
+        return self.properties[self.names[name]]['value']
+
+    def update_image_size(self):
+        binning = int(self.value('BINNING'))
+        if self.value('SUBARRAY MODE') == 2:
+            width, height = self.value('SUBARRAY HSIZE'), self.value('SUBARRAY VSIZE')
+        else:
+            height, width = SETTINGS['dcam_shape']
+        width, height = int(width) // binning, int(height) // binning
+        for name, value in (('IMAGE WIDTH', width), ('IMAGE HEIGHT', height),
+                            ('IMAGE ROWBYTES', 2 * width), ('IMAGE FRAMEBYTES', 2 * width * height)):
+            self.properties[self.names[name]]['value'] = float(value)
+
+    def error(self, code):
+        self.last_error = code
+        return DCAMERR_ERROR
+
+    def deliver(self, frame_number):
+        # Called with the sensor lock held
+        with self.lock:
+            if not self.addresses:
+                return
+            index = self.frame_count % len(self.addresses)
+            rows, cols = int(self.value('IMAGE HEIGHT')), int(self.value('IMAGE WIDTH'))
+            frame = np.ctypeslib.as_array((C.c_uint16 * (rows * cols)).from_address(self.addresses[index]))
+            write_frame(frame.reshape((rows, cols)), frame_number)
+            self.frame_count += 1
+            self.buffer_index = index
+            self.event = True
+            self.frame_ready.notify_all()
+
+    # Initialisation
+
+    def dcam_init(self, instance, count, reserved):
+        _set(count, 1)
+        return DCAMERR_NOERROR
+
+    def dcam_open(self, handle, index, reserved):
+        _set(handle, 1)
+        return DCAMERR_NOERROR
+
+    def dcam_close(self, handle):
+        self.sensor.stop()
+        return DCAMERR_NOERROR
+
+    def dcam_getmodelinfo(self, index, string_id, buf, buf_len):
+        buf.value = self.model[:_value(buf_len) - 1]
+        return DCAMERR_NOERROR
+
+    def dcam_getlasterror(self, handle, buf, buf_len):
+        if buf is not None:
+            buf.value = ('error 0x%08x' % self.last_error)[:_value(buf_len) - 1]
+        return self.last_error
+
+    # Properties
+
+    def dcam_getnextpropertyid(self, handle, prop_id, option):
+        current = _value(prop_id)
+        if _value(option) & DCAMPROP_OPTION_NEAREST:
+            ids = [k for k in self.properties if k >= current]
+        else:
+            ids = [k for k in self.properties if k > current]
+        if not ids:
+            return DCAMERR_ERROR
+        _set(prop_id, min(ids))
+        return DCAMERR_NOERROR
+
+    def dcam_getpropertyname(self, handle, prop_id, buf, buf_len):
+        prop = self.properties.get(_value(prop_id))
+        if prop is None:
+            return self.error(DCAMERR_INVALIDPROPERTYID)
+        buf.value = prop['name'][:_value(buf_len) - 1]
+        return DCAMERR_NOERROR
+
+    def dcam_getpropertyattr(self, handle, attr):
+        attr = _obj(attr)
+        prop = self.properties.get(attr.iProp)
+        if prop is None:
+            return self.error(DCAMERR_INVALIDPROPERTYID)
+        attr.attribute = prop['type'] | DCAMPROP_ATTR_READABLE
+        if prop['writable']:
+            attr.attribute |= DCAMPROP_ATTR_WRITABLE
+        if prop['texts']:
+            attr.attribute |= DCAMPROP_ATTR_HASVALUETEXT
+        attr.valuemin = prop['min']
+        attr.valuemax = prop['max']
+        attr.valuestep = 0. if prop['type'] == DCAMPROP_TYPE_REAL else 1.
+        attr.valuedefault = prop['value']
+        return DCAMERR_NOERROR
+
+    def dcam_getpropertyvaluetext(self, handle, prop_text):
+        prop_text = _obj(prop_text)
+        prop = self.properties.get(prop_text.iProp)
+        if prop is None:
+            return self.error(DCAMERR_INVALIDPROPERTYID)
+        names = dict((value, name) for name, value in prop['texts'].items())
+        text = names.get(int(prop_text.value), '')[:prop_text.textbytes - 1] + '\0'
+        address = C.c_void_p.from_buffer(prop_text, type(prop_text).text.offset).value
+        C.memmove(address, text, len(text))
+        return DCAMERR_NOERROR
+
+    def dcam_querypropertyvalue(self, handle, prop_id, value, option):
+        prop = self.properties.get(_value(prop_id))
+        if prop is None:
+            return self.error(DCAMERR_INVALIDPROPERTYID)
+        following = [v for v in prop['texts'].values() if v > _value(value)]
+        if not following:
+            return DCAMERR_ERROR
+        _set(value, min(following))
+        return DCAMERR_NOERROR
+
+    def dcam_getpropertyvalue(self, handle, prop_id, value):
+        prop = self.properties.get(_value(prop_id))
+        if prop is None:
+            return self.error(DCAMERR_INVALIDPROPERTYID)
+        _set(value, prop['value'])
+        return DCAMERR_NOERROR
+
+    def dcam_setgetpropertyvalue(self, handle, prop_id, value, option):
+        prop = self.properties.get(_value(prop_id))
+        if prop is None:
+            return self.error(DCAMERR_INVALIDPROPERTYID)
+        if not prop['writable']:
+            return self.error(DCAMERR_NOTWRITABLE)
+        new_value = min(max(_value(value), prop['min']), prop['max'])
+        if prop['type'] != DCAMPROP_TYPE_REAL:
+            new_value = float(int(round(new_value)))
+            if prop['texts'] and new_value not in prop['texts'].values():
+                return self.error(DCAMERR_NOTWRITABLE)
+        prop['value'] = new_value
+        self.update_image_size()
+        _set(value, new_value)
+        return DCAMERR_NOERROR
+
+    # Triggers
+
+    def dcam_settriggermode(self, handle, mode):
+        self.trigger_mode = _value(mode)
+        return DCAMERR_NOERROR
+
+    def dcam_gettriggermode(self, handle, mode):
+        _set(mode, self.trigger_mode)
+        return DCAMERR_NOERROR
+
+    def dcam_firetrigger(self, handle):
+        self.sensor.trigger()
+        return DCAMERR_NOERROR
+
+    # Acquisition
+
+    def dcam_precapture(self, handle, mode):
+        return DCAMERR_NOERROR
+
+    def dcam_allocframe(self, handle, n_frames):
+        frame_bytes = int(self.value('IMAGE FRAMEBYTES'))
+        self.frames = [np.empty(frame_bytes // 2, dtype = np.uint16) for _ in range(_value(n_frames))]
+        self.addresses = [frame.ctypes.data for frame in self.frames]
+        return DCAMERR_NOERROR
+
+    def dcam_freeframe(self, handle):
+        self.frames = []
+        self.addresses = []
+        return DCAMERR_NOERROR
+
+    def dcam_attachbuffer(self, handle, pointers, size):
+        self.addresses = [pointers[k] for k in range(_value(size) // C.sizeof(C.c_void_p))]
+        return DCAMERR_NOERROR
+
+    def dcam_releasebuffer(self, handle):
+        self.addresses = []
+        return DCAMERR_NOERROR
+
+    def dcam_capture(self, handle):
+        with self.lock:
+            self.frame_count = 0
+            self.buffer_index = -1
+            self.event = False
+        base_frame((int(self.value('IMAGE HEIGHT')), int(self.value('IMAGE WIDTH'))))
+        period = None
+        if self.value('TRIGGER SOURCE') == 1: # INTERNAL
+            period = max(1. / self.value('INTERNAL FRAME RATE'), self.value('EXPOSURE TIME'))
+        self.sensor.start(period)
+        return DCAMERR_NOERROR
+
+    def dcam_idle(self, handle):
+        self.sensor.stop()
+        return DCAMERR_NOERROR
+
+    def dcam_wait(self, handle, event, timeout_ms, reserved):
+        timeout_ms = _value(timeout_ms)
+        deadline = None if timeout_ms & 0x80000000 else time.time() + timeout_ms / 1e3
+        with self.lock:
+            while not self.event:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return self.error(DCAMERR_TIMEOUT)
+                self.frame_ready.wait(remaining)
+            self.event = False
+        return DCAMERR_NOERROR
+
+    def dcam_gettransferinfo(self, handle, buffer_index, frame_count):
+        with self.lock:
+            _set(buffer_index, self.buffer_index)
+            _set(frame_count, self.frame_count)
+        return DCAMERR_NOERROR
+
+    def dcam_lockdata(self, handle, address, row_bytes, frame):
+        _set(address, self.addresses[_value(frame)])
+        _set(row_bytes, int(self.value('IMAGE ROWBYTES')))
+        return DCAMERR_NOERROR
+
+    def dcam_unlockdata(self, handle):
+        return DCAMERR_NOERROR
+
+
+# SC2_Cam (pcoedge.py)
+
+BUFFER_EVENT_SET = 0x00008000
+WAIT_OBJECT_0 = 0x00000000
+WAIT_TIMEOUT = 0x00000102
+
+_events = {}
+_event_handles = itertools.count(1)
+
+
+class SimulatedKernel32(SimulatedDll):
+    """Stand-in for the kernel32 calls on the buffer events of SimulatedSC2Cam."""
+
+    prefix = 'WaitForSingleObject'
+
+    def WaitForSingleObject(self, handle, timeout_ms):
+        event = _events.get(_value(handle))
+        if event is None or not event.wait(_value(timeout_ms) / 1e3):
+            return WAIT_TIMEOUT
+        return WAIT_OBJECT_0
+
+
+class SimulatedSC2Cam(SimulatedDll):
+    """
+    Stand-in for SC2_Cam.dll with one pco.edge 4.2 like camera.
+
+    While recording, each frame goes into the oldest buffer queued with
+    PCO_AddBufferEx, whose status then has BUFFER_EVENT_SET and whose
+    event is set. Frames that find no queued buffer are dropped.
+    """
+
+    prefix = 'PCO_'
+
+    def __init__(self):
+        SimulatedDll.__init__(self)
+        rows, cols = SETTINGS['pco_shape']
+        self.shape = (rows, cols)
+        self.lock = threading.Lock()
+        self.trigger_mode = 0
+        self.polarity = 4
+        self.delay = (0, 0)
+        self.exposure = (10, 2) # 10 ms
+        self.roi = (1, 1, cols, rows)
+        self.size = (cols, rows)
+        self.recording = False
+        self.buffers = {}
+        self.queue = []
+        self.dropped = 0
+        self.sensor = SimulatedSensor(self.deliver)
+
+    def deliver(self, frame_number):
+        with self.lock:
+            if not self.recording or not self.queue:
+                self.dropped += 1
+                return
+            buffer_number = self.queue.pop(0)
+            frame, event, status = self.buffers[buffer_number]
+            cols, rows = self.size
+            write_frame(frame[:rows * cols].reshape((rows, cols)), frame_number)
+            self.buffers[buffer_number] = (frame, event, BUFFER_EVENT_SET)
+            _events[event].set()
+
+    def PCO_OpenCamera(self, handle, index):
+        _set(handle, 1)
+
+    def PCO_CloseCamera(self, handle):
+        self.sensor.stop()
+
+    def PCO_ResetSettingsToDefault(self, handle):
+        pass
+
+    def PCO_ArmCamera(self, handle):
+        left, top, right, bottom = self.roi
+        self.size = (right - left + 1, bottom - top + 1)
+        base_frame((self.size[1], self.size[0]))
+
+    def PCO_GetSizes(self, handle, x_res, y_res, x_res_max, y_res_max):
+        _set(x_res, self.size[0])
+        _set(y_res, self.size[1])
+        _set(x_res_max, self.shape[1])
+        _set(y_res_max, self.shape[0])
+
+    def PCO_GetSensorFormat(self, handle, sensor_format):
+        _set(sensor_format, 0)
+
+    def PCO_GetCameraHealthStatus(self, handle, warnings, errors, status):
+        for arg in (warnings, errors, status):
+            _set(arg, 0)
+
+    def PCO_GetCameraName(self, handle, buf, buf_len):
+        buf.value = 'pco.edge 4.2 (simulated)'[:_value(buf_len) - 1]
+
+    def PCO_GetTemperature(self, handle, ccd_temp, camera_temp, power_temp):
+        _set(ccd_temp, 75)
+        _set(camera_temp, 35)
+        _set(power_temp, 30)
+
+    def PCO_GetTriggerMode(self, handle, mode):
+        _set(mode, self.trigger_mode)
+
+    def PCO_SetTriggerMode(self, handle, mode):
+        self.trigger_mode = _value(mode)
+
+    def PCO_GetHWIOSignal(self, handle, line, signal):
+        _obj(signal).wPolarity = self.polarity
+
+    def PCO_SetHWIOSignal(self, handle, line, signal):
+        signal = _obj(signal)
+        self.polarity = getattr(signal, 'wPolarity', getattr(signal, 'value', self.polarity))
+
+    def PCO_GetHWIOSignalCount(self, handle, count):
+        _set(count, 4)
+
+    def PCO_GetDelayExposureTime(self, handle, delay, exposure, delay_base, exposure_base):
+        _set(delay, self.delay[0])
+        _set(exposure, self.exposure[0])
+        _set(delay_base, self.delay[1])
+        _set(exposure_base, self.exposure[1])
+
+    def PCO_SetDelayExposureTime(self, handle, delay, exposure, delay_base, exposure_base):
+        self.delay = (_value(delay), _value(delay_base))
+        self.exposure = (_value(exposure), _value(exposure_base))
+
+    def PCO_GetROI(self, handle, left, top, right, bottom):
+        for arg, value in zip((left, top, right, bottom), self.roi):
+            _set(arg, value)
+
+    def PCO_SetROI(self, handle, left, top, right, bottom):
+        self.roi = tuple(_value(arg) for arg in (left, top, right, bottom))
+
+    def PCO_CamLinkSetImageParameters(self, handle, width, height):
+        pass
+
+    def PCO_AllocateBuffer(self, handle, buffer_number, size, pointer, event):
+        with self.lock:
+            number = _value(buffer_number)
+            if number < 0:
+                number = min(set(range(len(self.buffers) + 1)) - set(self.buffers))
+            frame = np.empty(_value(size) // 2, dtype = np.uint16)
+            handle = next(_event_handles)
+            _events[handle] = threading.Event()
+            self.buffers[number] = (frame, handle, 0)
+        _set(buffer_number, number)
+        _obj(pointer).contents = C.c_uint16.from_address(frame.ctypes.data)
+        _set(event, handle)
+
+    def PCO_FreeBuffer(self, handle, buffer_number):
+        with self.lock:
+            frame, event, status = self.buffers.pop(_value(buffer_number))
+            _events.pop(event, None)
+            if _value(buffer_number) in self.queue:
+                self.queue.remove(_value(buffer_number))
+
+    def PCO_AddBufferEx(self, handle, first, last, buffer_number, width, height, bits):
+        with self.lock:
+            frame, event, status = self.buffers[_value(buffer_number)]
+            self.buffers[_value(buffer_number)] = (frame, event, 0)
+            _events[event].clear()
+            self.queue.append(_value(buffer_number))
+
+    def PCO_GetBufferStatus(self, handle, buffer_number, dll_status, driver_status):
+        with self.lock:
+            frame, event, status = self.buffers[_value(buffer_number)]
+        _set(dll_status, 0xc0000000 | status)
+        _set(driver_status, 0)
+
+    def PCO_RemoveBuffer(self, handle):
+        with self.lock:
+            self.queue = []
+
+    def PCO_CancelImages(self, handle):
+        with self.lock:
+            self.queue = []
+
+    def PCO_SetRecordingState(self, handle, state):
+        with self.lock:
+            self.recording = bool(_value(state))
+        if self.recording:
+            period = None
+            if self.trigger_mode == 0: # auto trigger
+                exposure, base = self.exposure
+                period = max(exposure * 10**(3 * base - 9), 0.01)
+            self.sensor.start(period)
+        else:
+            self.sensor.stop()
+
+
+# PyCapture2 (pgcam.py)
+
+class PyCapture2(object):
+    """
+    Stand-in for the PyCapture2 module with one Chameleon3 like camera.
+
+    Frames wait in up to numBuffers host buffers until retrieveBuffer().
+    In grab mode 1 (BUFFER_FRAMES) frames that find all buffers full are
+    dropped, in grab mode 0 (DROP_FRAMES) only the newest frame is kept.
+    """
+
+    class Fc2error(Exception):
+        pass
+
+    class PROPERTY_TYPE(object):
+        SHUTTER = 12
+
+    class CameraInfo(object):
+        modelName = 'Chameleon3 CM3-U3-13S2M (simulated)'
+        serialNumber = 12345678
+
+    class Format7ImageSettings(object):
+        def __init__(self, rows, cols):
+            self.mode = 0
+            self.offsetX = 0
+            self.offsetY = 0
+            self.width = cols
+            self.height = rows
+            self.pixelFormat = -2147483648 # MONO8
+
+    class TriggerMode(object):
+        def __init__(self, onOff = False, polarity = 0, source = 0, mode = 0, parameter = 0):
+            self.onOff = onOff
+            self.polarity = polarity
+            self.source = source
+            self.mode = mode
+            self.parameter = parameter
+
+    class Image(object):
+        def __init__(self, data, rows, cols, stride):
+            self.data = data
+            self.rows = rows
+            self.cols = cols
+            self.stride = stride
+
+        def getData(self):
+            return self.data
+
+        def getRows(self):
+            return self.rows
+
+        def getCols(self):
+            return self.cols
+
+        def getStride(self):
+            return self.stride
+
+    class BusManager(object):
+        def getCameraFromIndex(self, index):
+            if index != 0:
+                raise PyCapture2.Fc2error('no camera with index %d' % index)
+            return index
+
+    class Camera(object):
+        def __init__(self):
+            rows, cols = SETTINGS['pg_shape']
+            self.format7 = PyCapture2.Format7ImageSettings(rows, cols)
+            self.stride = 2 * cols + SETTINGS['pg_row_padding']
+            self.trigger_mode = PyCapture2.TriggerMode()
+            self.num_buffers = 10
+            self.grab_mode = 1
+            self.grab_timeout = 1
+            self.shutter = 10.
+            self.lock = threading.Lock()
+            self.image_ready = threading.Condition(self.lock)
+            self.images = []
+            self.sensor = SimulatedSensor(self.deliver)
+
+        def deliver(self, frame_number):
+            rows, cols = self.format7.height, self.format7.width
+            data = np.zeros(rows * self.stride, dtype = np.uint8)
+            pixels = data.view('<u2').reshape((rows, self.stride // 2))[:, :cols]
+            write_frame(pixels, frame_number)
+            with self.lock:
+                if self.grab_mode == 0:
+                    self.images = []
+                if len(self.images) >= self.num_buffers:
+                    return
+                self.images.append(PyCapture2.Image(data, rows, cols, self.stride))
+                self.image_ready.notify_all()
+
+        def connect(self, guid):
+            pass
+
+        def getCameraInfo(self):
+            return PyCapture2.CameraInfo()
+
+        def getFormat7Configuration(self):
+            return self.format7, 1024, 100.0
+
+        def setFormat7Configuration(self, percent, settings):
+            self.format7 = settings
+
+        def setTriggerMode(self, onOff = False, polarity = 0, source = 0, mode = 0, parameter = 0):
+            self.trigger_mode = PyCapture2.TriggerMode(onOff, polarity, source, mode, parameter)
+
+        def getTriggerMode(self):
+            return self.trigger_mode
+
+        def fireSoftwareTrigger(self):
+            self.sensor.trigger()
+
+        def setConfiguration(self, config = None, numBuffers = None, grabMode = None, grabTimeout = None, **kwargs):
+            if numBuffers is not None:
+                self.num_buffers = numBuffers
+            if grabMode is not None:
+                self.grab_mode = grabMode
+            if grabTimeout is not None:
+                self.grab_timeout = grabTimeout
+
+        def setProperty(self, type = None, absValue = None, **kwargs):
+            if type == PyCapture2.PROPERTY_TYPE.SHUTTER:
+                self.shutter = absValue
+
+        def startCapture(self):
+            # As the SDK, which refuses to start the isochronous transfer twice
+            if self.sensor.running:
+                raise PyCapture2.Fc2error('isoch already started')
+            with self.lock:
+                self.images = []
+            base_frame((self.format7.height, self.format7.width))
+            period = None
+            if not self.trigger_mode.onOff:
+                period = max(self.shutter / 1e3, 1 / 30.)
+            self.sensor.start(period)
+
+        def stopCapture(self):
+            self.sensor.stop()
+            with self.lock:
+                self.images = []
+
+        def retrieveBuffer(self):
+            deadline = time.time() + self.grab_timeout / 1e3
+            with self.lock:
+                while not self.images:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PyCapture2.Fc2error('timeout')
+                    self.image_ready.wait(remaining)
+                return self.images.pop(0)
+
+
+if __name__ == '__main__':
+    # Quick check that the simulated backends work with the camera modules
+    import os
+    os.environ['CAMERA_BACKEND'] = 'simulated'
+    # The camera modules share the imported module, not this script
+    import simcams
+    simcams.configure(latency = 0.001)
+    n_images = 5
+
+    from hcam import HamamatsuCameraMR
+    hcam = HamamatsuCameraMR(0)
+    hcam.setPropertyValue('trigger_source', 2) # external
+    hcam.startAcquisition(n_images)
+    simcams.trigger_all(n_images, period = 0.005)
+    frames = []
+    while len(frames) < n_images:
+        new_frames, dims = hcam.getFrames(timeout = 1.0)
+        if not new_frames:
+            break
+        frames += new_frames
+    hcam.stopAcquisition()
+    print('hcam: %d frames of %dx%d, numbers %s' % (len(frames), dims[0], dims[1],
+          [int(frame.getImage()[0, 0]) for frame in frames]))
+    hcam.releaseFrames(frames)
+
+    from pcoedge import PCOCamera
+    pcoecam = PCOCamera()
+    pcoecam.apply_settings(trigger = 'external_trigger', exposure_time = 200,
+                           roi = {'left': 800, 'right': 1400, 'top': 750, 'bottom': 1300})
+    pcoecam.arm(num_buffers = 2)
+    pcoecam.start_stream(n_images)
+    simcams.trigger_all(n_images, period = 0.005)
+    images, info = pcoecam.stop_stream(n_images)
+    pcoecam.close()
+    print('pco.edge: %d images of shape %s, numbers %s' % (len(images), images.shape[1:], list(images[:, 0, 0])))
+
+    from pgcam import PointGreyCamera
+    pgcam = PointGreyCamera(0)
+    pgcam.setTriggerMode(trig = True)
+    pgcam.setGrabMode(mode = 1, num_buffers = n_images + 1)
+    pgcam.startAcquisition()
+    simcams.trigger_all(n_images, period = 0.005)
+    time.sleep(0.1)
+    images = pgcam.grabImages(n_images + 1)
+    pgcam.stopAcquisition()
+    print('PointGrey: %d images of shape %s, numbers %s' % (len(images), images.shape[1:], list(images[:, 0, 0])))
@@ -0,0 +1,263 @@
+"""Memory-mapped spool of the raw frames of the camera servers
+
+With a spool directory configured (spool_dir in camera_servers.ini), a
+camera server acquires the frames of each shot straight into a
+memory-mapped spool file on a local disk, and the writer thread copies
+them from there into the shot file. The frames survive a crash of the
+server or a failed write (e.g. an h5 lock timeout), and they do not
+count against the memory of the server.
+
+Every spool file holds one shot:
+
+  HEADER      'CSPL', version, state, frame slots, frames acquired, rows,
+              columns, dtype, shot file and camera name
+  FRAME       for each frame slot: exposure name, frametype and the
+              (x, y, width, height, binning) of the exposure
+  frames      from the next page boundary, (slots, rows, cols) of dtype
+
+The state goes from ACQUIRING to READY once all the frames of the shot
+are in, and to WRITTEN once they are in the shot file. Each camera uses
+its spool files in turn, and never reuses one whose frames were not
+written. Headers are updated after the frames, so a spool file is
+consistent whenever the server process stops (not after a power cut,
+the files are not synced).
+
+  Typical usage example:
+
+  python spool.py C:\\camera_spool               # list the spooled shots
+  python spool.py C:\\camera_spool --recover     # write the unwritten ones
+"""
+
+import os
+import sys
+import glob
+import struct
+import argparse
+import numpy as np
+
+MAGIC = 'CSPL'
+VERSION = 1
+EMPTY, ACQUIRING, READY, WRITTEN = 0, 1, 2, 3
+STATES = {EMPTY: 'empty', ACQUIRING: 'acquiring', READY: 'ready', WRITTEN: 'written'}
+
+# Longest shot file path and camera, exposure or frametype name a spool file holds
+PATH_SIZE = 1024
+NAME_SIZE = 64
+HEADER = struct.Struct('<4sHHIIII8s%ds%ds' % (PATH_SIZE, NAME_SIZE))
+FRAME = struct.Struct('<%ds%ds5i' % (NAME_SIZE, NAME_SIZE))
+PAGE_SIZE = 4096
+
+# Offsets of the header fields updated during a shot
+STATE_OFFSET = 6
+N_VALID_OFFSET = 12
+
+
+def check_length(what, value, size):
+    """Raises a ValueError if value does not fit the size bytes of its spool file field,
+    which would silently cut it short."""
+    if len(value) > size:
+        raise ValueError('%s of %d bytes is longer than the %d bytes a spool file holds: %s'
+                         % (what, len(value), size, value))
+
+
+def data_offset(n_frames):
+    """Offset of the frames in a spool file, the header and frame table rounded up to a page."""
+    return -(-(HEADER.size + n_frames * FRAME.size) // PAGE_SIZE) * PAGE_SIZE
+
+
+class SpoolFile(object):
+    """
+    A spool file, holding the frames of one shot.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mmap = None
+        self.n_frames = 0
+
+    def state(self):
+        """Returns the state in the header, EMPTY if the file does not exist yet."""
+        if self.mmap is not None:
+            return struct.unpack_from('<H', self.mmap, STATE_OFFSET)[0]
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < HEADER.size:
+            return EMPTY
+        with open(self.path, 'rb') as f:
+            return struct.unpack_from('<H', f.read(HEADER.size), STATE_OFFSET)[0]
+
+    def create(self, h5_filepath, cam_name, n_frames, shape, dtype, image_names, frametypes=None, rois=None):
+        """
+        Starts the spool of a shot.
+
+        Args:
+            h5_filepath  (str): Shot file the frames are for.
+            cam_name     (str): Camera, the frames go to data/<cam_name>.
+            n_frames     (int): Number of frame slots.
+            shape      (tuple): (rows, cols) of the frames.
+            dtype:              numpy dtype of the frames.
+            image_names (list): Exposure name of each frame.
+            frametypes  (list): Frametype of each frame, optional.
+            rois        (list): (x, y, width, height, binning) of each frame, optional.
+
+        Returns:
+            np.array: (n_frames, rows, cols) array mapped on the file, to acquire the frames into.
+
+        Raises:
+            ValueError: If the shot file path or a name is too long for the file.
+        """
+
+        check_length('shot file', h5_filepath, PATH_SIZE)
+        check_length('camera name', cam_name, NAME_SIZE)
+        for name in image_names:
+            check_length('exposure name', name, NAME_SIZE)
+        for frametype in frametypes or []:
+            check_length('frametype', frametype, NAME_SIZE)
+        dtype = np.dtype(dtype)
+        rows, cols = shape
+        offset = data_offset(n_frames)
+        size = offset + n_frames * rows * cols * dtype.itemsize
+        # The file only grows, so that the same shots map the same pages
+        if self.mmap is None or len(self.mmap) < size:
+            self.mmap = None
+            with open(self.path, 'r+b' if os.path.exists(self.path) else 'w+b') as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() < size:
+                    f.truncate(size)
+            self.mmap = np.memmap(self.path, dtype=np.uint8, mode='r+')
+        self.n_frames = n_frames
+        self._write(0, HEADER.pack(MAGIC, VERSION, EMPTY, n_frames, 0, rows, cols, dtype.str,
+                                   h5_filepath, cam_name))
+        for k in range(n_frames):
+            name = image_names[k] if k < len(image_names) else ''
+            frametype = frametypes[k] if frametypes is not None and k < len(frametypes) else ''
+            roi = rois[k] if rois is not None and k < len(rois) else (0, 0, 0, 0, 1)
+            self._write(HEADER.size + k * FRAME.size, FRAME.pack(name, frametype, *roi))
+        self.set_state(ACQUIRING)
+        return self.mmap[offset:size].view(dtype).reshape((n_frames, rows, cols))
+
+    def commit(self, n_valid, state=None):
+        """Records that the first n_valid frames were acquired, and optionally a new state."""
+        self._write(N_VALID_OFFSET, struct.pack('<I', min(n_valid, self.n_frames)))
+        if state is not None:
+            self.set_state(state)
+
+    def set_state(self, state):
+        self._write(STATE_OFFSET, struct.pack('<H', state))
+
+    def _write(self, offset, data):
+        self.mmap[offset:offset + len(data)] = np.frombuffer(data, dtype=np.uint8)
+
+
+class Spool(object):
+    """
+    The spool files of a camera, used in turn.
+    """
+
+    def __init__(self, directory, cam_name, n_files=8):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.files = [SpoolFile(os.path.join(directory, '%s_%d.spool' % (cam_name, k))) for k in range(n_files)]
+        self.next = 0
+
+    def acquire(self):
+        """Returns the next spool file without unwritten frames, None if there is none."""
+        for k in range(len(self.files)):
+            spool_file = self.files[(self.next + k) % len(self.files)]
+            if spool_file.state() in (EMPTY, WRITTEN):
+                self.next = (self.next + k + 1) % len(self.files)
+                return spool_file
+        return None
+
+
+def read_spool(path):
+    """
+    Reads a spool file
+
+    Returns:
+        info (dict): The header fields, 'state', 'n_frames', 'n_valid',
+                     'h5_filepath' and 'cam_name', and the lists
+                     'image_names', 'frametypes' and 'rois' of the frames.
+        frames (np.array): (n_valid, rows, cols) memory-mapped frames.
+    """
+
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    (magic, version, state, n_frames, n_valid, rows, cols, dtype,
+     h5_filepath, cam_name) = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('%s is not a version %d spool file' % (path, VERSION))
+    info = {'state': state, 'n_frames': n_frames, 'n_valid': n_valid,
+            'h5_filepath': h5_filepath.rstrip('\0'), 'cam_name': cam_name.rstrip('\0'),
+            'image_names': [], 'frametypes': [], 'rois': []}
+    for k in range(n_frames):
+        fields = FRAME.unpack_from(data, HEADER.size + k * FRAME.size)
+        info['image_names'].append(fields[0].rstrip('\0'))
+        info['frametypes'].append(fields[1].rstrip('\0'))
+        info['rois'].append(tuple(fields[2:]))
+    dtype = np.dtype(dtype.rstrip('\0'))
+    offset = data_offset(n_frames)
+    frames = data[offset:offset + n_frames * rows * cols * dtype.itemsize].view(dtype)
+    return info, frames.reshape((n_frames, rows, cols))[:n_valid]
+
+
+def recover(path, writer):
+    """
+    Writes the frames of a spool file into its shot file, unless they were written already.
+
+    Returns:
+        int: Number of frames written.
+    """
+
+    import h5py
+    info, frames = read_spool(path)
+    if info['state'] not in (ACQUIRING, READY) or not info['n_valid']:
+        return 0
+    with h5py.File(info['h5_filepath'], 'r') as f:
+        if info['cam_name'] in f.get('data', {}):
+            written = True
+        else:
+            written = False
+    if not written:
+        n_valid = info['n_valid']
+        rois = info['rois'][:n_valid]
+        if all(roi == (0, 0, 0, 0, 1) for roi in rois):
+            rois = None
+        writer.write(info['h5_filepath'], info['cam_name'], frames, info['image_names'][:n_valid],
+                     info['frametypes'][:n_valid], rois)
+    spool_file = SpoolFile(path)
+    spool_file.mmap = np.memmap(path, dtype=np.uint8, mode='r+')
+    spool_file.set_state(WRITTEN)
+    return 0 if written else info['n_valid']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Lists the shots in a camera spool directory and recovers them')
+    parser.add_argument('directory')
+    parser.add_argument('--recover', action='store_true',
+                        help='write the frames of the shots not written yet into their shot files')
+    parser.add_argument('--layout', default='images', help='as in camera_servers.ini')
+    parser.add_argument('--compression', default='none')
+    args = parser.parse_args()
+
+    try:
+        # Lock the shot files against BLACS, as the camera servers do
+        import labscript_utils.h5_lock
+    except ImportError:
+        pass
+    from h5writer import H5Writer
+    writer = None
+    if args.recover:
+        writer = H5Writer(layout=args.layout, compression=None if args.compression == 'none' else args.compression)
+    for path in sorted(glob.glob(os.path.join(args.directory, '*.spool'))):
+        try:
+            info, frames = read_spool(path)
+        except Exception as e:
+            print('%s: %s' % (os.path.basename(path), str(e)))
+            continue
+        print('%s: %s, %d of %d frames of %s for %s' % (os.path.basename(path), STATES.get(info['state'], '?'),
+              info['n_valid'], info['n_frames'], info['cam_name'], info['h5_filepath']))
+        if writer is not None and info['state'] in (ACQUIRING, READY):
+            try:
+                n_written = recover(path, writer)
+            except Exception as e:
+                sys.stderr.write('  could not recover: %s\n' % str(e))
+            else:
+                print('  recovered %d frames' % n_written if n_written else '  already in the shot file')
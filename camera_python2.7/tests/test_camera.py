@@ -0,0 +1,56 @@
+"""Tests of the exposure checks of the labscript device in Camera.py
+
+Need labscript and BLACS, and are skipped without them.
+
+  Typical usage example:
+
+  python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import Camera
+except ImportError:
+    Camera = None
+
+
+class Device(object):
+    """Stand-in for a Camera, with only what _check_processing() uses."""
+
+    def __init__(self, sensor_size):
+        self.sensor_size = sensor_size
+
+    def check(self, roi, binning=1):
+        return Camera.Camera.__dict__['_check_processing'](self, 'CAM', roi, binning)
+
+
+@unittest.skipIf(Camera is None, 'labscript and BLACS are not installed')
+class CheckProcessingTest(unittest.TestCase):
+
+    def test_inside(self):
+        device = Device((2048, 1024))
+        self.assertEqual(device.check((1048, 24, 1000, 1000), 4), ((1048, 24, 1000, 1000), 4))
+        self.assertEqual(device.check(None, 2), (None, 2))
+
+    def test_out_of_bounds(self):
+        device = Device((2048, 1024))
+        for roi in [(1049, 0, 1000, 10), (0, 25, 10, 1000), (3000, 2000, 10, 10)]:
+            self.assertRaises(Camera.LabscriptError, device.check, roi)
+
+    def test_binning_too_large(self):
+        self.assertRaises(Camera.LabscriptError, Device((2048, 1024)).check, (0, 0, 10, 10), 11)
+        self.assertRaises(Camera.LabscriptError, Device((2048, 1024)).check, None, 1025)
+        self.assertRaises(Camera.LabscriptError, Device(None).check, (0, 0, 10, 10), 11)
+
+    def test_unknown_sensor_size(self):
+        device = Device(None)
+        self.assertEqual(device.check((5000, 5000, 10, 10)), ((5000, 5000, 10, 10), 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
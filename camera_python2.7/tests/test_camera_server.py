@@ -0,0 +1,191 @@
+"""Tests of camera_server.py on the simulated cameras (see simcams.py)
+
+  Typical usage example:
+
+  python -m unittest discover tests
+"""
+
+import os
+import sys
+import time
+import shutil
+import StringIO
+import tempfile
+import threading
+import unittest
+import h5py
+
+os.environ['CAMERA_BACKEND'] = 'simulated'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import simcams
+import camera_server
+from benchmark_shots import Client, free_port, make_shot_file
+
+
+def shutdown(server):
+    """Shuts a server down and frees the buffers of a simulated pco.edge, which all its servers share."""
+    server.shutdown()
+    if hasattr(server, 'pcoecam'):
+        server.pcoecam.close()
+
+
+class StartupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        simcams.configure(latency=0.001)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def start_slowly(self, server_type, camera_module, camera_class):
+        """Starts a server in the background whose camera takes 0.5 s to open, returns its port."""
+        module = __import__(camera_module)
+        camera = getattr(module, camera_class)
+        original = camera.__init__
+        def slow_init(*args, **kwargs):
+            time.sleep(0.5)
+            original(*args, **kwargs)
+        camera.__init__ = slow_init
+        self.addCleanup(setattr, camera, '__init__', original)
+        port = free_port()
+        servers = []
+        thread = threading.Thread(target=lambda: servers.append(
+            camera_server.SERVER_TYPES[server_type](port, 'CAM', {})))
+        thread.start()
+        def stop():
+            thread.join()
+            if servers:
+                shutdown(servers[0])
+        self.addCleanup(stop)
+        return port
+
+    def check_shot_right_after_startup(self, server_type, camera_module, camera_class):
+        port = self.start_slowly(server_type, camera_module, camera_class)
+        client = Client(port, timeout=10)
+        self.addCleanup(client.close)
+        h5_filepath = os.path.join(self.directory, 'shot.h5')
+        make_shot_file(h5_filepath, 'CAM', 3, 0.005, 0.001)
+        self.assertEqual(client.exchange(h5_filepath, 2), ['ok', 'done'])
+        simcams.trigger_all(3, 0.005)
+        time.sleep(0.1)
+        self.assertEqual(client.exchange('done', 2), ['ok', 'done'])
+        self.assertEqual(client.request('flush'), 'done')
+
+    def test_pcoedge(self):
+        self.check_shot_right_after_startup('pcoedge', 'pcoedge', 'PCOCamera')
+
+    def test_hamamatsu(self):
+        self.check_shot_right_after_startup('hamamatsu', 'hcam', 'HamamatsuCameraMR')
+
+    def test_pointgrey(self):
+        self.check_shot_right_after_startup('pointgrey', 'pgcam', 'PointGreyCamera')
+
+
+class RoiTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        simcams.configure(latency=0.001)
+
+    def check_shot_refused(self, server_type):
+        port = free_port()
+        server = camera_server.SERVER_TYPES[server_type](port, 'CAM', {'compression': 'lzf'})
+        self.addCleanup(shutdown, server)
+        client = Client(port, timeout=10)
+        self.addCleanup(client.close)
+        h5_filepath = os.path.join(self.directory, 'shot.h5')
+        make_shot_file(h5_filepath, 'CAM', 3, 0.005, 0.001, roi=(0, 0, 100000, 10))
+        replies = client.exchange(h5_filepath, 2)
+        self.assertEqual(replies[0], 'ok')
+        self.assertIn('is not inside the', replies[1])
+        # The next shot runs
+        make_shot_file(h5_filepath, 'CAM', 3, 0.005, 0.001, roi=(0, 0, 100, 10))
+        self.assertEqual(client.exchange(h5_filepath, 2), ['ok', 'done'])
+        simcams.trigger_all(3, 0.005)
+        time.sleep(0.1)
+        self.assertEqual(client.exchange('done', 2), ['ok', 'done'])
+        self.assertEqual(client.request('flush'), 'done')
+
+    def test_pcoedge(self):
+        self.check_shot_refused('pcoedge')
+
+    def test_hamamatsu(self):
+        self.check_shot_refused('hamamatsu')
+
+    def test_pointgrey(self):
+        self.check_shot_refused('pointgrey')
+
+
+class PointGreyGrabTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        # Slower frames than the 1 ms a grab used to wait for them
+        simcams.configure(latency=0.2)
+        self.addCleanup(simcams.configure, latency=0.001)
+        port = free_port()
+        server = camera_server.SERVER_TYPES['pointgrey'](port, 'CAM', {})
+        self.addCleanup(shutdown, server)
+        self.client = Client(port, timeout=10)
+        self.addCleanup(self.client.close)
+        self.output = StringIO.StringIO()
+        stdout, sys.stdout = sys.stdout, self.output
+        self.addCleanup(setattr, sys, 'stdout', stdout)
+
+    def run_shot(self, n_triggers, wait=0.):
+        h5_filepath = tempfile.mktemp(suffix='.h5', dir=self.directory)
+        make_shot_file(h5_filepath, 'CAM', 3, 0.005, 0.001)
+        self.assertEqual(self.client.exchange(h5_filepath, 2), ['ok', 'done'])
+        simcams.trigger_all(n_triggers, 0.005)
+        time.sleep(wait)
+        return self.client.exchange('done', 2)
+
+    def test_slow_frames(self):
+        # Asks for the images before they are ready
+        for _ in range(2):
+            self.assertEqual(self.run_shot(3), ['ok', 'done'])
+        self.assertEqual(self.client.request('flush'), 'done')
+        self.assertNotIn('Error retrieving buffer', self.output.getvalue())
+
+    def test_surplus_frame(self):
+        replies = self.run_shot(4, wait=0.3)
+        self.assertEqual(replies[0], 'ok')
+        self.assertIn('4 images arrived', replies[1])
+        self.assertNotIn('Error retrieving buffer', self.output.getvalue())
+
+
+class PreviewAfterWriteErrorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        simcams.configure(latency=0.001)
+
+    def test_hamamatsu(self):
+        port = free_port()
+        server = camera_server.SERVER_TYPES['hamamatsu'](port, 'CAM', {}, {'port': free_port()})
+        self.addCleanup(shutdown, server)
+        client = Client(port, timeout=10)
+        self.addCleanup(client.close)
+        h5_filepath = os.path.join(self.directory, 'shot.h5')
+        make_shot_file(h5_filepath, 'CAM', 3, 0.005, 0.001)
+        # The images of the shot can not be written
+        with h5py.File(h5_filepath) as f:
+            f.create_group('data/CAM')
+        self.assertEqual(client.exchange(h5_filepath, 2), ['ok', 'done'])
+        simcams.trigger_all(3, 0.005)
+        time.sleep(0.1)
+        self.assertEqual(client.exchange('done', 2), ['ok', 'done'])
+        # The preview starts all the same, the error is left to the flush
+        self.assertEqual(client.request('preview'), 'ok')
+        self.assertEqual(client.request('stop_preview'), 'ok')
+        self.assertIn('already exists', client.request('flush'))
+        self.assertEqual(client.request('flush'), 'done')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+"""Tests of the region of interest checks of h5writer.py
+
+  Typical usage example:
+
+  python -m unittest discover tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from h5writer import H5Writer, check_roi, crop_and_bin
+
+
+class RoiTest(unittest.TestCase):
+
+    def test_inside(self):
+        image = np.ones((100, 200), dtype=np.uint16)
+        self.assertEqual(crop_and_bin(image, (150, 80, 50, 20, 1)).shape, (20, 50))
+        self.assertEqual(crop_and_bin(image, (0, 0, 0, 0, 4)).shape, (25, 50))
+
+    def test_out_of_bounds(self):
+        for roi in [(150, 0, 51, 10, 1),    # past the right edge
+                    (0, 90, 10, 11, 1),     # past the bottom edge
+                    (200, 100, 10, 10, 1),  # entirely outside
+                    (-1, 0, 10, 10, 1)]:
+            self.assertRaises(ValueError, check_roi, (100, 200), roi)
+            self.assertRaises(ValueError, crop_and_bin, np.ones((100, 200)), roi)
+
+    def test_binning_too_large(self):
+        self.assertRaises(ValueError, check_roi, (100, 200), (0, 0, 10, 10, 11))
+        self.assertRaises(ValueError, check_roi, (100, 200), (0, 0, 0, 0, 101))
+
+
+class PutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.h5_filepath = os.path.join(self.directory, 'shot.h5')
+        with h5py.File(self.h5_filepath, 'w') as f:
+            f.create_group('data')
+
+    def test_out_of_bounds_not_queued(self):
+        writer = H5Writer(compression='lzf')
+        images = np.ones((2, 100, 200), dtype=np.uint16)
+        self.assertRaises(ValueError, writer.put, self.h5_filepath, 'CAM', images, ['a', 'b'],
+                          rois=[(0, 0, 10, 10, 1), (190, 0, 20, 10, 1)])
+        writer.flush()
+        with h5py.File(self.h5_filepath, 'r') as f:
+            self.assertNotIn('CAM', f['data'])
+
+    def test_inside_written(self):
+        writer = H5Writer(compression='lzf')
+        images = np.ones((2, 100, 200), dtype=np.uint16)
+        writer.put(self.h5_filepath, 'CAM', images, ['a', 'b'], rois=[(0, 0, 10, 10, 1), (190, 0, 10, 10, 2)])
+        writer.flush()
+        with h5py.File(self.h5_filepath, 'r') as f:
+            self.assertEqual(f['data/CAM/a'].shape, (10, 10))
+            self.assertEqual(f['data/CAM/b'].shape, (5, 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""Tests of hcam.py on the simulated DCAM (see simcams.py)
+
+  Typical usage example:
+
+  python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+os.environ['CAMERA_BACKEND'] = 'simulated'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hcam
+
+
+class SetPropertiesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.camera = hcam.HamamatsuCameraMR(0)
+        dcam = self.camera.dcam
+        original = dcam.dcam_setgetpropertyvalue
+        self.sent = []
+        def counting(handle, prop_id, value, option):
+            self.sent.append(prop_id.value)
+            return original(handle, prop_id, value, option)
+        dcam.dcam_setgetpropertyvalue = counting
+        self.addCleanup(setattr, dcam, 'dcam_setgetpropertyvalue', original)
+
+    def set_twice(self, properties):
+        """Returns the values of both calls and how many properties the second one sent to the camera."""
+        first = self.camera.setProperties(properties)
+        del self.sent[:]
+        second = self.camera.setProperties(properties)
+        return first, second, len(self.sent)
+
+    def test_text_value_unchanged(self):
+        first, second, n_sent = self.set_twice([('trigger_source', 'EXTERNAL')])
+        self.assertEqual(first['trigger_source'], 2.)
+        self.assertEqual(second, first)
+        self.assertEqual(n_sent, 0)
+
+    def test_clamped_value_unchanged(self):
+        first, second, n_sent = self.set_twice([('exposure_time', 100.), ('subarray_hpos', -8)])
+        self.assertEqual(first, {'exposure_time': 10., 'subarray_hpos': 0.})
+        self.assertEqual(second, first)
+        self.assertEqual(n_sent, 0)
+
+    def test_changed_value_sent(self):
+        self.camera.setProperties([('exposure_time', 0.01)])
+        del self.sent[:]
+        values = self.camera.setProperties([('exposure_time', 0.02)])
+        self.assertEqual(values['exposure_time'], 0.02)
+        self.assertEqual(len(self.sent), 1)
+
+    def test_settrigger_resets_trigger_properties(self):
+        self.camera.setProperties([('trigger_source', 'EXTERNAL'), ('exposure_time', 0.01)])
+        self.camera.settrigger(1)
+        del self.sent[:]
+        self.camera.setProperties([('trigger_source', 'EXTERNAL'), ('exposure_time', 0.01)])
+        self.assertIn(self.camera.properties['trigger_source'], self.sent)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+"""Tests of the spool files of spool.py
+
+  Typical usage example:
+
+  python -m unittest discover tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import spool
+
+
+class SpoolFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.spool = spool.Spool(self.directory, 'CAM', n_files=2)
+
+    def create(self, h5_filepath='shot.h5', cam_name='CAM', image_names=('atoms', 'probe'),
+               frametypes=('atoms', 'probe')):
+        spool_file = self.spool.acquire()
+        frames = spool_file.create(h5_filepath, cam_name, 2, (4, 6), np.uint16, list(image_names),
+                                   list(frametypes), [(0, 0, 0, 0, 1)] * 2)
+        return spool_file, frames
+
+    def test_round_trip(self):
+        h5_filepath = 'C:\\' + 'a' * (spool.PATH_SIZE - 3)
+        name = 'n' * spool.NAME_SIZE
+        spool_file, frames = self.create(h5_filepath, name, [name, 'probe'], ['atoms', name])
+        frames[:] = np.arange(frames.size).reshape(frames.shape)
+        spool_file.commit(2, spool.READY)
+        info, spooled = spool.read_spool(spool_file.path)
+        self.assertEqual(info['state'], spool.READY)
+        self.assertEqual(info['h5_filepath'], h5_filepath)
+        self.assertEqual(info['cam_name'], name)
+        self.assertEqual(info['image_names'], [name, 'probe'])
+        self.assertEqual(info['frametypes'], ['atoms', name])
+        np.testing.assert_array_equal(spooled, frames)
+
+    def test_too_long(self):
+        too_long = 'n' * (spool.NAME_SIZE + 1)
+        for kwargs in [{'h5_filepath': 'p' * (spool.PATH_SIZE + 1)},
+                       {'cam_name': too_long},
+                       {'image_names': ['atoms', too_long]},
+                       {'frametypes': [too_long, 'probe']}]:
+            self.assertRaises(ValueError, self.create, **kwargs)
+        # Nothing was spooled, the files are still free
+        self.assertTrue(all(spool_file.state() == spool.EMPTY for spool_file in self.spool.files))
+
+
+if __name__ == '__main__':
+    unittest.main()